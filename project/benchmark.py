@@ -0,0 +1,488 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Benchmark suite for the hot paths of the book library
+
+Generates synthetic libraries of different sizes and measures the time
+(and optionally the peak memory) of loading, saving, finding, adding and
+importing books. Results can be stored as baseline and compared against
+in later runs.
+
+Usage example:
+    python benchmark.py --sizes 1000 10000 100000 --save-baseline baseline.json
+    python benchmark.py --sizes 1000 10000 100000 --compare baseline.json
+    python benchmark.py --sizes 100000 --parallel-load 1 2 4 8
+    python benchmark.py --sizes 100000 --codecs
+    python benchmark.py --sizes 100000 --isbn
+'''
+
+from book_library import BookLibraryJSON, ShardedBookLibraryJSON, CODECS
+from book import Book, BookJSONEncoder
+from project import handle_cli_command_import
+from dedupe import find_duplicates
+import isbn_batch
+
+import argparse
+import isbnlib
+import contextlib
+import datetime
+import io
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+
+SAMPLE_LIBRARY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_library.json")
+
+
+def sample_vocabulary(filename=SAMPLE_LIBRARY) -> dict:
+    '''
+    Collect first names, last names, keywords and title words of a library file
+    '''
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(filename)
+
+    first_names = set()
+    last_names = set()
+    keywords = set()
+    title_words = set()
+    for book in lib:
+        for author in book.authors:
+            parts = author.split()
+            if len(parts) > 1:
+                first_names.add(" ".join(parts[:-1]))
+            last_names.add(parts[-1])
+        keywords.update(book.keywords)
+        title_words.update(book.title.split())
+
+    return {
+        "first_names": sorted(first_names),
+        "last_names": sorted(last_names),
+        "keywords": sorted(keywords),
+        "title_words": sorted(title_words),
+    }
+
+
+def _zipf_weights(n, s=1.1) -> list:
+    # few authors/keywords are very popular, most are rare
+    return [1 / (rank ** s) for rank in range(1, n + 1)]
+
+
+def _random_isbn13(rng) -> str:
+    digits = "978" + "".join(str(rng.randrange(10)) for _ in range(9))
+    checksum = sum(int(d) * (1 if i % 2 == 0 else 3) for i, d in enumerate(digits))
+    return digits + str((10 - checksum % 10) % 10)
+
+
+def generate_books(size, seed=42, vocabulary=None) -> list:
+    '''
+    Generate a list of size synthetic books
+    Authors, keywords and title words are derived from the sample library.
+    Author and keyword popularity follow a Zipf distribution.
+    '''
+    rng = random.Random(seed)
+    vocabulary = vocabulary or sample_vocabulary()
+
+    # combine first and last names to a vocabulary of about size/5 authors
+    author_count = max(10, size // 5)
+    authors = [f"{rng.choice(vocabulary['first_names'])} {rng.choice(vocabulary['last_names'])} {i}" for i in range(author_count)]
+    author_weights = _zipf_weights(author_count)
+
+    # extend keywords by synthetic ones to obtain a long tail
+    keywords = vocabulary["keywords"] + [f"topic {i}" for i in range(max(10, size // 50))]
+    keyword_weights = _zipf_weights(len(keywords))
+
+    books = []
+    for _ in range(size):
+        meta = {
+            "uuid": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "title": " ".join(rng.choices(vocabulary["title_words"], k=rng.randint(1, 6))),
+            "authors": rng.choices(authors, weights=author_weights, k=rng.choices([1, 2, 3, 5], weights=[60, 25, 10, 5])[0]),
+            "keywords": rng.choices(keywords, weights=keyword_weights, k=rng.randint(0, 5)),
+        }
+        if rng.random() < 0.9:
+            meta["publication_date"] = datetime.date(rng.randint(1500, 2024), rng.randint(1, 12), rng.randint(1, 28))
+        if rng.random() < 0.5:
+            meta["isbn"] = _random_isbn13(rng)
+
+        books.append(Book(**meta))
+
+    return books
+
+
+def write_library_file(books, filename):
+    '''
+    Write books to a library file without adding them to a library one by one
+    '''
+    with open(filename, "wt", encoding="utf-8") as f:
+        json.dump(books, f, cls=BookJSONEncoder, indent=4)
+
+
+def generate_library(size, seed=42, vocabulary=None) -> BookLibraryJSON:
+    '''
+    Generate a synthetic library with size books (see generate_books())
+    '''
+    lib = BookLibraryJSON()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        lib_file = os.path.join(tmp_dir, "library.json")
+        write_library_file(generate_books(size, seed, vocabulary), lib_file)
+        lib.read_from_json_file(lib_file)
+
+    return lib
+
+
+def measure(func, memory=False) -> dict:
+    '''
+    Call func() and return elapsed time in seconds and (optionally) peak memory in bytes
+    '''
+    if memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+
+    result = {"seconds": elapsed}
+    if memory:
+        result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return result
+
+
+def run_benchmarks(size, repeat=3, memory=False, seed=42) -> dict:
+    '''
+    Run all benchmarks for a library of given size
+    Returns a dict: benchmark name -> {"seconds", "books_per_second"[, "peak_bytes"]}
+    The best of repeat runs is reported.
+    '''
+    lib = generate_library(size, seed=seed)
+    books = list(lib)
+    some_book = books[len(books) // 2]
+    some_isbn = next((b.isbn for b in books if b.isbn), None)
+    some_author = some_book.authors[0]
+
+    results = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        lib_file = os.path.join(tmp_dir, "library.json")
+        lib.write_to_json_file(lib_file)
+        jsonl_file = os.path.join(tmp_dir, "library.jsonl")
+        lib.write_to_json_file(jsonl_file)
+
+        def load():
+            BookLibraryJSON().read_from_json_file(lib_file)
+
+        # unchanged libraries are not saved again to the same file
+        saves = itertools.count()
+
+        def save():
+            lib.write_to_json_file(os.path.join(tmp_dir, f"saved-{next(saves)}.json"))
+
+        def load_jsonl():
+            BookLibraryJSON().read_from_json_file(jsonl_file)
+
+        def save_jsonl():
+            lib.write_to_json_file(os.path.join(tmp_dir, f"saved-{next(saves)}.jsonl"))
+
+        jsonl_lib = BookLibraryJSON()
+        jsonl_lib.read_from_json_file(jsonl_file)
+
+        def append_jsonl():
+            jsonl_lib.add(Book(title="Appended book", authors=["John Doe"]))
+            jsonl_lib.write_to_json_file(jsonl_file)
+
+        cached_lib = BookLibraryJSON(cache_size=16)
+        cached_lib.read_from_json_file(jsonl_file)
+
+        indexed_file = os.path.join(tmp_dir, "indexed.jsonl")
+        lib.write_to_json_file(indexed_file)
+
+        def load_indexed(persist_indexes):
+            # load and answer queries using all lazy indexes
+            indexed_lib = BookLibraryJSON(persist_indexes=persist_indexes)
+            indexed_lib.INDEX_FILE_MIN_BOOKS = 0
+            indexed_lib.read_from_json_file(indexed_file)
+            indexed_lib.count(keywords=["mathematics"])
+            indexed_lib.find(authors=[some_author], fuzzy=1)
+            indexed_lib.search("mathematics")
+            indexed_lib.complete(some_author[:2])
+            indexed_lib.complete(some_book.title[:2], field="title")
+
+        # the first run writes the index file
+        load_indexed(True)
+
+        def bulk_add():
+            target = BookLibraryJSON()
+            for book in books:
+                target.add(book)
+
+        def import_json():
+            target_file = os.path.join(tmp_dir, "import_target.json")
+            BookLibraryJSON().write_to_json_file(target_file)
+            args = argparse.Namespace(file=target_file, json_file=lib_file, isbn_file=None)
+            with contextlib.redirect_stdout(io.StringIO()):
+                handle_cli_command_import(args)
+
+        benchmarks = {
+            "load": load,
+            "save": save,
+            "load_jsonl": load_jsonl,
+            "save_jsonl": save_jsonl,
+            "append_jsonl": append_jsonl,
+            "load_indexes_cold": lambda: load_indexed(False),
+            "load_indexes_warm": lambda: load_indexed(True),
+            "find_all": lambda: lib.find(),
+            "find_uuid": lambda: lib.find(uuid=some_book.uuid),
+            "find_title": lambda: lib.find(title="*" + some_book.title.split()[0] + "*"),
+            "find_isbn": lambda: lib.find(isbn=some_isbn),
+            "find_authors": lambda: lib.find(authors=[some_author, "*Doe"]),
+            "find_authors_match_all": lambda: lib.find(authors=[some_author, "*Doe"], match_all=True),
+            "find_authors_insensitive": lambda: lib.find(authors=[some_author.upper(), "*doe"], insensitive=True),
+            "find_authors_fuzzy": lambda: lib.find(authors=[some_author[:-1]], fuzzy=2),
+            "find_keywords": lambda: lib.find(keywords=["mathematics", "topic 1*"]),
+            "find_keywords_match_all": lambda: lib.find(keywords=["mathematics", "topic 1*"], match_all=True),
+            "count_keywords_match_all": lambda: lib.count(keywords=["mathematics", "topic 1*"], match_all=True),
+            "find_keywords_cached": lambda: cached_lib.find(keywords=["mathematics", "topic 1*"]),
+            "find_published": lambda: lib.find(published_after="1900-01-01", published_before="2000-01-01"),
+            "search": lambda: lib.search("mathematics " + some_author),
+            "complete": lambda: lib.complete(some_author[:2]),
+            "dedupe": lambda: find_duplicates(lib.find()),
+            "bulk_add": bulk_add,
+            "import_json": import_json,
+        }
+
+        for name, func in benchmarks.items():
+            best = min((measure(func) for _ in range(repeat)), key=lambda r: r["seconds"])
+            if memory:
+                best["peak_bytes"] = measure(func, memory=True)["peak_bytes"]
+            best["books_per_second"] = size / best["seconds"] if best["seconds"] else float("inf")
+            results[name] = best
+
+    return results
+
+
+def write_sharded_library(books, directory):
+    '''
+    Write books to a sharded library directory without adding them one by one
+    '''
+    lib = ShardedBookLibraryJSON()
+    lib.write_to_json_file(directory)
+
+    shards = {}
+    for book in books:
+        shards.setdefault(lib.shard_prefix(book.uuid), []).append(book)
+    for prefix, shard_books in shards.items():
+        write_library_file(shard_books, lib._shard_filename(directory, prefix))
+
+
+def run_parallel_load_benchmark(size, worker_counts, repeat=3, seed=42) -> dict:
+    '''
+    Measure loading a sharded library and decoding a JSON Lines library file
+    with different numbers of worker processes
+    Returns a dict: "parallel_load_<workers>"/"parallel_load_jsonl_<workers>" -> {"seconds", "books_per_second"}
+    (1 worker: loading in this process)
+    '''
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        books = generate_books(size, seed=seed)
+        shard_dir = os.path.join(tmp_dir, "sharded")
+        write_sharded_library(books, shard_dir)
+        jsonl_file = os.path.join(tmp_dir, "library.jsonl")
+        lib = BookLibraryJSON()
+        lib._add_loaded(books)
+        lib.write_to_json_file(jsonl_file)
+
+        for workers in worker_counts:
+            def load():
+                ShardedBookLibraryJSON(workers=workers).read_from_json_file(shard_dir)
+
+            def load_jsonl():
+                # files of any size are split among the workers
+                jsonl_lib = BookLibraryJSON(workers=workers)
+                jsonl_lib.PARALLEL_LOAD_MIN_BYTES = 0
+                jsonl_lib.read_from_json_file(jsonl_file)
+
+            for name, func in ((f"parallel_load_{workers}", load), (f"parallel_load_jsonl_{workers}", load_jsonl)):
+                best = min((measure(func) for _ in range(repeat)), key=lambda r: r["seconds"])
+                best["books_per_second"] = size / best["seconds"] if best["seconds"] else float("inf")
+                results[name] = best
+
+    return results
+
+
+def run_codec_benchmark(size, repeat=3, seed=42) -> dict:
+    '''
+    Measure loading and saving compressed library files for each codec
+    Returns a dict: "load_<codec>"/"save_<codec>" -> {"seconds", "books_per_second", "file_bytes"}
+    '''
+    lib = generate_library(size, seed=seed)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        saves = itertools.count()
+
+        for codec, extension in [("none", "")] + [(codec, CODECS[codec][0]) for codec in CODECS]:
+            lib_file = os.path.join(tmp_dir, "library.jsonl" + extension)
+            lib.write_to_json_file(lib_file)
+            file_bytes = os.path.getsize(lib_file)
+
+            def load():
+                BookLibraryJSON().read_from_json_file(lib_file)
+
+            def save():
+                lib.write_to_json_file(os.path.join(tmp_dir, f"saved-{next(saves)}.jsonl{extension}"))
+
+            for name, func in (("load", load), ("save", save)):
+                best = min((measure(func) for _ in range(repeat)), key=lambda r: r["seconds"])
+                best["books_per_second"] = size / best["seconds"] if best["seconds"] else float("inf")
+                best["file_bytes"] = file_bytes
+                results[f"{name}_{codec}"] = best
+
+    return results
+
+
+def run_isbn_benchmark(size, repeat=3, seed=42) -> dict:
+    '''
+    Measure validating the ISBNs of an import file per value with isbnlib versus
+    in batches, and formatting ISBNs (isbnlib.mask() versus the memoized Book.isbn_str)
+    Returns a dict: name -> {"seconds", "books_per_second"}
+    '''
+    books = [book for book in generate_library(size, seed=seed) if book.isbn]
+    rnd = random.Random(seed)
+
+    # lines as found in ISBN files: canonical, hyphenated or no ISBN at all
+    lines = []
+    for book in books:
+        choice = rnd.random()
+        if choice < 0.5:
+            lines.append(book.isbn)
+        elif choice < 0.9:
+            lines.append(book.isbn[:3] + "-" + book.isbn[3:])
+        else:
+            lines.append(book.title)
+
+    benchmarks = {
+        "isbn_validate_isbnlib": lambda: [isbnlib.get_canonical_isbn(line) for line in lines],
+        "isbn_validate_batch": lambda: list(isbn_batch.iter_canonical_isbns(lines, use_numpy=False)),
+        "isbn_mask_isbnlib": lambda: [isbnlib.mask(book.isbn) for book in books],
+        "isbn_str": lambda: [book.isbn_str for book in books],
+    }
+    if isbn_batch.numpy is not None:
+        benchmarks["isbn_validate_numpy"] = lambda: list(isbn_batch.iter_canonical_isbns(lines, use_numpy=True))
+
+    results = {}
+    for name, func in benchmarks.items():
+        best = min((measure(func) for _ in range(repeat)), key=lambda r: r["seconds"])
+        best["books_per_second"] = len(books) / best["seconds"] if best["seconds"] else float("inf")
+        results[name] = best
+
+    return results
+
+
+def compare(results, baseline, threshold=0.2) -> list:
+    '''
+    Compare results with baseline results
+    Returns list of (size, benchmark, ratio) of all benchmarks that are slower
+    than the baseline by more than threshold (0.2 = 20%)
+    '''
+    regressions = []
+    for size, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            reference = baseline.get(str(size), {}).get(name)
+            if not reference or not reference["seconds"]:
+                continue
+
+            ratio = result["seconds"] / reference["seconds"]
+            if ratio > 1 + threshold:
+                regressions.append((size, name, ratio))
+
+    return regressions
+
+
+def print_report(results, baseline=None, file=sys.stdout):
+    for size, benchmarks in results.items():
+        print(f"Library size: {size} books", file=file)
+        for name, result in benchmarks.items():
+            line = f"  {name:<26} {result['seconds']*1000:12.3f} ms {result['books_per_second']:14.0f} books/s"
+            if "peak_bytes" in result:
+                line += f" {result['peak_bytes']/2**20:10.1f} MiB"
+            if "file_bytes" in result:
+                line += f" {result['file_bytes']/2**20:10.1f} MiB file"
+            if baseline and (reference := baseline.get(str(size), {}).get(name)) and reference["seconds"]:
+                line += f"   x{result['seconds']/reference['seconds']:.2f} vs. baseline"
+            print(line, file=file)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks of the book library")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], metavar="N", help="Library sizes (default: 1000 10000)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per benchmark, best is reported (default: 3)")
+    parser.add_argument("--memory", action="store_true", help="Measure peak memory (additional run per benchmark)")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the synthetic library generator")
+    parser.add_argument("--parallel-load", type=int, nargs="+", metavar="WORKERS", help="Also measure loading sharded libraries and JSON Lines files with given numbers of worker processes")
+    parser.add_argument("--codecs", action="store_true", help="Also measure loading and saving compressed library files")
+    parser.add_argument("--isbn", action="store_true", help="Also measure validating and formatting ISBNs")
+    parser.add_argument("--save-baseline", type=str, metavar="FILE", help="Store results as baseline")
+    parser.add_argument("--compare", type=str, metavar="FILE", help="Compare results against baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Tolerated slowdown vs. baseline (default: 0.2)")
+    return parser.parse_args(argv)
+
+
+def main(argv):
+    args = parse_args(argv)
+
+    results = {size: run_benchmarks(size, repeat=args.repeat, memory=args.memory, seed=args.seed) for size in args.sizes}
+
+    if args.parallel_load:
+        for size in args.sizes:
+            results[size].update(run_parallel_load_benchmark(size, args.parallel_load, repeat=args.repeat, seed=args.seed))
+
+    if args.codecs:
+        for size in args.sizes:
+            results[size].update(run_codec_benchmark(size, repeat=args.repeat, seed=args.seed))
+
+    if args.isbn:
+        for size in args.sizes:
+            results[size].update(run_isbn_benchmark(size, repeat=args.repeat, seed=args.seed))
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "rt", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    print_report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "wt", encoding="utf-8") as f:
+            json.dump({str(size): benchmarks for size, benchmarks in results.items()}, f, indent=4)
+
+    if baseline and (regressions := compare(results, baseline, args.threshold)):
+        for size, name, ratio in regressions:
+            print(f"Regression: {name} ({size} books) is {ratio:.2f} times slower than baseline", file=sys.stderr)
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
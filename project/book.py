@@ -19,9 +19,33 @@ import datetime
 import isbnlib
 import re
 import json
+import profiling
+import metrics
+import functools
+import unicodedata
+from isbn_batch import canonical_isbn
 
 # BOOK_META_SERVICE="dnb"
 
+# Hyphenated ISBNs (isbnlib.mask() looks up the registration group ranges)
+ISBN_MASK_CACHE_SIZE = 1 << 16
+_mask_isbn = functools.lru_cache(maxsize=ISBN_MASK_CACHE_SIZE)(isbnlib.mask)
+
+def normalize(text: str) -> str:
+    """ Search key of a text: casefolded, accents stripped, e.g. "Éléments" -> "elements" """
+    return "".join(c for c in unicodedata.normalize("NFKD", text.casefold()) if not unicodedata.combining(c))
+
+
+def isbn13(isbn: str) -> str:
+    """ Canonical ISBN-13 of an ISBN-10 or ISBN-13, e.g. "0-306-40615-2" -> "9780306406157"
+        Values that cannot be converted are returned in canonical form.
+    """
+    isbn = isbnlib.canonical(isbn)
+    if len(isbn) == 10:
+        return isbnlib.to_isbn13(isbn) or isbn
+    return isbn
+
+
 class BookJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, set):
@@ -47,9 +71,16 @@ class BookJSONDecoder(json.JSONDecoder):
         return dct 
 
 class Book:
+    # set by the library holding the book, called as
+    # _on_change(book, old_isbn) after the metadata of the book changed
+    _on_change = None
+
     def __init__(self, **kwargs) -> None:
 
         self._meta = {'__type__': 'mybooks.Book'}
+        self._dirty = False
+        self._keys = None
+        self._isbn13 = None
         
         if kwargs.get('uuid'):
             self._meta['uuid'] = kwargs['uuid']
@@ -60,10 +91,18 @@ class Book:
             raise ValueError("Title and authors are requred!")
 
         self.update(**kwargs)
+
+        # a new book is clean, changes are tracked from now on
+        self._dirty = False
     
 
     def update(self, **kwargs) -> int:
+        """ Set metadata of the book
+            Returns number of changed properties, i.e. values that equal the
+            current ones are not counted
+        """
         updates_performed = 0
+        old_isbn = self._meta.get('isbn')
 
         if kwargs.get("uuid") and (kwargs["uuid"] != self._meta['uuid']):
             raise ValueError("Changing the UUID is not allowed!")
@@ -72,8 +111,9 @@ class Book:
             if not isinstance(kwargs["title"], str):
                 raise ValueError("Title must be a str!")
 
-            self._meta['title'] = kwargs["title"]
-            updates_performed += 1
+            if kwargs["title"] != self._meta.get('title'):
+                self._meta['title'] = kwargs["title"]
+                updates_performed += 1
 
         if kwargs.get("authors"):
             if not isinstance(kwargs["authors"], list):
@@ -84,44 +124,62 @@ class Book:
                 if not isinstance(author, str):
                     raise ValueError("Author must be a str!")
         
-            self._meta['authors'] = kwargs["authors"]
-            updates_performed += len(kwargs["authors"])
+            if kwargs["authors"] != self._meta.get('authors'):
+                self._meta['authors'] = kwargs["authors"]
+                updates_performed += len(kwargs["authors"])
 
 
         if kwargs.get("publication_date"):
             if isinstance(kwargs["publication_date"], datetime.date):
-                self._meta['publication_date'] = kwargs["publication_date"]
-                updates_performed += 1
+                publication_date = kwargs["publication_date"]
             
             elif isinstance(kwargs["publication_date"], str):
                 if d := Book._parse_date_str(kwargs["publication_date"]):
-                    self._meta['publication_date'] = datetime.date(d[0],d[1],d[2])
-                    updates_performed += 1
+                    publication_date = datetime.date(d[0],d[1],d[2])
                 else:
                     raise ValueError("Invalid publication date!")
             else:
                 raise ValueError("Publication date must be either datetime.date or str!")
+
+            if publication_date != self._meta.get('publication_date'):
+                self._meta['publication_date'] = publication_date
+                updates_performed += 1
         
         
         if kwargs.get("isbn"):
-            isbn = isbnlib.canonical(kwargs["isbn"])
-            if isbnlib.notisbn(isbn):
+            isbn = canonical_isbn(kwargs["isbn"])
+            if not isbn:
                 raise ValueError(f'Invalid ISBN: {kwargs["isbn"]}')
             
-            self._meta['isbn'] = isbn
-            updates_performed += 1
+            if isbn != self._meta.get('isbn'):
+                self._meta['isbn'] = isbn
+                self._isbn13 = None
+                updates_performed += 1
 
 
         if kwargs.get("keywords"):
             if (isinstance(kwargs["keywords"], set) or isinstance(kwargs["keywords"], list)):
+                old_keywords = self._meta.get('keywords') or set()
                 self._meta['keywords'] = set()
-                for keyword in kwargs["keywords"]:           
-                    self.add_keyword(keyword)
-                    updates_performed += 1
+                self._add_keywords(kwargs["keywords"])
+
+                if self._meta['keywords'] != old_keywords:
+                    updates_performed += len(kwargs["keywords"])
             else:
                 raise ValueError("Keywords must be either set or list!")
+
+        if updates_performed:
+            self._changed(old_isbn)
         
         return updates_performed
+
+    def _changed(self, old_isbn):
+        self._dirty = True
+        self._keys = None
+        if self._meta.get('isbn') != old_isbn:
+            self._isbn13 = None
+        if self._on_change:
+            self._on_change(self, old_isbn)
     
     def __str__(self) -> str:
 
@@ -209,7 +267,9 @@ class Book:
         isbn = isbnlib.canonical(isbn)
 
         try:
-            isbn_meta = isbnlib.meta(isbn)    
+            with profiling.phase("fetch") as p, metrics.timer("mybooks_fetch_seconds"):
+                isbn_meta = isbnlib.meta(isbn)    
+                p.add_count()
 
             if isbn_meta and isinstance(isbn_meta, dict):
                 if "Title" in isbn_meta:
@@ -222,12 +282,17 @@ class Book:
                     meta['publication_date'] = datetime.date(int(isbn_meta["Year"]), 1, 1)
                 
                 meta["isbn"] = isbn
-
                 return meta
             
         except isbnlib.NotValidISBNError:
+            metrics.inc("mybooks_fetch_errors_total", error="invalid isbn")
             raise ValueError('Invalid ISBN!')
+
+        except Exception as e:
+            metrics.inc("mybooks_fetch_errors_total", error=type(e).__name__)
+            raise
         
+        metrics.inc("mybooks_fetch_errors_total", error="no metadata")
         return None
     
     @classmethod
@@ -240,8 +305,14 @@ class Book:
 
     def fetch_meta(self) -> bool:
         if meta := Book._meta_from_isbn(self.isbn):
+            old_isbn = self.isbn
+            changed = False
             for key in meta:
-                self._meta[key] = meta[key]
+                if self._meta.get(key) != meta[key]:
+                    self._meta[key] = meta[key]
+                    changed = True
+            if changed:
+                self._changed(old_isbn)
             return True
 
         return False
@@ -256,16 +327,73 @@ class Book:
     @classmethod
     def from_meta(cls, meta):
         return Book(**meta)
+
+    @property
+    def record(self) -> tuple:
+        """ Compact, picklable representation of the book:
+            (uuid, title, authors, publication date as ordinal or None, isbn or None, keywords)
+        """
+        return (self.uuid, self.title, self.authors, self.publication_date.toordinal() if self.publication_date else None,
+                self.isbn, list(self.keywords))
+
+    @classmethod
+    def from_record(cls, record):
+        """ Create a book from a record (see property record)
+            The record must stem from a valid book, its values are not validated again.
+        """
+        uuid, title, authors, publication_date, isbn, keywords = record
+
+        book = cls.__new__(cls)
+        book._meta = {'__type__': 'mybooks.Book', 'uuid': uuid, 'title': title, 'authors': list(authors)}
+        if publication_date is not None:
+            book._meta['publication_date'] = datetime.date.fromordinal(publication_date)
+        if isbn:
+            book._meta['isbn'] = isbn
+        if keywords:
+            book._meta['keywords'] = set(keywords)
+        book._dirty = False
+        book._keys = None
+        book._isbn13 = None
+
+        return book
         
 
     @property
     def meta(self) -> dict:
         return self._meta
 
+    @property
+    def dirty(self) -> bool:
+        """ True if the metadata has been changed since creation or mark_clean() """
+        return self._dirty
+
+    def mark_clean(self):
+        self._dirty = False
+
     @property
     def uuid(self) -> str:
         return self._meta['uuid']
 
+    def _search_keys(self) -> tuple:
+        # computed once on first use, reset when the metadata changes
+        if self._keys is None:
+            self._keys = (normalize(self.title or ""), [normalize(author) for author in self.authors or []],
+                          [normalize(keyword) for keyword in self.keywords])
+        return self._keys
+
+    @property
+    def title_key(self) -> str:
+        """ Normalized title for case- and accent-insensitive comparisons (see normalize()) """
+        return self._search_keys()[0]
+
+    @property
+    def author_keys(self) -> list:
+        return self._search_keys()[1]
+
+    @property
+    def keyword_keys(self) -> list:
+        return self._search_keys()[2]
+
 
     @property
     def as_json(self):
@@ -276,11 +404,20 @@ class Book:
     def isbn(self):
         return self._meta.get('isbn')
 
+    @property
+    def isbn13(self):
+        """ ISBN in ISBN-13 form (see isbn13()), identical for both forms of an ISBN
+            Computed once on first use.
+        """
+        if self._isbn13 is None and self.isbn:
+            self._isbn13 = isbn13(self.isbn)
+        return self._isbn13
+
     @property
     def isbn_str(self):
         isbn = self._meta.get('isbn')
         if isbn:
-            return isbnlib.mask(isbn)
+            return _mask_isbn(isbn)
         else:
             False
 
@@ -322,17 +459,25 @@ class Book:
 
 
     def add_keyword(self, *args):
-        
-        for keyword in args:
-            if not isinstance(keyword, str):
-                raise ValueError("Keyword must be a string!")
-           
+        if self._add_keywords(args):
+            self._changed(self.isbn)
+
+    def _add_keywords(self, keywords) -> bool:
+        """ Add keywords without reporting the change, returns True if a keyword was added """
+        if not all(isinstance(keyword, str) for keyword in keywords):
+            raise ValueError("Keyword must be a string!")
+
+        added = False
+        for keyword in keywords:
             keyword = keyword.strip()
             if keyword:
                 if not "keywords" in self._meta:
                     self._meta['keywords'] = set()
 
-                self._meta['keywords'].add(keyword)
+                if keyword not in self._meta['keywords']:
+                    self._meta['keywords'].add(keyword)
+                    added = True
+        return added
 
 
  
\ No newline at end of file
@@ -14,17 +14,796 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from book import Book, BookJSONEncoder, BookJSONDecoder
+from book import Book, BookJSONEncoder, BookJSONDecoder, normalize, isbn13
+import profiling
+import metrics
+import time
 import json
-import isbnlib
 import fnmatch
 import datetime
+import hashlib
+import contextlib
+import concurrent.futures
+import threading
+import io
+import os
+import gzip
+import bz2
+import lzma
+import heapq
+import bisect
+import collections
+import collections.abc
+import math
+import re
+import marshal
+import mmap
+import gc
 
+try:
+    import fcntl
+except ImportError: # e.g. on Windows: no file locking
+    fcntl = None
+
+
+class LibraryFileChangedError(ValueError):
+    """ Library file has been modified since it was read """
+
+
+# First line of library files in the JSON Lines format (optional when reading)
+JSONL_FORMAT_VERSION = 1
+JSONL_HEADER = {"__type__": "mybooks.Library", "format": "jsonl", "version": JSONL_FORMAT_VERSION}
+
+
+# Compression of library files: codec -> (file extension, magic bytes, open function)
+CODECS = {
+    "gzip": (".gz", b"\x1f\x8b", lambda f, mode: gzip.GzipFile(fileobj=f, mode=mode, compresslevel=6, mtime=0)),
+    "bz2": (".bz2", b"BZh", lambda f, mode: bz2.BZ2File(f, mode)),
+    "xz": (".xz", b"\xfd7zXZ\x00", lambda f, mode: lzma.LZMAFile(f, mode)),
+}
+
+
+def _detect_codec(f):
+    """ Return the codec of a library file opened for binary reading (None: uncompressed) """
+    head = f.peek(8)
+    for codec, (_, magic, _) in CODECS.items():
+        if head.startswith(magic):
+            return codec
+    return None
+
+
+def _codec_for_filename(filename):
+    for codec, (extension, _, _) in CODECS.items():
+        if filename.endswith(extension):
+            return codec
+    return None
+
+
+def _open_codec(f, codec, mode):
+    """ Open a binary stream (de)compressing the data of binary file f """
+    if codec:
+        return CODECS[codec][2](f, mode)
+    return io.BufferedReader(f) if mode == "rb" else io.BufferedWriter(f)
+
+
+def _detect_format(filename, f) -> str:
+    """ Return the format of a library file opened for binary reading: "json" or "jsonl"
+        A JSON array is a library file, a JSON object in the first line a JSON Lines
+        file. Empty files are distinguished by the file extension.
+    """
+    head = f.peek(64).lstrip()[:1]
+    if head == b"{":
+        return "jsonl"
+    if head == b"[":
+        return "json"
+    return _format_for_filename(filename)
+
+
+def _format_for_filename(filename) -> str:
+    if codec := _codec_for_filename(filename):
+        filename = filename[:-len(CODECS[codec][0])]
+    return "jsonl" if filename.endswith(".jsonl") else "json"
+
+
+def _jsonl_line(obj) -> str:
+    return json.dumps(obj, cls=BookJSONEncoder, separators=(",", ":")) + "\n"
+
+
+def _iter_jsonl(stream, header_allowed=True, batch_size=1 << 16):
+    """ Decode the books of a JSON Lines library file (binary stream)
+        header_allowed: the first line may be a header
+        Lines are read in batches of about batch_size bytes, which are decoded
+        at once as JSON array.
+    """
+    decoder = BookJSONDecoder()
+    line_number = 0
+
+    while lines := stream.readlines(batch_size):
+        first = 0
+        if line_number == 0 and header_allowed and lines[0].lstrip().startswith(b"{"):
+            header = json.loads(lines[0])
+            if header.get("__type__") == JSONL_HEADER["__type__"]:
+                if header.get("version", 0) > JSONL_FORMAT_VERSION:
+                    raise ValueError(f"Unsupported version of library file format: {header.get('version')}")
+                first = 1
+
+        records = [line for line in lines[first:] if line.strip()]
+        try:
+            books = decoder.decode("[" + b",".join(records).decode("utf-8") + "]")
+        except ValueError:
+            books = None
+
+        if books is None or len(books) != len(records) or not all(isinstance(book, Book) for book in books):
+            # locate the invalid line
+            for i, line in enumerate(lines[first:], line_number + first + 1):
+                try:
+                    if line.strip() and not isinstance(decoder.decode(line.decode("utf-8")), Book):
+                        raise ValueError
+                except ValueError:
+                    raise ValueError(f"Invalid book in line {i} of library file!")
+
+        yield from books
+        line_number += len(lines)
+
+
+def _split_lines(data, chunks) -> list:
+    """ Split data into about equally sized chunks at line boundaries """
+    result = []
+    start = 0
+    for i in range(1, chunks + 1):
+        end = len(data) if i == chunks else data.find(b"\n", max(start, len(data) * i // chunks)) + 1
+        if end <= 0:
+            end = len(data)
+        if end > start:
+            result.append(data[start:end])
+        start = end
+    return result
+
+
+def _decode_jsonl_records(chunk, header_allowed):
+    """ Decode a chunk of a JSON Lines library file to book records
+        (executed in worker processes by the parallel loader)
+    """
+    return [book.record for book in _iter_jsonl(io.BytesIO(chunk), header_allowed=header_allowed)]
+
+
+@contextlib.contextmanager
+def locked_file(filename, exclusive=False):
+    """ Open a file for binary reading while holding an advisory lock
+        Shared locks (readers) may be held by several processes simultaneously,
+        exclusive locks (writers) only by a single process.
+    """
+    while True:
+        f = open(filename, 'rb')
+        if not fcntl:
+            break
+
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+        # the file might have been replaced while waiting for the lock
+        if os.path.samestat(os.fstat(f.fileno()), os.stat(filename)):
+            break
+        f.close()
+
+    try:
+        yield f
+    finally:
+        f.close()
+
+
+def _stat_key(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class _HashingFile(io.RawIOBase):
+    """ Binary file wrapper computing the SHA-256 of the data read from or written to f
+        file_hash: hash of data already in the file (when appending)
+    """
+    def __init__(self, f, file_hash=None):
+        self._f = f
+        self.hash = file_hash or hashlib.sha256()
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        self.hash.update(memoryview(b)[:n])
+        self.size += n
+        return n
+
+    def write(self, b):
+        self._f.write(b)
+        self.hash.update(b)
+        self.size += len(b)
+        return len(b)
+
+    def drain(self):
+        """ Read the remaining data, so that the hash covers the complete file """
+        while self.read(1 << 16):
+            pass
+
+
+def _open_text_writer(f, codec):
+    """ Open a UTF-8 text stream writing to binary file f, compressed by codec """
+    return io.TextIOWrapper(_open_codec(f, codec, "wb"), encoding="utf-8", newline="")
+
+
+def tokenize(text) -> list:
+    """ Split text into normalized words (see book.normalize()) """
+    return re.findall(r"\w+", normalize(text))
+
+
+class FullTextIndex:
+    """ Inverted index over titles, authors and keywords of books with BM25 ranking """
+    K1 = 1.2
+    B = 0.75
 
-class BookLibraryJSON:
     def __init__(self) -> None:
-        
+        self._postings = {}  # term -> {UUID: term frequency}
+        self._terms = {}     # UUID -> {term: term frequency} of the indexed books
+        self._lengths = {}   # UUID -> number of terms
+        self._total_length = 0
+
+    @staticmethod
+    def _book_terms(book) -> dict:
+        terms = {}
+        for text in [book.title_key, *book.author_keys, *book.keyword_keys]:
+            for term in re.findall(r"\w+", text):
+                terms[term] = terms.get(term, 0) + 1
+        return terms
+
+    def add(self, book):
+        self.remove(book.uuid)
+        terms = self._book_terms(book)
+        self._terms[book.uuid] = terms
+        self._lengths[book.uuid] = sum(terms.values())
+        self._total_length += self._lengths[book.uuid]
+        for term, frequency in terms.items():
+            self._postings.setdefault(term, {})[book.uuid] = frequency
+
+    def add_all(self, books):
+        for book in books:
+            self.add(book)
+
+    def remove(self, uuid):
+        terms = self._terms.pop(uuid, None)
+        if terms is None:
+            return
+
+        self._total_length -= self._lengths.pop(uuid)
+        for term in terms:
+            postings = self._postings[term]
+            del postings[uuid]
+            if not postings:
+                del self._postings[term]
+
+    def search(self, query, limit=10) -> list:
+        """ Returns list of (score, UUID) of the best matching books, best first """
+        if not self._terms:
+            return []
+
+        count = len(self._terms)
+        average_length = self._total_length / count
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for uuid, frequency in postings.items():
+                norm = self.K1 * (1 - self.B + self.B * self._lengths[uuid] / average_length)
+                scores[uuid] = scores.get(uuid, 0.0) + idf * frequency * (self.K1 + 1) / (frequency + norm)
+
+        return heapq.nlargest(limit, ((score, uuid) for uuid, score in scores.items()))
+
+    def __len__(self):
+        """ Number of distinct terms """
+        return len(self._postings)
+
+    def state(self):
+        """ Contents of the index as marshal-able data (see set_state()) """
+        return (self._postings, self._terms, self._lengths, self._total_length)
+
+    def set_state(self, state, by_uuid):
+        """ Restore the contents returned by state() of an index of the books by_uuid (UUID -> book) """
+        self._postings, self._terms, self._lengths, self._total_length = state
+
+
+class CompletionIndex:
+    """ Sorted array of the distinct normalized values of a field for prefix completion
+        values: function returning the values of a book, e.g. its authors
+    """
+    def __init__(self, values) -> None:
+        self._values = values
+        self._keys = []         # sorted normalized values
+        self._counts = {}       # normalized value -> {value: number of books}
+        self._book_values = {}  # UUID -> values of the indexed book
+
+    def _count(self, book):
+        values = self._values(book)
+        self._book_values[book.uuid] = values
+        new_keys = []
+        for value in values:
+            key = normalize(value)
+            if key not in self._counts:
+                self._counts[key] = {}
+                new_keys.append(key)
+            self._counts[key][value] = self._counts[key].get(value, 0) + 1
+        return new_keys
+
+    def add(self, book):
+        self.remove(book.uuid)
+        for key in self._count(book):
+            bisect.insort(self._keys, key)
+
+    def add_all(self, books):
+        for book in books:
+            self.remove(book.uuid)
+            self._count(book)
+        self._keys = sorted(self._counts)
+
+    def remove(self, uuid):
+        for value in self._book_values.pop(uuid, ()):
+            key = normalize(value)
+            forms = self._counts[key]
+            forms[value] -= 1
+            if not forms[value]:
+                del forms[value]
+            if not forms:
+                del self._counts[key]
+                del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def complete(self, prefix, limit=10) -> list:
+        """ Returns list of (value, number of books) of the values starting with prefix
+            (ignoring case and accents), most frequent first
+            Values that differ only in case or accents are counted together and
+            represented by their most frequent spelling.
+        """
+        key = normalize(prefix)
+        start = bisect.bisect_left(self._keys, key)
+        end = bisect.bisect_left(self._keys, key + "\U0010ffff", start)
+
+        candidates = ((sum(forms.values()), max(forms, key=forms.get)) for forms in (self._counts[k] for k in self._keys[start:end]))
+        return [(value, count) for count, value in heapq.nlargest(limit, candidates, key=lambda c: c[0])]
+
+    def __len__(self):
+        """ Number of distinct normalized values """
+        return len(self._keys)
+
+    def state(self):
+        return (self._keys, self._counts, self._book_values)
+
+    def set_state(self, state, by_uuid):
+        self._keys, self._counts, self._book_values = state
+
+
+# Fields supported by BookLibraryJSON.complete(): name -> values of a book
+COMPLETION_FIELDS = {
+    "authors": lambda book: list(book.authors),
+    "title": lambda book: [book.title],
+}
+
+
+def levenshtein(a, b) -> int:
+    """ Edit distance (insertions, deletions, substitutions) between the strings a and b """
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        previous = current
+    return previous[-1]
+
+
+def author_key(name) -> str:
+    """ Normalized author name for fuzzy matching, "Kepler, Johannes" becomes "johannes kepler" """
+    key = normalize(name)
+    if "," in key:
+        last, first = key.split(",", 1)
+        key = first + " " + last
+    return " ".join(key.split())
+
+
+class FuzzyIndex:
+    """ BK-tree over the distinct author keys for approximate matching by edit distance
+        Only the subtrees whose distance to the node can be within the requested
+        distance of the query are visited, instead of comparing with every name.
+    """
+    def __init__(self) -> None:
+        self._root = None       # [key, {distance: child node}]
+        self._uuids = {}        # author key -> set of UUIDs of the books
+        self._book_keys = {}    # UUID -> author keys of the indexed book
+
+    def _insert(self, key):
+        if self._root is None:
+            self._root = [key, {}]
+            return
+
+        node = self._root
+        while True:
+            distance = levenshtein(key, node[0])
+            if distance in node[1]:
+                node = node[1][distance]
+            else:
+                node[1][distance] = [key, {}]
+                return
+
+    def add(self, book):
+        self.remove(book.uuid)
+        keys = {author_key(author) for author in book.authors}
+        self._book_keys[book.uuid] = keys
+        for key in keys:
+            if key not in self._uuids:
+                # keys are kept in the tree when their last book is removed
+                self._uuids[key] = set()
+                self._insert(key)
+            self._uuids[key].add(book.uuid)
+
+    def add_all(self, books):
+        for book in books:
+            self.add(book)
+
+    def remove(self, uuid):
+        for key in self._book_keys.pop(uuid, ()):
+            self._uuids[key].discard(uuid)
+
+    def match(self, name, distance) -> set:
+        """ Returns set of UUIDs of the books with an author within the given edit distance of name """
+        key = author_key(name)
+        found = set()
+        nodes = [self._root] if self._root is not None else []
+        while nodes:
+            node_key, children = nodes.pop()
+            d = levenshtein(key, node_key)
+            if d <= distance:
+                found |= self._uuids[node_key]
+            nodes.extend(child for child_distance, child in children.items() if d - distance <= child_distance <= d + distance)
+        return found
+
+    def __len__(self):
+        """ Number of distinct author keys (nodes of the tree) """
+        return len(self._uuids)
+
+    def state(self):
+        # the tree is stored as a list of (key, parent, distance) instead of
+        # nested lists, which could exceed the nesting limit of marshal
+        nodes = []
+        pending = [(self._root, -1, 0)] if self._root is not None else []
+        while pending:
+            (key, children), parent, distance = pending.pop()
+            nodes.append((key, parent, distance))
+            pending.extend((child, len(nodes) - 1, d) for d, child in children.items())
+        return (nodes, self._uuids, self._book_keys)
+
+    def set_state(self, state, by_uuid):
+        nodes, self._uuids, self._book_keys = state
+        tree = [[key, {}] for key, _, _ in nodes]
+        for node, (_, parent, distance) in zip(tree, nodes):
+            if parent >= 0:
+                tree[parent][1][distance] = node
+        self._root = tree[0] if tree else None
+
+
+# Byte value -> positions of its set bits
+_BYTE_BITS = [tuple(i for i in range(8) if value >> i & 1) for value in range(256)]
+_NONZERO_BYTE = re.compile(rb"[^\x00]")
+
+
+def bitmap_from_ordinals(ordinals) -> int:
+    """ Bitmap (int) with the bits of the given ordinals set """
+    if not ordinals:
+        return 0
+    data = bytearray(max(ordinals) // 8 + 1)
+    for ordinal in ordinals:
+        data[ordinal >> 3] |= 1 << (ordinal & 7)
+    return int.from_bytes(data, "little")
+
+
+def ordinals_from_bitmap(bits):
+    """ Generates the positions of the set bits of bits in ascending order """
+    data = bits.to_bytes((bits.bit_length() + 7) // 8, "little")
+    for match in _NONZERO_BYTE.finditer(data):
+        base = match.start() * 8
+        for bit in _BYTE_BITS[data[match.start()]]:
+            yield base + bit
+
+
+class BitmapIndex:
+    """ Posting lists of the keywords and authors over dense book ordinals
+        A posting is a set of ordinals while it is sparse and a bitmap (int with
+        bit i set for the book with ordinal i) once it contains at least
+        DENSE_MIN books and 1/DENSE_FRACTION of the library. Queries combine
+        postings as bitmaps, i.e. AND/OR of many keywords are operations on ints.
+    """
+    FIELDS = ("keywords", "authors")
+    DENSE_MIN = 64
+    DENSE_FRACTION = 256
+
+    def __init__(self) -> None:
+        self._books = []        # ordinal -> book, None if free
+        self._free = []         # ordinals of removed books
+        self._entries = {}      # UUID -> (ordinal, {field: values})
+        self._postings = {field: {} for field in self.FIELDS} # field -> value -> set of ordinals or bitmap
+
+    def _is_dense(self, posting):
+        return len(posting) >= self.DENSE_MIN and len(posting) * self.DENSE_FRACTION >= len(self._books)
+
+    def _insert(self, book):
+        ordinal = self._free.pop() if self._free else len(self._books)
+        if ordinal == len(self._books):
+            self._books.append(book)
+        else:
+            self._books[ordinal] = book
+
+        values = {"keywords": set(book.keywords), "authors": set(book.authors)}
+        self._entries[book.uuid] = (ordinal, values)
+        return ordinal, values
+
+    def add(self, book):
+        self.remove(book.uuid)
+        ordinal, values = self._insert(book)
+        for field, field_values in values.items():
+            postings = self._postings[field]
+            for value in field_values:
+                posting = postings.setdefault(value, set())
+                if isinstance(posting, int):
+                    postings[value] = posting | (1 << ordinal)
+                else:
+                    posting.add(ordinal)
+                    if self._is_dense(posting):
+                        postings[value] = bitmap_from_ordinals(posting)
+
+    def add_all(self, books):
+        # postings are collected as sets and converted to bitmaps once at the end
+        for book in books:
+            self.remove(book.uuid)
+            ordinal, values = self._insert(book)
+            for field, field_values in values.items():
+                postings = self._postings[field]
+                for value in field_values:
+                    posting = postings.setdefault(value, set())
+                    if isinstance(posting, int):
+                        postings[value] = posting | (1 << ordinal)
+                    else:
+                        posting.add(ordinal)
+
+        for postings in self._postings.values():
+            for value, posting in postings.items():
+                if not isinstance(posting, int) and self._is_dense(posting):
+                    postings[value] = bitmap_from_ordinals(posting)
+
+    def remove(self, uuid):
+        entry = self._entries.pop(uuid, None)
+        if entry is None:
+            return
+
+        ordinal, values = entry
+        for field, field_values in values.items():
+            postings = self._postings[field]
+            for value in field_values:
+                posting = postings[value]
+                if isinstance(posting, int):
+                    posting &= ~(1 << ordinal)
+                    postings[value] = posting
+                else:
+                    posting.discard(ordinal)
+                if not posting:
+                    del postings[value]
+
+        self._books[ordinal] = None
+        self._free.append(ordinal)
+
+    def match(self, field, patterns, match_all=False) -> int:
+        """ Bitmap of the books with a value of field matching any (match_all: each)
+            of the fnmatch patterns
+        """
+        postings = self._postings[field]
+        result = None
+        for pattern in patterns:
+            if any(c in pattern for c in "*?["):
+                values = fnmatch.filter(postings, pattern)
+            else:
+                values = [pattern] if pattern in postings else []
+
+            # sparse postings are merged before they are converted to a bitmap
+            bits = 0
+            ordinals = set()
+            for value in values:
+                posting = postings[value]
+                if isinstance(posting, int):
+                    bits |= posting
+                else:
+                    ordinals |= posting
+            bits |= bitmap_from_ordinals(ordinals)
+
+            if result is None:
+                result = bits
+            elif match_all:
+                result &= bits
+            else:
+                result |= bits
+
+        return result or 0
+
+    def books(self, bits) -> list:
+        """ Books of the bitmap bits """
+        return [self._books[ordinal] for ordinal in ordinals_from_bitmap(bits)]
+
+    def __len__(self):
+        """ Number of posting lists """
+        return sum(len(postings) for postings in self._postings.values())
+
+    def state(self):
+        uuids = [book.uuid if book is not None else None for book in self._books]
+        return (uuids, self._free, self._entries, self._postings)
+
+    def set_state(self, state, by_uuid):
+        uuids, self._free, self._entries, self._postings = state
+        self._books = [by_uuid[uuid] if uuid is not None else None for uuid in uuids]
+
+
+class FindCache:
+    """ LRU cache of find() results
+        An entry is only valid for the generation of the library it was stored
+        in, the library increments its generation on every change.
+    """
+    def __init__(self, maxsize) -> None:
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict() # key -> (generation, tuple of books)
+        self._lock = threading.Lock() # readers of ThreadSafeBookLibraryJSON share the cache
+
+    @staticmethod
+    def key(kwargs) -> tuple:
+        """ Normalized find() arguments: unset arguments are dropped, order of lists (or other iterables) ignored """
+        key = []
+        for arg, value in sorted(kwargs.items()):
+            if isinstance(value, collections.abc.Iterable) and not isinstance(value, str):
+                value = tuple(sorted(set(value)))
+            if value is None or value is False or value in ("", ()):
+                continue
+            if arg == "isbn":
+                value = isbn13(value)
+            key.append((arg, value))
+        return tuple(key)
+
+    def get(self, key, generation):
+        """ Cached results (list of books) of key or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                metrics.inc("mybooks_find_cache_total", result="hit")
+                return list(entry[1])
+
+            self.misses += 1
+            metrics.inc("mybooks_find_cache_total", result="miss")
+            return None
+
+    def put(self, key, generation, results):
+        with self._lock:
+            self._entries[key] = (generation, tuple(results))
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "maxsize": self.maxsize}
+
+
+# Sidecar file of a library file storing its lazily built indexes: the first
+# line is a JSON header, followed by the marshalled state() of each index
+INDEX_FILE_SUFFIX = ".idx"
+INDEX_FILE_VERSION = 1
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    """ Disable the cyclic garbage collector, e.g. while creating many containers
+        that are kept anyway (the collector would scan them again and again)
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def _read_index_file(filename, stamp) -> dict:
+    """ Return name -> marshalled state (memoryview of the mapped file) of the indexes
+        stored in the index file filename, {} if it is missing, invalid or its
+        stamp (see BookLibraryJSON._index_file_stamp()) differs
+    """
+    try:
+        with open(filename, "rb") as f:
+            header = json.loads(f.readline(1 << 20))
+            if header.get("version") != INDEX_FILE_VERSION or header.get("stamp") != stamp:
+                return {}
+            start = f.tell()
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+        return {name: data[start + offset:start + offset + length]
+                for name, (offset, length) in header["indexes"].items() if start + offset + length <= len(data)}
+    except (OSError, ValueError, TypeError, KeyError, AttributeError):
+        return {}
+
+
+def _write_index_file(filename, stamp, indexes):
+    """ Write the index file filename with the marshalled states of indexes (name -> bytes) """
+    header = {"version": INDEX_FILE_VERSION, "stamp": stamp, "indexes": {}}
+    offset = 0
+    for name, data in indexes.items():
+        header["indexes"][name] = [offset, len(data)]
+        offset += len(data)
+
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_filename, "wb") as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+            for data in indexes.values():
+                f.write(data)
+        os.replace(tmp_filename, filename)
+    finally:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+
+class BookLibraryJSON:
+    # JSON Lines files of at least this size are decoded in parallel (if workers > 1)
+    PARALLEL_LOAD_MIN_BYTES = 1 << 20
+
+    # lazy indexes of libraries with at least this number of books are persisted (if persist_indexes)
+    INDEX_FILE_MIN_BOOKS = 10000
+
+    def __init__(self, workers=None, cache_size=0, persist_indexes=False) -> None:
+        """ workers: number of processes used for decoding large JSON Lines files
+                (default: decode in this process)
+            cache_size: number of find() results kept in a cache (default: no cache)
+            persist_indexes: store the lazily built indexes of large libraries in an
+                index file next to the library file (INDEX_FILE_SUFFIX), so that they
+                are loaded instead of rebuilt as long as the library file is unchanged
+        """
         self._books= set() # empty set
+        self._workers = workers
+        self._persist_indexes = persist_indexes
+
+        # incremented on every change of the books, invalidates cached find() results
+        self._generation = 0
+        self._find_cache = FindCache(cache_size) if cache_size else None
+
+        # indexes: UUID -> book, ISBN-13 -> list of books
+        self._by_uuid = {}
+        self._by_isbn = {}
+        self._lazy_indexes = {} # name -> index built on first use (FullTextIndex, CompletionIndex)
+        self._stored_indexes = {} # name -> marshalled state of the index file of the library file
+        self._file_generation = None # generation when the books were last read or written
+
+        # library file the books have been read from or written to last
+        self._filename = None
+        self._format = None  # "json" or "jsonl"
+        self._codec = None   # compression, see CODECS
+        self._etag = None
+        self._hash = None    # SHA-256 object of the file contents (for appending)
+        self._stat = None
+
+        # UUIDs of books added/changed and removed since the library file was read or written
+        self._changed = set()
+        self._removed = set()
+        self._added = {}     # UUID -> book added since then
 
     def add(self, book) -> bool:
         """ Adds book to libary
@@ -39,11 +818,12 @@ class BookLibraryJSON:
         if book in self._books:
             return False
 
-        # Don't add if isbn already in library
-        if book.isbn and len(self.find( isbn=book.isbn ))>0:
+        # Don't add if isbn already in library (in either ISBN-10 or ISBN-13 form)
+        if book.isbn and book.isbn13 in self._by_isbn:
             return False
         
         self._books.add(book)
+        self._book_added(book)
 
         return True
 
@@ -51,25 +831,125 @@ class BookLibraryJSON:
     def find(self, **kwargs) -> list:
         """ Find books based on their meta data
             Returns all books if no argument is given 
+            insensitive=True: title, authors and keywords are matched ignoring
+                case and accents
+            fuzzy=N: authors are names (no patterns) matched within an edit
+                distance of N, ignoring case, accents and "Last, First" order
         """
+        self._check_find_args(kwargs)
+
+        start = time.perf_counter()
+        with profiling.phase("query") as p:
+            if self._find_cache is None:
+                results = self._find(**kwargs)
+            else:
+                key = FindCache.key(kwargs)
+                generation = self._generation
+                results = self._find_cache.get(key, generation)
+                if results is None:
+                    results = self._find(**kwargs)
+                    self._find_cache.put(key, generation, results)
+            p.add_count(len(results))
+
+        if metrics.enabled():
+            filters = "+".join(sorted(arg for arg in kwargs if kwargs[arg])) or "none"
+            metrics.observe("mybooks_find_seconds", time.perf_counter() - start, filters=filters)
+
+        return results
+
+
+    def count(self, **kwargs) -> int:
+        """ Number of books find(**kwargs) returns
+            Queries for keywords and authors (without other filters) are counted
+            on the bitmaps of the postings without creating lists of books.
+        """
+        self._check_find_args(kwargs)
+
+        with profiling.phase("query"):
+            if kwargs.get("fuzzy") is None and not any(kwargs.get(arg) for arg in ["uuid", "title", "isbn", "published_after", "published_before", "insensitive"]):
+                if kwargs.get("keywords") or kwargs.get("authors"):
+                    return self._match_bitmaps(**kwargs).bit_count()
+                return len(self._books)
+
+            return len(self._find(**kwargs))
+
+
+    def cache_stats(self) -> dict:
+        """ Hits, misses, size and maxsize of the find() cache (None if the cache is disabled) """
+        return self._find_cache.stats() if self._find_cache is not None else None
 
-        if not all( arg in ["uuid", "title", "isbn", "authors", "keywords", "match_all", "published_after", "published_before"] for arg in kwargs):
+
+    def _check_find_args(self, kwargs):
+        if not all( arg in ["uuid", "title", "isbn", "authors", "keywords", "match_all", "published_after", "published_before", "insensitive", "fuzzy"] for arg in kwargs):
             raise ValueError("Unsupported argument for find()!")
 
+        fuzzy = kwargs.get("fuzzy")
+        if fuzzy is not None and (not isinstance(fuzzy, int) or isinstance(fuzzy, bool) or fuzzy < 0):
+            raise ValueError("Fuzzy distance must be an int >= 0!")
+
+
+    def _find_lazy_indexes(self, kwargs) -> list:
+        """ Names of the lazy indexes used by find(**kwargs) """
+        names = []
+        if not kwargs.get('insensitive') and (kwargs.get('keywords') or (kwargs.get('authors') and kwargs.get('fuzzy') is None)):
+            names.append("bitmap")
+        if kwargs.get('fuzzy') is not None and kwargs.get('authors'):
+            names.append("fuzzy-authors")
+        return names
+
+
+    def _match_bitmaps(self, **kwargs) -> int:
+        """ Bitmap of the books matching the keywords and (unless fuzzy) the authors of a query """
+        index = self._lazy_index("bitmap", BitmapIndex)
+        match_all = bool(kwargs.get('match_all'))
+        fields = ["keywords"] if kwargs.get('fuzzy') is not None else ["keywords", "authors"]
+        bitmaps = [index.match(field, kwargs[field], match_all) for field in fields if kwargs.get(field)]
+
+        bits = bitmaps[0]
+        for other in bitmaps[1:]:
+            bits &= other
+        return bits
+
+
+    def _find(self, **kwargs) -> list:
         results = self._books
 
+        # candidates from the indexes, the filters below are still applied
+        if kwargs.get('uuid') and not any(c in kwargs['uuid'] for c in "*?["):
+            book = self._by_uuid.get(kwargs['uuid'])
+            results = [book] if book else []
+
+        elif kwargs.get('isbn'):
+            results = self._by_isbn.get(isbn13(kwargs['isbn']), [])
+
+        elif "bitmap" in self._find_lazy_indexes(kwargs):
+            bits = self._match_bitmaps(**kwargs)
+            results = self._lazy_indexes["bitmap"].books(bits)
+            kwargs = dict(kwargs, keywords=None, authors=kwargs.get('authors') if kwargs.get('fuzzy') is not None else None)
 
         if kwargs.get('uuid'):
             results = filter(lambda b: fnmatch.fnmatch(b.uuid, kwargs["uuid"]), results)
 
 
-        if kwargs.get('title'):
-            results = filter(lambda b: fnmatch.fnmatch(b.title, kwargs["title"]), results)
+        if kwargs.get('isbn'):
+            isbn = isbn13(kwargs["isbn"])
+            results = filter(lambda b: b.isbn13 == isbn, results)
 
 
-        if kwargs.get('isbn'):
-            isbn = isbnlib.canonical(kwargs["isbn"])
-            results = filter(lambda b: b.isbn == isbn, results)
+        if kwargs.get('fuzzy') is not None and kwargs.get('authors'):
+            index = self._lazy_index("fuzzy-authors", FuzzyIndex)
+            matches = [index.match(author, kwargs['fuzzy']) for author in kwargs['authors']]
+            any_or_all = all if kwargs.get('match_all') else any
+            results = filter(lambda b: any_or_all(b.uuid in uuids for uuids in matches), results)
+            kwargs = dict(kwargs, authors=None)
+
+
+        if kwargs.get('insensitive'):
+            return self._find_insensitive(results, **kwargs)
+
+
+        if kwargs.get('title'):
+            results = filter(lambda b: fnmatch.fnmatch(b.title, kwargs["title"]), results)
 
 
         if kwargs.get('authors'):
@@ -86,6 +966,32 @@ class BookLibraryJSON:
                 results = filter(lambda b: any(fnmatch.filter(b.keywords, keyword) for keyword in kwargs["keywords"]) , results)
 
 
+        return self._find_published(results, **kwargs)
+
+
+    def _find_insensitive(self, results, **kwargs) -> list:
+        """ Like _find(), but matches normalized patterns against the normalized keys of the books """
+        def matcher(pattern):
+            return re.compile(fnmatch.translate(normalize(pattern))).match
+
+        if kwargs.get('title'):
+            match = matcher(kwargs['title'])
+            results = filter(lambda b: match(b.title_key), results)
+
+        any_or_all = all if kwargs.get('match_all') else any
+
+        if kwargs.get('authors'):
+            matches = [matcher(author) for author in kwargs['authors']]
+            results = filter(lambda b: any_or_all(any(map(match, b.author_keys)) for match in matches), results)
+
+        if kwargs.get('keywords'):
+            matches = [matcher(keyword) for keyword in kwargs['keywords']]
+            results = filter(lambda b: any_or_all(any(map(match, b.keyword_keys)) for match in matches), results)
+
+        return self._find_published(results, **kwargs)
+
+
+    def _find_published(self, results, **kwargs) -> list:
         if kwargs.get('published_after'):
             adate = datetime.date.fromisoformat(kwargs['published_after'])
             results = filter(lambda b: (b.publication_date and (b.publication_date > adate)), results)
@@ -98,6 +1004,117 @@ class BookLibraryJSON:
 
         return list(results)
 
+    def isbn_collisions(self) -> list:
+        """ Find books sharing an ISBN, e.g. stored in ISBN-10 and ISBN-13 form
+            before add() detected this
+            Returns list of lists of books with the same ISBN-13
+        """
+        return [list(books) for books in self._by_isbn.values() if len(books) > 1]
+
+    def search(self, query: str, limit=10) -> list:
+        """ Full-text search for words in titles, authors and keywords
+            Returns the limit best matching books ranked by relevance (BM25)
+        """
+        if not isinstance(query, str):
+            raise ValueError("Search query must be a str!")
+
+        if limit < 0:
+            raise ValueError("Limit must not be negative!")
+
+        with profiling.phase("query") as p:
+            index = self._lazy_index("text", FullTextIndex)
+            results = [self._by_uuid[uuid] for _, uuid in index.search(query, limit)]
+            p.add_count(len(results))
+
+        return results
+
+
+    def complete(self, prefix: str, field="authors", limit=10) -> list:
+        """ Complete a prefix of author names or titles (field "authors" or "title")
+            Returns list of (value, number of books) of the limit most frequent
+            values starting with prefix, ignoring case and accents
+        """
+        if not isinstance(prefix, str):
+            raise ValueError("Prefix must be a str!")
+
+        if field not in COMPLETION_FIELDS:
+            raise ValueError(f"Unsupported field for completion: {field}")
+
+        if limit < 0:
+            raise ValueError("Limit must not be negative!")
+
+        with profiling.phase("query") as p:
+            results = self._lazy_index(f"complete-{field}", lambda: CompletionIndex(COMPLETION_FIELDS[field])).complete(prefix, limit)
+            p.add_count(len(results))
+
+        return results
+
+
+    def _lazy_index(self, name, factory):
+        """ Return index name, build it by factory() if necessary
+            The index is kept up to date by the hooks afterwards.
+        """
+        if name not in self._lazy_indexes:
+            index = self._stored_index(name, factory)
+            if index is not None:
+                self._lazy_indexes[name] = index
+            else:
+                index = self._lazy_indexes[name] = factory()
+                index.add_all(self._books)
+                self._store_indexes()
+            self._set_gauges()
+        return self._lazy_indexes[name]
+
+
+    def _index_file_stamp(self):
+        """ Identifies the library file the books have been read from or written to,
+            None if the books differ from it or their indexes are not persisted
+        """
+        if not (self._persist_indexes and self._filename and self._generation == self._file_generation
+                and len(self._books) >= self.INDEX_FILE_MIN_BOOKS):
+            return None
+        return {"size": self._stat[1], "mtime_ns": self._stat[2], "sha256": self._etag}
+
+
+    def _stored_index(self, name, factory):
+        """ Return index name restored from the index file, None if not available """
+        if name not in self._stored_indexes or self._index_file_stamp() is None:
+            return None
+
+        with profiling.phase("load index") as p:
+            try:
+                index = factory()
+                with _gc_paused():
+                    index.set_state(marshal.loads(self._stored_indexes[name]), self._by_uuid)
+            except (ValueError, EOFError, TypeError, KeyError, IndexError):
+                # damaged, rebuild it
+                del self._stored_indexes[name]
+                return None
+            p.add_count(len(self._stored_indexes[name]))
+        metrics.inc("mybooks_index_file_total", result="hit")
+        return index
+
+
+    def _store_indexes(self):
+        """ Write all lazy indexes to the index file of the library file """
+        stamp = self._index_file_stamp()
+        if stamp is None:
+            return
+
+        metrics.inc("mybooks_index_file_total", result="rebuild")
+        with profiling.phase("save index") as p:
+            indexes = dict(self._stored_indexes)
+            for name, index in self._lazy_indexes.items():
+                if name not in indexes:
+                    indexes[name] = marshal.dumps(index.state())
+            try:
+                _write_index_file(self._filename + INDEX_FILE_SUFFIX, stamp, indexes)
+            except OSError:
+                return # e.g. read-only directory, the indexes are rebuilt next time
+            p.add_count(sum(len(data) for data in indexes.values()))
+        self._stored_indexes = indexes
+
+
     def update(self, uuid: str, **kwargs) -> int:
         """ Change meta data of a book identified by its UUID in the library
             Note: The UUID of a book cannot be changed.
@@ -121,6 +1138,7 @@ class BookLibraryJSON:
         if not isinstance( res[0], Book):
             raise ValueError(f"BookLibraryJSON.update(): Illegal object found in library!")
 
+        # the book reports the changes to _book_changed() itself
         return res[0].update(**kwargs)
 
 
@@ -147,19 +1165,320 @@ class BookLibraryJSON:
 
 
         self._books.remove(res[0])
+        self._book_removed(res[0])
         
         return True
 
 
+    def _book_added(self, book):
+        self._generation += 1
+        self._index(book)
+        self._changed.add(book.uuid)
+        self._added[book.uuid] = book
+        self._set_gauges()
 
-    def read_from_json_file(self, filename):
-        f = open(filename, 'rt',encoding="utf-8")
-        self._books = set(json.load(f, cls=BookJSONDecoder))
-        
+    def _book_changed(self, book, old_isbn):
+        self._generation += 1
+        if book.isbn != old_isbn:
+            self._unindex(book, old_isbn)
+            self._index(book)
+        else:
+            for index in self._lazy_indexes.values():
+                index.add(book)
+        self._changed.add(book.uuid)
+        self._set_gauges()
+
+    def _book_removed(self, book):
+        self._generation += 1
+        self._unindex(book, book.isbn)
+        self._changed.discard(book.uuid)
+        self._added.pop(book.uuid, None)
+        self._removed.add(book.uuid)
+        self._set_gauges()
+
+
+
+    def _set_gauges(self):
+        """ Record the number of books and the number of entries of each index """
+        if not metrics.enabled():
+            return
+        metrics.set_gauge("mybooks_books", len(self._books))
+        metrics.set_gauge("mybooks_index_entries", len(self._by_uuid), index="uuid")
+        metrics.set_gauge("mybooks_index_entries", len(self._by_isbn), index="isbn")
+        for name, index in self._lazy_indexes.items():
+            metrics.set_gauge("mybooks_index_entries", len(index), index=name)
+
+    def _on_book_change(self, book, old_isbn):
+        # ignore books that have been removed or replaced by reading the file again
+        if self._by_uuid.get(book.uuid) is book:
+            self._book_changed(book, old_isbn)
+
+    def _index(self, book):
+        book._on_change = self._on_book_change
+        self._by_uuid[book.uuid] = book
+        if book.isbn:
+            self._by_isbn.setdefault(book.isbn13, []).append(book)
+        for index in self._lazy_indexes.values():
+            index.add(book)
+
+    def _unindex(self, book, isbn):
+        self._by_uuid.pop(book.uuid, None)
+        for index in self._lazy_indexes.values():
+            index.remove(book.uuid)
+        isbn = isbn13(isbn) if isbn else None
+        if isbn in self._by_isbn:
+            books = [b for b in self._by_isbn[isbn] if b is not book]
+            if books:
+                self._by_isbn[isbn] = books
+            else:
+                del self._by_isbn[isbn]
+
+    def _add_loaded(self, books):
+        """ Add books read from a file (not tracked as changes) """
+        self._generation += 1
+        self._books.update(books)
+        for book in books:
+            self._index(book)
+
+
+    def read_from_json_file(self, filename, uuids=None):
+        """ Restore the library from a library file (JSON or JSON Lines format,
+            optionally compressed by one of the CODECS)
+            The file is read while holding a shared lock, i.e. concurrent writers
+            of other processes using this class have to wait.
+            uuids: UUIDs of the books that are going to be accessed. Libraries
+                that support partial loading may restrict loading to these books.
+                This class always loads all books.
+        """
+        with locked_file(filename) as f:
+            self._read(f, filename)
+
+
+    def write_to_json_file(self, filename, replay=None):
+        """ Save the library to a library file
+            If the library has been read from the same file and the file has been
+            changed by someone else in the meantime, the file is not overwritten:
+            - if replay is None, LibraryFileChangedError is raised
+            - otherwise the library is reloaded from the file and replay(self) is
+              called to repeat the modifications on the fresh state before saving.
+            The file is replaced atomically while holding an exclusive lock.
+            If books have only been added to a library read from a JSON Lines file,
+            they are appended to the file instead.
+            New files are written in the JSON Lines format if filename ends with
+            ".jsonl", otherwise in the JSON format. They are compressed if filename
+            ends with the extension of one of the CODECS (e.g. "library.jsonl.gz").
+            Returns False if the file has not been written, because the library
+            has not been changed since it was read from or written to that file.
+        """
+        if self._filename == os.path.abspath(filename) and not self.is_dirty:
+            return False
+
+        if not os.path.isfile(filename):
+            self._write(filename)
+            return True
+
+        with locked_file(filename, exclusive=True) as f:
+            if self._filename == os.path.abspath(filename) and self._file_changed(f):
+                if replay is None:
+                    raise LibraryFileChangedError(f"Library file {filename} has been changed by another process!")
+
+                self._read(f, filename)
+                replay(self)
+
+            if self._filename == os.path.abspath(filename) and self._appendable():
+                self._append(f, filename)
+                return True
+
+            if fcntl:
+                self._write(filename)
+                return True
+
+        # without file locking (Windows) the file must not be open while it is replaced
+        self._write(filename)
+        return True
+
+
+    def _read(self, f, filename):
+        stat = _stat_key(os.fstat(f.fileno()))
+        codec = _detect_codec(f)
+
+        # the etag is the hash of the (compressed) file contents
+        raw = _HashingFile(f)
+        stream = _open_codec(raw, codec, "rb")
+        file_format = _detect_format(filename, stream)
+
+        if not (file_format == "jsonl" and self._workers and self._workers > 1 and stat[1] >= self.PARALLEL_LOAD_MIN_BYTES):
+            # decode book by book while reading
+            with profiling.phase("decode") as p:
+                books = set(_iter_jsonl(stream) if file_format == "jsonl" else _iter_json_array(stream))
+                p.add_count(len(books))
+
+        else:
+            # the workers get chunks of the complete (decompressed) file
+            with profiling.phase("load") as p:
+                data = stream.read()
+                p.add_count(len(data))
+
+            with profiling.phase("decode") as p:
+                books = self._decode_jsonl_parallel(data)
+                p.add_count(len(books))
 
-    def write_to_json_file(self, filename):
-        f = open(filename, 'wt',encoding="utf-8")
-        json.dump(self._books, f, cls=BookJSONEncoder, indent=4)
+        raw.drain()
+        self._set_loaded(books, filename, raw.hash.hexdigest(), stat, file_format, raw.hash, codec)
+
+
+    def _decode_jsonl_parallel(self, data) -> set:
+        """ Decode a JSON Lines file by splitting it into chunks decoded by worker processes """
+        chunks = _split_lines(data, self._workers)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self._workers) as executor:
+            results = executor.map(_decode_jsonl_records, chunks, [True] + [False] * (len(chunks) - 1))
+            return {Book.from_record(record) for records in results for record in records}
+
+
+    def _set_loaded(self, books, filename, etag, stat, file_format="json", file_hash=None, codec=None):
+        """ Replace the books by books read from filename """
+        self._generation += 1
+        self._books = set()
+        self._by_uuid = {}
+        self._by_isbn = {}
+        self._lazy_indexes = {}
+        self._add_loaded(books)
+        self._set_gauges()
+
+        self._changed.clear()
+        self._removed.clear()
+        self._added.clear()
+        self._filename = os.path.abspath(filename)
+        self._format = file_format
+        self._codec = codec
+        self._etag = etag
+        self._hash = file_hash
+        self._stat = stat
+
+        self._file_generation = self._generation
+        self._stored_indexes = {}
+        if stamp := self._index_file_stamp():
+            self._stored_indexes = _read_index_file(self._filename + INDEX_FILE_SUFFIX, stamp)
+
+
+    def _write(self, filename):
+        # write to a temporary file first and replace the library file afterwards,
+        # so that readers never see a partially written file
+        if self._filename == os.path.abspath(filename) and self._format:
+            file_format, codec = self._format, self._codec
+        else:
+            file_format, codec = _format_for_filename(filename), _codec_for_filename(filename)
+
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with profiling.phase("save") as p, metrics.timer("mybooks_save_seconds"), open(tmp_filename, 'wb') as f:
+                raw = _HashingFile(f)
+                with _open_text_writer(raw, codec) as out:
+                    if file_format == "jsonl":
+                        out.write(_jsonl_line(JSONL_HEADER))
+                        for book in self._books:
+                            out.write(_jsonl_line(book))
+                    else:
+                        json.dump(self._books, out, cls=BookJSONEncoder, indent=4)
+                p.add_count(len(self._books))
+            os.replace(tmp_filename, filename)
+        finally:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+        self._set_written(filename, raw, file_format, codec)
+
+
+    def _appendable(self) -> bool:
+        """ True if the changes can be saved by appending the added books to the file """
+        return (self._format == "jsonl" and self._hash is not None and not self._removed
+                and self._changed.issubset(self._added)
+                and not any(book.dirty for book in self._books if book.uuid not in self._added))
+
+
+    def _append(self, f, filename):
+        """ Append the added books to the JSON Lines file f (opened with an exclusive lock) """
+        if self._codec:
+            # compressed data is appended as an additional stream, the end of
+            # the last line cannot be checked (empty lines are ignored)
+            missing_newline = True
+        elif os.fstat(f.fileno()).st_size:
+            f.seek(-1, os.SEEK_END)
+            missing_newline = f.read(1) != b"\n"
+        else:
+            missing_newline = False
+
+        with profiling.phase("save") as p, metrics.timer("mybooks_save_seconds"), open(filename, 'ab') as f_out:
+            raw = _HashingFile(f_out, self._hash.copy())
+            with _open_text_writer(raw, self._codec) as out:
+                if missing_newline:
+                    out.write("\n")
+                for book in self._added.values():
+                    out.write(_jsonl_line(book))
+            p.add_count(len(self._added))
+
+        self._set_written(filename, raw, "jsonl", self._codec)
+
+
+    def _set_written(self, filename, raw, file_format, codec):
+        self._mark_clean()
+        self._filename = os.path.abspath(filename)
+        self._format = file_format
+        self._codec = codec
+        self._etag = raw.hash.hexdigest()
+        self._hash = raw.hash
+        metrics.inc("mybooks_save_bytes_total", raw.size)
+        self._stat = _stat_key(os.stat(filename))
+
+        # the index file is rewritten when the next index is built
+        self._file_generation = self._generation
+        self._stored_indexes = {}
+
+
+    def _file_changed(self, f) -> bool:
+        # cheap check first: unchanged inode, size and modification time
+        if _stat_key(os.fstat(f.fileno())) == self._stat:
+            return False
+
+        f.seek(0)
+        file_hash = hashlib.sha256()
+        while chunk := f.read(1 << 16):
+            file_hash.update(chunk)
+        f.seek(0)
+        return file_hash.hexdigest() != self._etag
+
+
+    def _mark_clean(self):
+        for book in self._books:
+            book.mark_clean()
+        self._changed.clear()
+        self._removed.clear()
+        self._added.clear()
+
+
+    @property
+    def is_dirty(self) -> bool:
+        """ True if books have been added, changed or removed since the
+            library file was read or written
+        """
+        return bool(self._changed or self._removed) or any(book.dirty for book in self._books)
+
+
+    def changed_books(self) -> list:
+        """ Books that have been added or changed since the library file was read or written """
+        return [book for book in self._books if book.uuid in self._changed or book.dirty]
+
+
+    @property
+    def removed_uuids(self) -> set:
+        """ UUIDs of books removed since the library file was read or written """
+        return set(self._removed)
+
+
+    @property
+    def etag(self):
+        """ Content hash of the library file when it was last read or written """
+        return self._etag
 
 
     def __iter__(self):
@@ -172,3 +1491,466 @@ class BookLibraryJSON:
     @property
     def books(self):
         return self._books
+
+
+
+def library_for_file(filename, workers=None, persist_indexes=False) -> BookLibraryJSON:
+    """ Return an empty library of the class that handles the library stored at filename
+        Directories are sharded libraries, everything else library files.
+        workers: number of processes for loading (if supported by the library class)
+        persist_indexes: see BookLibraryJSON (not supported by sharded libraries)
+    """
+    if os.path.isdir(filename):
+        return ShardedBookLibraryJSON(workers=workers)
+    return BookLibraryJSON(workers=workers, persist_indexes=persist_indexes)
+
+
+def iter_books(filename):
+    """ Iterate over the books stored at filename (library file or directory)
+        The books are decoded one after another while reading, i.e. the file
+        is never completely held in memory.
+    """
+    if os.path.isdir(filename):
+        for name in sorted(os.listdir(filename)):
+            if name.startswith("shard-") and name.endswith(".json"):
+                yield from iter_books(os.path.join(filename, name))
+        return
+
+    with locked_file(filename) as f:
+        stream = _open_codec(f, _detect_codec(f), "rb")
+        if _detect_format(filename, stream) == "jsonl":
+            yield from _iter_jsonl(stream)
+        else:
+            yield from _iter_json_array(stream)
+
+
+_JSON_WHITESPACE = re.compile(r"[ \t\r\n]*")
+
+
+def _iter_json_array(stream, chunk_size=1 << 16):
+    """ Decode the books of a library file in JSON format (array of books) incrementally """
+    decoder = BookJSONDecoder()
+    text = io.TextIOWrapper(stream, encoding="utf-8")
+    buffer = ""
+    pos = 0
+    eof = False
+    expected = "["  # "[", "book or ]", "book", ", or ]"
+
+    while True:
+        pos = _JSON_WHITESPACE.match(buffer, pos).end()
+
+        if pos == len(buffer) or expected == "book":
+            if expected == "book":
+                try:
+                    book, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    # incomplete book at the end of the buffer
+                    if eof:
+                        raise
+                else:
+                    if not isinstance(book, Book):
+                        raise ValueError("Invalid book in library file!")
+                    yield book
+                    expected = ", or ]"
+                    continue
+
+            if eof:
+                raise ValueError("Unexpected end of library file!")
+
+            chunk = text.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+
+        c = buffer[pos]
+        if expected == "[" and c == "[":
+            expected = "book or ]"
+        elif expected in ("book or ]", ", or ]") and c == "]":
+            return
+        elif expected == "book or ]":
+            expected = "book"
+            continue
+        elif expected == ", or ]" and c == ",":
+            expected = "book"
+        else:
+            raise ValueError(f"Invalid library file: expected {expected}, found {c!r}!")
+        pos += 1
+
+
+def _read_records(filename):
+    """ Read a library file and return the records of its books, etag and stat
+        (executed in worker processes by the parallel loader)
+    """
+    with locked_file(filename) as f:
+        data = f.read()
+        stat = _stat_key(os.fstat(f.fileno()))
+
+    records = [book.record for book in json.loads(data.decode("utf-8"), cls=BookJSONDecoder)]
+    return records, hashlib.sha256(data).hexdigest(), stat
+
+
+
+class ReadWriteLock:
+    """ Lock that allows either many concurrent readers or a single writer
+        Waiting writers are preferred over new readers, so writers do not starve.
+        The thread holding the write lock may acquire the read and write lock again.
+    """
+    def __init__(self) -> None:
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writer_depth += 1
+                return
+
+            while self._writer is not None or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writer_depth -= 1
+                return
+
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            if self._writer == threading.get_ident():
+                self._writer_depth += 1
+                return
+
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = threading.get_ident()
+            self._writer_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writer_depth -= 1
+            if self._writer_depth == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextlib.contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+
+class ThreadSafeBookLibraryJSON(BookLibraryJSON):
+    """ Book library that may be shared between threads
+        Any number of threads may query the library simultaneously, while
+        modifications are performed exclusively. Query results and iteration
+        are based on a consistent snapshot of the library.
+        Note: Modify books via update(). Changes made directly, e.g. via
+        Book.update(), update the indexes under the lock as well, but other
+        threads may see the book while it is being changed.
+    """
+    def __init__(self, workers=None, cache_size=0, persist_indexes=False) -> None:
+        super().__init__(workers, cache_size, persist_indexes)
+        self._lock = ReadWriteLock()
+
+    def add(self, book) -> bool:
+        with self._lock.write_locked():
+            return super().add(book)
+
+    def find(self, **kwargs) -> list:
+        with self._locked_for_indexes(self._find_lazy_indexes(kwargs)):
+            return super().find(**kwargs)
+
+    def count(self, **kwargs) -> int:
+        with self._locked_for_indexes(self._find_lazy_indexes(kwargs)):
+            return super().count(**kwargs)
+
+    @contextlib.contextmanager
+    def _locked_for_indexes(self, names):
+        # lazy indexes are built while holding the write lock; they are checked
+        # while holding the read lock, as a reload may reset them at any time
+        self._lock.acquire_read()
+        if all(name in self._lazy_indexes for name in names):
+            try:
+                yield
+            finally:
+                self._lock.release_read()
+            return
+
+        self._lock.release_read()
+        with self._lock.write_locked():
+            yield
+
+    def isbn_collisions(self) -> list:
+        with self._lock.read_locked():
+            return super().isbn_collisions()
+
+    def search(self, query: str, limit=10) -> list:
+        with self._locked_for_indexes(["text"]):
+            return super().search(query, limit)
+
+    def complete(self, prefix: str, field="authors", limit=10) -> list:
+        with self._locked_for_indexes([f"complete-{field}"]):
+            return super().complete(prefix, field, limit)
+
+    def update(self, uuid: str, **kwargs) -> int:
+        with self._lock.write_locked():
+            return super().update(uuid, **kwargs)
+
+    def _on_book_change(self, book, old_isbn):
+        with self._lock.write_locked():
+            super()._on_book_change(book, old_isbn)
+
+    def remove(self, uuid: str) -> bool:
+        with self._lock.write_locked():
+            return super().remove(uuid)
+
+    def read_from_json_file(self, filename, uuids=None):
+        with self._lock.write_locked():
+            super().read_from_json_file(filename, uuids)
+
+    def write_to_json_file(self, filename, replay=None):
+        with self._lock.write_locked():
+            return super().write_to_json_file(filename, replay)
+
+    def __iter__(self):
+        with self._lock.read_locked():
+            return iter(list(self._books))
+
+    def __len__(self):
+        with self._lock.read_locked():
+            return len(self._books)
+
+    @property
+    def books(self):
+        with self._lock.read_locked():
+            return set(self._books)
+
+
+
+class ShardedBookLibraryJSON(BookLibraryJSON):
+    """ Book library stored in a directory instead of a single file
+        The books are partitioned by the first characters of their UUID into
+        shard files (library file format). The manifest file describes the layout.
+        Only shards containing changes are rewritten when saving. Loading can be
+        restricted to the shards of given UUIDs. Books of shards that have not
+        been loaded are neither found nor iterated.
+    """
+    MANIFEST = "manifest.json"
+    FORMAT_VERSION = 1
+
+    def __init__(self, prefix_length=2, workers=None, cache_size=0) -> None:
+        """ workers: number of processes used for loading shards in parallel
+                (default: load in this process)
+            cache_size: see BookLibraryJSON
+        """
+        super().__init__(workers, cache_size)
+        self._prefix_length = prefix_length
+        self._directory = None
+        self._available_shards = set() # prefixes of the shard files in the directory
+        self._shards = {}              # prefix -> BookLibraryJSON of the loaded shards
+
+
+    def shard_prefix(self, uuid: str) -> str:
+        prefix = uuid[:self._prefix_length].lower()
+        if len(prefix) == self._prefix_length and all(c in "0123456789abcdef" for c in prefix):
+            return prefix
+        return "other"
+
+
+    def _shard_filename(self, directory, prefix):
+        return os.path.join(directory, f"shard-{prefix}.json")
+
+
+    def _shard(self, prefix) -> BookLibraryJSON:
+        """ Return shard, load it from the directory if necessary """
+        if prefix not in self._shards:
+            shard = BookLibraryJSON()
+            if prefix in self._available_shards:
+                shard.read_from_json_file(self._shard_filename(self._directory, prefix))
+                self._add_loaded(shard.books)
+                self._set_gauges()
+            elif self._directory:
+                # new shard: a file created by another process in the meantime
+                # has to be detected as a change when saving
+                shard._filename = os.path.abspath(self._shard_filename(self._directory, prefix))
+            self._shards[prefix] = shard
+
+        return self._shards[prefix]
+
+
+    def read_from_json_file(self, filename, uuids=None):
+        """ Restore the library from a library directory
+            If uuids is given, only the shards that may contain these UUIDs are loaded.
+        """
+        with open(os.path.join(filename, self.MANIFEST), 'rt', encoding="utf-8") as f:
+            manifest = json.load(f)
+
+        if manifest.get("__type__") != "mybooks.ShardedLibrary":
+            raise ValueError(f"Invalid library manifest in {filename}!")
+
+        self._prefix_length = manifest["prefix_length"]
+
+        if uuids is None:
+            self._load(filename)
+        else:
+            self._load(filename, {self.shard_prefix(uuid) for uuid in uuids})
+
+
+    def _load(self, directory, prefixes=None):
+        """ Load shards with the given prefixes (default: all) from directory """
+        self._directory = os.path.abspath(directory)
+        self._available_shards = {name[len("shard-"):-len(".json")] for name in os.listdir(directory)
+                                  if name.startswith("shard-") and name.endswith(".json")}
+        self._shards = {}
+        self._generation += 1
+        self._books = set()
+        self._by_uuid = {}
+        self._by_isbn = {}
+        self._lazy_indexes = {}
+        self._stored_indexes = {}
+        self._changed.clear()
+        self._removed.clear()
+        self._added.clear()
+
+        prefixes = self._available_shards if prefixes is None else prefixes & self._available_shards
+
+        if self._workers and self._workers > 1 and len(prefixes) > 1:
+            self._load_parallel(sorted(prefixes))
+
+        for prefix in prefixes:
+            self._shard(prefix)
+
+
+    def _load_parallel(self, prefixes):
+        """ Decode and validate shard files in worker processes
+            The workers send back compact records, from which the books are assembled.
+        """
+        filenames = [self._shard_filename(self._directory, prefix) for prefix in prefixes]
+
+        with profiling.phase("decode") as p, concurrent.futures.ProcessPoolExecutor(max_workers=self._workers) as executor:
+            for prefix, filename, (records, etag, stat) in zip(prefixes, filenames, executor.map(_read_records, filenames)):
+                shard = BookLibraryJSON()
+                shard._set_loaded({Book.from_record(record) for record in records}, filename, etag, stat)
+                self._shards[prefix] = shard
+                self._add_loaded(shard.books)
+                p.add_count(len(records))
+
+        self._set_gauges()
+
+
+    def write_to_json_file(self, filename, replay=None):
+        """ Save the library to a library directory
+            Only shards with changes are rewritten. Concurrent changes of shard files
+            are handled like in BookLibraryJSON.write_to_json_file().
+            Returns False if nothing has been written.
+        """
+        directory = os.path.abspath(filename)
+
+        if directory != self._directory:
+            self._write_manifest(directory)
+            for prefix, shard in self._shards.items():
+                shard.write_to_json_file(self._shard_filename(directory, prefix))
+            self._directory = directory
+            self._available_shards = set(self._shards)
+            self._mark_clean()
+            return True
+
+        if not self.is_dirty:
+            return False
+
+        for _ in range(10):
+            try:
+                for prefix, shard in self._shards.items():
+                    shard.write_to_json_file(self._shard_filename(directory, prefix))
+                break
+
+            except LibraryFileChangedError:
+                if replay is None:
+                    raise
+
+                # repeat the modifications on the fresh state of the loaded shards
+                self._load(directory, set(self._shards))
+                replay(self)
+        else:
+            raise LibraryFileChangedError(f"Library {filename} is changed continuously by other processes!")
+
+        self._available_shards |= set(self._shards)
+        self._mark_clean()
+        return True
+
+
+    def _write_manifest(self, directory):
+        os.makedirs(directory, exist_ok=True)
+
+        # remove shards of a library previously stored in the directory
+        for name in os.listdir(directory):
+            if name.startswith("shard-") and name.endswith(".json"):
+                os.remove(os.path.join(directory, name))
+
+        manifest = {"__type__": "mybooks.ShardedLibrary", "version": self.FORMAT_VERSION, "prefix_length": self._prefix_length}
+        tmp_filename = os.path.join(directory, f"{self.MANIFEST}.{os.getpid()}.tmp")
+        with open(tmp_filename, 'wt', encoding="utf-8") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_filename, os.path.join(directory, self.MANIFEST))
+
+
+    def add(self, book) -> bool:
+        if isinstance(book, Book):
+            self._shard(self.shard_prefix(book.uuid))
+        return super().add(book)
+
+    def update(self, uuid: str, **kwargs) -> int:
+        if uuid and isinstance(uuid, str):
+            self._shard(self.shard_prefix(uuid))
+        return super().update(uuid, **kwargs)
+
+    def remove(self, uuid: str) -> bool:
+        if uuid and isinstance(uuid, str):
+            self._shard(self.shard_prefix(uuid))
+        return super().remove(uuid)
+
+
+    # the shard is updated first, so that the metrics of the whole library are recorded last
+
+    def _book_added(self, book):
+        shard = self._shard(self.shard_prefix(book.uuid))
+        shard._books.add(book)
+        shard._book_added(book)
+        super()._book_added(book)
+
+    def _book_changed(self, book, old_isbn):
+        self._shard(self.shard_prefix(book.uuid))._book_changed(book, old_isbn)
+        super()._book_changed(book, old_isbn)
+
+    def _book_removed(self, book):
+        shard = self._shard(self.shard_prefix(book.uuid))
+        shard._books.discard(book)
+        shard._book_removed(book)
+        super()._book_removed(book)
+
+
+    @property
+    def loaded_shards(self) -> set:
+        return set(self._shards)
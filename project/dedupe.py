@@ -0,0 +1,163 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Detection of near-duplicate books (same work with a different spelling or edition)
+
+The title and author names of each book are split into overlapping character
+shingles. MinHash signatures of the shingle sets are grouped by locality-sensitive
+hashing (LSH): books sharing all values of a band of their signatures become
+candidate pairs, so only similar books are compared instead of all pairs.
+'''
+
+from book_library import author_key
+import hashlib
+import profiling
+
+
+def shingles(book, size=4) -> frozenset:
+    """ Set of the character substrings of length size of the normalized title and authors """
+    text = " ".join([book.title_key] + sorted(author_key(author) for author in book.authors))
+    if len(text) <= size:
+        return frozenset([text])
+    return frozenset(text[i:i + size] for i in range(len(text) - size + 1))
+
+
+def jaccard(a, b) -> float:
+    """ Jaccard similarity of the sets a and b """
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHash:
+    """ Computes MinHash signatures of sets of strings
+        Each of the num_perm hash functions is a 32 bit slice of a SHAKE-128 digest.
+        The hash values are cached per shingle, as shingles recur in many books.
+    """
+    def __init__(self, num_perm=32) -> None:
+        self.num_perm = num_perm
+        self._hashes = {} # shingle -> tuple of num_perm hash values
+
+    def _hash(self, shingle):
+        values = self._hashes.get(shingle)
+        if values is None:
+            digest = hashlib.shake_128(shingle.encode("utf-8")).digest(4 * self.num_perm)
+            values = self._hashes[shingle] = tuple(memoryview(digest).cast("I"))
+        return values
+
+    def signature(self, items) -> tuple:
+        """ Returns the minimum of each hash function over items (must not be empty) """
+        return tuple(map(min, zip(*map(self._hash, items))))
+
+
+def find_duplicates(books, threshold=0.6, num_perm=32, bands=8) -> list:
+    """ Find pairs of similar books
+        threshold: minimum Jaccard similarity of the shingles of title and authors
+        num_perm, bands: size of the MinHash signatures and number of LSH bands;
+            pairs with a similarity around (1/bands)**(bands/num_perm) or above are
+            likely to become candidates
+        Returns list of (similarity, book, other book), most similar first
+    """
+    if num_perm % bands:
+        raise ValueError("Number of hash functions must be a multiple of the number of bands!")
+    if not 0 <= threshold <= 1:
+        raise ValueError("Threshold must be between 0 and 1!")
+
+    books = list(books)
+    rows = num_perm // bands
+    minhash = MinHash(num_perm)
+
+    with profiling.phase("dedupe") as p:
+        p.add_count(len(books))
+
+        book_shingles = [shingles(book) for book in books]
+
+        # books sharing a band of their signatures become candidates
+        buckets = {}
+        signatures = {} # shingles -> signature, e.g. for books with the same title and authors
+        for i, items in enumerate(book_shingles):
+            signature = signatures.get(items)
+            if signature is None:
+                signature = signatures[items] = minhash.signature(items)
+            for band in range(bands):
+                buckets.setdefault((band, signature[band * rows:(band + 1) * rows]), []).append(i)
+
+        candidates = set()
+        for members in buckets.values():
+            for j, a in enumerate(members):
+                for b in members[j + 1:]:
+                    candidates.add((a, b))
+
+        # the exact similarity of the candidates decides
+        duplicates = []
+        for a, b in candidates:
+            similarity = jaccard(book_shingles[a], book_shingles[b])
+            if similarity >= threshold:
+                duplicates.append((similarity, a, b))
+
+    duplicates.sort(key=lambda d: (-d[0], d[1], d[2]))
+    return [(similarity, books[a], books[b]) for similarity, a, b in duplicates]
+
+
+def _completeness(book):
+    return (book.isbn is not None, book.publication_date is not None, len(book.keywords))
+
+
+def merge_duplicates(lib, pairs) -> list:
+    """ Merge each pair of books (UUIDs) of lib into the one with more metadata
+        The missing ISBN and publication date and the keywords of the removed book
+        are added to the kept one. Pairs of which a book is already gone are skipped.
+        Returns list of (kept UUID, removed UUID)
+    """
+    merged = []
+    for uuid, other_uuid in pairs:
+        found = lib.find(uuid=uuid)
+        other_found = lib.find(uuid=other_uuid)
+        if not (found and other_found):
+            continue
+
+        keep, duplicate = found[0], other_found[0]
+        if _completeness(duplicate) > _completeness(keep):
+            keep, duplicate = duplicate, keep
+
+        changes = {"keywords": list(keep.keywords) + [k for k in duplicate.keywords if k not in keep.keywords]}
+        if keep.isbn is None and duplicate.isbn:
+            changes["isbn"] = duplicate.isbn
+        if keep.publication_date is None and duplicate.publication_date:
+            changes["publication_date"] = duplicate.publication_date
+
+        # remove first, the ISBN may move to the kept book
+        lib.remove(duplicate.uuid)
+        lib.update(keep.uuid, **changes)
+        merged.append((keep.uuid, duplicate.uuid))
+
+    return merged
+
+
+def merge_isbn_collisions(lib) -> list:
+    """ Merge all books of lib sharing an ISBN (see BookLibraryJSON.isbn_collisions())
+        into one book per ISBN
+        Returns list of (kept UUID, removed UUID)
+    """
+    merged = []
+    for books in lib.isbn_collisions():
+        keep = books[0].uuid
+        for book in books[1:]:
+            if result := merge_duplicates(lib, [(keep, book.uuid)]):
+                keep = result[0][0]
+                merged.extend(result)
+    return merged
@@ -0,0 +1,138 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Fast validation and normalization of ISBNs, e.g. of bulk import files
+
+The results are the same as those of the respective isbnlib functions, but
+values that are already canonical skip the regular expressions, the check
+digits are computed without per-digit function calls and many values are
+validated at once. If NumPy is installed, the check digits of a chunk of
+values are computed with array operations.
+'''
+
+import itertools
+import operator
+import re
+
+try:
+    import numpy
+except ImportError: # optional, the pure Python implementation is used instead
+    numpy = None
+
+# Number of values validated at once by iter_canonical_isbns()
+CHUNK_SIZE = 1 << 14
+
+# ISBN-like substrings, same as isbnlib.get_canonical_isbn()
+_ISBN_LIKE = re.compile(r"97[89]{1}-?[0-9]{10}|97[89]{1}-[-0-9]{13}|\d{9}[0-9X]{1}|[-0-9X]{10,16}", re.I)
+_NOT_CANONICAL = re.compile(r"[^0-9Xx]")
+_RESERVED = frozenset(["0000000000", "0000000000000", "000000000X"])
+_ISBN10_WEIGHTS = tuple(range(10, 1, -1))
+_CHECK_DIGITS_10 = frozenset("0123456789X")
+
+
+def _checksum_ok(isbn) -> bool:
+    """ Check digit test of a canonical ISBN-10 or ISBN-13 """
+    if len(isbn) == 13:
+        if not (isbn.isascii() and isbn.isdigit()):
+            return False
+        # the weighted sum of the ASCII codes differs by a multiple of 10
+        codes = isbn.encode("ascii")
+        return (sum(codes[0::2]) + 3 * sum(codes[1::2])) % 10 == 0
+
+    if not (isbn.isascii() and isbn[:9].isdigit()):
+        return False
+    check = 10 if isbn[9] == "X" else ord(isbn[9]) - 48
+    return (sum(map(operator.mul, _ISBN10_WEIGHTS, isbn[:9].encode("ascii"))) - 48 * 54 + check) % 11 == 0
+
+
+def _canonical(value) -> str:
+    """ Same as isbnlib.canonical() """
+    isbn = _NOT_CANONICAL.sub("", value)
+    if isbn.endswith("x"):
+        isbn = isbn[:-1] + "X"
+
+    if len(isbn) not in (10, 13) or isbn in _RESERVED or isbn.find("X") not in (9, -1) or "x" in isbn:
+        return ""
+    return isbn
+
+
+def canonical_isbn(value: str):
+    """ Canonical form of a valid ISBN-10 or ISBN-13, None if invalid
+        Equivalent to isbnlib.canonical(value) if not isbnlib.notisbn(value)
+    """
+    isbn = _canonical(value)
+    if not isbn:
+        return None
+    if len(isbn) == 13 and isbn[:3] not in ("978", "979"):
+        return None
+
+    return isbn if _checksum_ok(isbn) else None
+
+
+def _candidate(value):
+    """ Canonical ISBN-like part of value before the check digit test, "" if none """
+    # common case: the value is a canonical ISBN already
+    if len(value) == 13 and value[:3] in ("978", "979") and value.isascii() and value.isdigit():
+        return value
+    if len(value) == 10 and value.isascii() and value[:9].isdigit() and value[9] in _CHECK_DIGITS_10:
+        return value if value not in _RESERVED else ""
+
+    match = _ISBN_LIKE.search(value)
+    return _canonical(match.group()) if match else ""
+
+
+def _checksums_ok_numpy(isbns) -> list:
+    """ _checksum_ok() of all isbns by array operations """
+    valid = [False] * len(isbns)
+    for length, weights, modulus in ((13, [1, 3] * 6 + [1], 10), (10, list(range(10, 0, -1)), 11)):
+        indexes = [i for i, isbn in enumerate(isbns) if len(isbn) == length and isbn[:length - 1].isdigit()]
+        if not indexes:
+            continue
+
+        digits = numpy.frombuffer("".join(isbns[i] for i in indexes).encode("ascii"), dtype=numpy.uint8)
+        digits = digits.reshape(-1, length).astype(numpy.int64) - 48
+        if length == 10:
+            digits[digits[:, 9] == ord("X") - 48, 9] = 10
+        for i, ok in zip(indexes, ((digits @ numpy.array(weights)) % modulus == 0).tolist()):
+            valid[i] = ok
+    return valid
+
+
+def canonical_isbns(values, use_numpy=None) -> list:
+    """ Canonical ISBN found in each of values, None if there is no valid ISBN
+        Equivalent to [isbnlib.get_canonical_isbn(value) or None for value in values]
+        use_numpy: compute check digits with NumPy (default: if installed)
+    """
+    if use_numpy is None:
+        use_numpy = numpy is not None
+    elif use_numpy and numpy is None:
+        raise ValueError("NumPy is not installed!")
+
+    candidates = [_candidate(value) for value in values]
+    if use_numpy:
+        valid = _checksums_ok_numpy(candidates)
+    else:
+        valid = [bool(isbn) and _checksum_ok(isbn) for isbn in candidates]
+
+    return [isbn if ok else None for isbn, ok in zip(candidates, valid)]
+
+
+def iter_canonical_isbns(values, chunk_size=CHUNK_SIZE, use_numpy=None):
+    """ Generates canonical_isbns() of values (e.g. the lines of a file), processed in chunks """
+    values = iter(values)
+    while chunk := list(itertools.islice(values, chunk_size)):
+        yield from canonical_isbns(chunk, use_numpy)
@@ -0,0 +1,203 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+In-process metrics (counters, gauges and histograms) of the book library
+
+Metrics are only recorded after enable() has been called. Before that the
+update functions return immediately, i.e. the library code can update
+metrics on its hot paths without noticeable overhead.
+
+The recorded metrics can be dumped in the Prometheus text format or as JSON.
+'''
+
+import bisect
+import json
+import threading
+import time
+
+
+# upper bounds of the histogram buckets in seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # last: +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Registry:
+    """ Stores metrics by name and labels """
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.counters = {}   # (name, labels) -> value
+        self.gauges = {}     # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> Histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def as_prometheus(self) -> str:
+        """ Metrics in the Prometheus text exposition format """
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, _ in metrics}):
+                    lines.append(f"# TYPE {name} {kind}")
+                    for (n, labels), value in sorted(metrics.items()):
+                        if n == name:
+                            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append(f"# TYPE {name} histogram")
+                for (n, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{_format_labels(labels + (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def as_dict(self) -> dict:
+        """ Metrics as JSON serializable dict """
+        with self._lock:
+            return {
+                "counters": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.counters.items())],
+                "gauges": [{"name": n, "labels": dict(l), "value": v} for (n, l), v in sorted(self.gauges.items())],
+                "histograms": [{"name": n, "labels": dict(l), "buckets": list(h.buckets), "counts": h.counts, "sum": h.sum, "count": h.count}
+                               for (n, l), h in sorted(self.histograms.items(), key=lambda item: item[0])],
+            }
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+class _Timer:
+    def __init__(self, name, labels) -> None:
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self._name, time.perf_counter() - self._start, **self._labels)
+        return False
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+_registry = None
+
+
+def enable() -> Registry:
+    """ Start recording metrics (keeps already recorded metrics) """
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+
+def disable():
+    """ Stop recording and discard all recorded metrics """
+    global _registry
+    _registry = None
+
+
+def enabled() -> bool:
+    return _registry is not None
+
+
+def registry() -> Registry:
+    return _registry
+
+
+def inc(name, value=1, **labels):
+    if _registry is not None:
+        _registry.inc(name, value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    if _registry is not None:
+        _registry.set_gauge(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    if _registry is not None:
+        _registry.observe(name, value, **labels)
+
+
+def timer(name, **labels):
+    """ Context manager observing the elapsed time in histogram name """
+    if _registry is None:
+        return _NULL_TIMER
+    return _Timer(name, labels)
+
+
+def dump(filename, output_format=None):
+    """ Write the recorded metrics to a file
+        output_format: "prometheus" or "json" (default: by file extension)
+    """
+    if output_format is None:
+        output_format = "json" if filename.endswith(".json") else "prometheus"
+
+    registry = _registry or Registry()
+    with open(filename, "wt", encoding="utf-8") as f:
+        if output_format == "json":
+            json.dump(registry.as_dict(), f, indent=4)
+        elif output_format == "prometheus":
+            f.write(registry.as_prometheus())
+        else:
+            raise ValueError(f"Unsupported metrics format: {output_format}")
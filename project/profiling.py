@@ -0,0 +1,135 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+'''
+Lightweight timing instrumentation of the processing phases
+
+Usage:
+    with profiling.phase("load") as p:
+        ...
+        p.add_count(len(books))
+
+Phases may be nested, e.g. building an index during a query. The time of
+the inner phase is only counted for the inner phase, i.e. the times of all
+phases add up to the time spent in them.
+
+As long as profiling has not been started, phase() returns a shared no-op
+object, i.e. the instrumentation costs a single function call.
+'''
+
+import cProfile
+import threading
+import time
+
+
+class Profiler:
+    """ Accumulates elapsed time and counts per phase """
+    def __init__(self) -> None:
+        self.phases = {} # name -> [seconds, calls, count]
+        self._active = threading.local() # stack of the phases entered by a thread
+
+    def add(self, name, seconds, count=0):
+        entry = self.phases.setdefault(name, [0.0, 0, 0])
+        entry[0] += seconds
+        entry[1] += 1
+        entry[2] += count
+
+    def summary(self) -> str:
+        lines = [f"{'phase':<10} {'time [ms]':>12} {'calls':>8} {'count':>10}"]
+        for name, (seconds, calls, count) in self.phases.items():
+            lines.append(f"{name:<10} {seconds*1000:12.3f} {calls:8d} {count:10d}")
+        return "\n".join(lines)
+
+
+class _Phase:
+    def __init__(self, profiler, name) -> None:
+        self._profiler = profiler
+        self._name = name
+        self._count = 0
+
+    def add_count(self, n=1):
+        self._count += n
+
+    def __enter__(self):
+        self._nested = 0.0 # time spent in nested phases
+        stack = self._profiler._active.__dict__.setdefault("stack", [])
+        stack.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._start
+        stack = self._profiler._active.stack
+        stack.pop()
+        if stack:
+            stack[-1]._nested += elapsed
+        self._profiler.add(self._name, elapsed - self._nested, self._count)
+        return False
+
+
+class _NullPhase:
+    def add_count(self, n=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+_profiler = None
+_cprofile = None
+_cprofile_filename = None
+
+
+def phase(name):
+    """ Context manager measuring the time spent in phase name """
+    if _profiler is None:
+        return _NULL_PHASE
+    return _Phase(_profiler, name)
+
+
+def start(cprofile_filename=None) -> Profiler:
+    """ Start recording phase timings
+        If cprofile_filename is given, cProfile is run as well and its
+        statistics are dumped to that file by stop() (see module pstats).
+    """
+    global _profiler, _cprofile, _cprofile_filename
+
+    _profiler = Profiler()
+    if cprofile_filename:
+        _cprofile_filename = cprofile_filename
+        _cprofile = cProfile.Profile()
+        _cprofile.enable()
+
+    return _profiler
+
+
+def stop() -> Profiler:
+    """ Stop recording and return the profiler with the recorded timings """
+    global _profiler, _cprofile, _cprofile_filename
+
+    if _cprofile:
+        _cprofile.disable()
+        _cprofile.dump_stats(_cprofile_filename)
+
+    profiler = _profiler
+    _profiler = _cprofile = _cprofile_filename = None
+
+    return profiler
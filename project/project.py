@@ -14,25 +14,48 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-from book_library import BookLibraryJSON
+from book_library import BookLibraryJSON, ShardedBookLibraryJSON, library_for_file, iter_books
 from book import Book
+from dedupe import find_duplicates, merge_duplicates, merge_isbn_collisions
+from isbn_batch import iter_canonical_isbns
 
 import argparse
+import atexit
+import csv
+import heapq
+import itertools
+import json
+import os
 import os.path
 import sys
-import isbnlib
+import time
+import profiling
+import metrics
+
+# Sort keys of the list command: name -> (key function, default order is descending)
+# Books without the respective metadata are listed first for dates and last otherwise.
+SORT_KEYS = {
+    "date": (lambda b: (b.publication_date is None, b.publication_date.toordinal() if b.publication_date else 0), True),
+    "title": (lambda b: b.title.casefold(), False),
+    "author": (lambda b: b.authors[0].casefold(), False),
+    "isbn": (lambda b: (b.isbn is None, b.isbn or ""), False),
+}
+
 
 def handle_cli_command_init(args) -> bool:
     '''
     Create an empty library
     '''
-    if os.path.isfile(args.file) and not args.force: 
+    if os.path.exists(args.file) and not args.force: 
         answer = input(f"Do you really want to overwrite existing file {args.file}? [Yes/No]: ")
         if answer != "Yes":
             print("Leaving existing file unchanged!")
             return False
 
-    lib = BookLibraryJSON()
+    if getattr(args, "sharded", False):
+        lib = ShardedBookLibraryJSON()
+    else:
+        lib = BookLibraryJSON()
     lib.write_to_json_file(args.file)
     print("Initialized empty database.")
 
@@ -45,7 +68,7 @@ def handle_cli_command_import(args):
     Returns number of imported books
     '''
 
-    if not os.path.isfile(args.file):
+    if not os.path.exists(args.file):
         print("Cannot find library file. Use init command to create an empty file.")
         return False
 
@@ -55,72 +78,189 @@ def handle_cli_command_import(args):
     if args.json_file and args.isbn_file:
         raise ValueError( 'Options --json-file and --isbn-file must nor be specified simultaneously. Aborting.')
     
-    lib = BookLibraryJSON()
+    lib = library_for_file(args.file, workers=getattr(args, "workers", None), persist_indexes=not getattr(args, "no_index_file", False))
     lib.read_from_json_file(args.file)
 
     # Import JSON file
     if args.json_file:
-        import_lib = BookLibraryJSON()
-
         print(f"Importing file {args.json_file} ...")
-        import_lib.read_from_json_file(args.json_file)
 
+        # books are decoded, checked for duplicates and added as they are read
+        progress = ProgressLine(getattr(args, "progress", 0), "{count} books read, {imported} imported ...")
         books_for_import = 0
-        books_imported = 0
-        for book in import_lib:
+        imported_books = []
+        for book in iter_books(args.json_file):
             books_for_import += 1
             if lib.add(book):
-                books_imported += 1
-            
+                imported_books.append(book)
+            progress.update(books_for_import, imported=len(imported_books))
+        progress.close()
+
+        books_imported = len(imported_books)
 
         print(f"{books_imported} of {books_for_import} books imported ({books_for_import-books_imported} duplicates).")
-        lib.write_to_json_file(args.file)
+        lib.write_to_json_file(args.file, replay=lambda lib: add_books(lib, imported_books))
         
         return books_imported
 
     # Import ISBN file
     elif args.isbn_file:
         print(f"Importing file {args.isbn_file} ...")
-        file = open(args.isbn_file, 'rt')
-        
+
+        checkpoint = ImportCheckpoint(lib, args.file, args.isbn_file,
+                                      every=getattr(args, "checkpoint_every", 0), seconds=getattr(args, "checkpoint_seconds", 0))
+        if getattr(args, "resume", False) and checkpoint.resume():
+            print(f"Resuming import after line {checkpoint.line} ...")
+
         valid_isbn = 0
         books_imported = 0
         lines_skipped = 0
-        for line in file:
-            isbn = isbnlib.get_canonical_isbn(line.strip())
-            if isbn:
-                valid_isbn += 1
-                if not lib.find(isbn=isbn):
-                    book = Book.from_isbn(isbn)
-                    if book and lib.add(book):
-                        print(f'Imported ISBN {isbn}.') 
-                        books_imported += 1
+        with open(args.isbn_file, 'rt') as file:
+            try:
+                # lines are validated in chunks, lines of a previous run are skipped
+                lines = (line.strip() for line in itertools.islice(file, checkpoint.line, None))
+                for line_number, isbn in enumerate(iter_canonical_isbns(lines), checkpoint.line + 1):
+                    if isbn:
+                        valid_isbn += 1
+                        if not lib.find(isbn=isbn):
+                            book = Book.from_isbn(isbn)
+                            if book and lib.add(book):
+                                print(f'Imported ISBN {isbn}.') 
+                                checkpoint.add(book)
+                                books_imported += 1
+                            else:
+                                print(f'Could not fetch metadata for ISBN {isbn}.')    
+                        else:
+                            print(f'Ignoring ISBN {isbn} (already in library).') 
                     else:
-                        print(f'Could not fetch metadata for ISBN {isbn}.')    
-                else:
-                    print(f'Ignoring ISBN {isbn} (already in library).') 
-            else:
-                lines_skipped += 1
+                        lines_skipped += 1
 
-        file.close()
+                    checkpoint.processed(line_number)
+
+            except BaseException:
+                # e.g. network failure or Ctrl-C: keep the books fetched so far
+                checkpoint.save()
+                print(f"Import interrupted after line {checkpoint.line}. Use --resume to continue.")
+                raise
 
         print(f"{books_imported} of {valid_isbn} books imported ({valid_isbn-books_imported} duplicates, {lines_skipped} lines skipped).")
-        lib.write_to_json_file(args.file)
+        checkpoint.finish()
 
         return books_imported
 
 
+class ImportCheckpoint:
+    '''
+    Saves the library periodically during a long-running import, together with
+    the number of processed input lines, so that an interrupted import can be resumed
+    '''
+    def __init__(self, lib, filename, input_filename, every=0, seconds=0):
+        '''
+        every: save after every N added books (0: never)
+        seconds: save if the last save is at least T seconds ago (0: never)
+        '''
+        self._lib = lib
+        self._filename = filename
+        self._every = every
+        self._seconds = seconds
+        self._pending = [] # books added since the last save
+        self._last_save = time.monotonic()
+        self.progress_filename = f"{input_filename}.progress"
+        self.line = 0      # number of processed input lines
+
+    def resume(self) -> int:
+        '''
+        Continue an interrupted import
+        Returns the number of input lines already processed (0 if there is no progress file)
+        '''
+        if not os.path.exists(self.progress_filename):
+            return 0
+
+        with open(self.progress_filename, 'rt', encoding="utf-8") as f:
+            progress = json.load(f)
+
+        if progress.get("library") != os.path.abspath(self._filename):
+            raise ValueError(f"Progress file {self.progress_filename} belongs to an import into library {progress.get('library')}!")
+
+        self.line = progress["lines"]
+        return self.line
+
+    def add(self, book):
+        self._pending.append(book)
+
+    def processed(self, line):
+        '''
+        Record that input lines up to line have been processed, save if a checkpoint is due
+        '''
+        self.line = line
+        if (self._every and len(self._pending) >= self._every) or (self._seconds and time.monotonic() - self._last_save >= self._seconds):
+            self.save()
+
+    def save(self):
+        pending = self._pending
+        self._lib.write_to_json_file(self._filename, replay=lambda lib: add_books(lib, pending))
+        self._pending = []
+        self._last_save = time.monotonic()
+
+        tmp_filename = f"{self.progress_filename}.{os.getpid()}.tmp"
+        with open(tmp_filename, 'wt', encoding="utf-8") as f:
+            json.dump({"library": os.path.abspath(self._filename), "lines": self.line}, f)
+        os.replace(tmp_filename, self.progress_filename)
+
+    def finish(self):
+        '''
+        Save the library and remove the progress file
+        '''
+        pending = self._pending
+        self._lib.write_to_json_file(self._filename, replay=lambda lib: add_books(lib, pending))
+        self._pending = []
+        if os.path.exists(self.progress_filename):
+            os.remove(self.progress_filename)
+
+
+class ProgressLine:
+    '''
+    Progress line on stderr that is overwritten every n-th step (n=0: disabled)
+    '''
+    def __init__(self, n, template, stream=None):
+        self._n = n
+        self._template = template
+        self._stream = stream or sys.stderr
+        self._shown = False
+
+    def update(self, count, **values):
+        if self._n and count % self._n == 0:
+            print("\r" + self._template.format(count=count, **values), end="", file=self._stream, flush=True)
+            self._shown = True
+
+    def close(self):
+        if self._shown:
+            print(file=self._stream)
+            self._shown = False
+
+
+def add_books(lib, books) -> int:
+    '''
+    Add books to the library
+    Returns number of added books (duplicates are skipped)
+    '''
+    return sum(1 for book in books if lib.add(book))
+
+
 def handle_cli_command_list(args):
     '''
     List the contents of the library
     '''
 
-    if not os.path.isfile(args.file):
+    if not os.path.exists(args.file):
         print("Cannot find library file. Use init command to create an empty file.")
         return False
 
-    lib = BookLibraryJSON()
-    lib.read_from_json_file(args.file)
+    lib = library_for_file(args.file, workers=getattr(args, "workers", None), persist_indexes=not getattr(args, "no_index_file", False))
+    if args.uuid and not any(c in args.uuid for c in "*?["):
+        lib.read_from_json_file(args.file, uuids=[args.uuid])
+    else:
+        lib.read_from_json_file(args.file)
 
     find_args = {}
 
@@ -148,48 +288,322 @@ def handle_cli_command_list(args):
     if args.uuid:
         find_args["uuid"] = args.uuid
 
+    if getattr(args, "insensitive", False):
+        find_args["insensitive"] = True
+
+    if getattr(args, "fuzzy", None) is not None:
+        find_args["fuzzy"] = args.fuzzy
+
+    if getattr(args, "count", False):
+        try:
+            count = lib.count(**find_args)
+        except ValueError as e:
+            print(e)
+            return 0
+        print(count)
+        return count
+
     try:
-        books = sorted(lib.find(**find_args), key=lambda b: f"{b.publication_date}", reverse=True)
+        key, reverse = SORT_KEYS[getattr(args, "sort", None) or "date"]
+        if getattr(args, "reverse", False):
+            reverse = not reverse
+
+        books = lib.find(**find_args)
+        with profiling.phase("sort") as p:
+            p.add_count(len(books))
+            books = select_books(books, key=key, reverse=reverse,
+                                 offset=getattr(args, "offset", None), limit=getattr(args, "limit", None))
     except ValueError as e:
         print(e)
         return 0
 
+    output_format = getattr(args, "format", None) or "text"
 
-    for index, book in enumerate(books):
-            
-            book_str = ""
+    if output_format == "text":
+        first_index = (getattr(args, "offset", None) or 0) + 1
+        lines = format_text_lines(books, args, first_index)
+    else:
+        lines = format_record_lines(books, output_format)
 
-            if not args.bare:
-                book_str += f"[{index+1}] "
-                
-            if args.show_all:
-                book_str += f" {book.full_str()}"
-            else:
-                book_str += f" {str(book)}"
+    with profiling.phase("format") as p:
+        p.add_count(write_lines(lines, sys.stdout))
+
+    return len(books)
+
+
+def handle_cli_command_search(args):
+    '''
+    Full-text search for books, best matches first
+    Returns number of found books
+    '''
 
-            if args.show_keywords or args.show_all:
-                book_str += f" {str(sorted(book.keywords))}"
+    if not os.path.exists(args.file):
+        print("Cannot find library file. Use init command to create an empty file.")
+        return False
+
+    lib = library_for_file(args.file, workers=getattr(args, "workers", None), persist_indexes=not getattr(args, "no_index_file", False))
+    lib.read_from_json_file(args.file)
+
+    try:
+        books = lib.search(" ".join(args.query), limit=getattr(args, "limit", 10))
+    except ValueError as e:
+        print(e)
+        return 0
 
-            if args.show_uuid or args.show_all:
-                book_str += f" <{book.uuid}>"
+    output_format = getattr(args, "format", None) or "text"
+    if output_format == "text":
+        lines = format_text_lines(books, args)
+    else:
+        lines = format_record_lines(books, output_format)
 
-            print(book_str)
-            #print(book.meta) 
-            #print(book.as_json) 
+    with profiling.phase("format") as p:
+        p.add_count(write_lines(lines, sys.stdout))
 
     return len(books)
 
+
+def handle_cli_command_complete(args):
+    '''
+    Print author names or titles starting with the given prefix, most frequent first
+    Returns number of completions
+    '''
+
+    if not os.path.exists(args.file):
+        print("Cannot find library file. Use init command to create an empty file.")
+        return False
+
+    lib = library_for_file(args.file, workers=getattr(args, "workers", None), persist_indexes=not getattr(args, "no_index_file", False))
+    lib.read_from_json_file(args.file)
+
+    try:
+        completions = lib.complete(args.prefix, field=getattr(args, "field", "authors"), limit=getattr(args, "limit", 10))
+    except ValueError as e:
+        print(e)
+        return 0
+
+    for value, count in completions:
+        if getattr(args, "show_count", False):
+            print(f"{value} ({count})")
+        else:
+            print(value)
+
+    return len(completions)
+
+
+def handle_cli_command_dedupe(args):
+    '''
+    Report (or merge) books that are likely duplicates, most similar first
+    Returns number of found pairs
+    '''
+
+    if not os.path.exists(args.file):
+        print("Cannot find library file. Use init command to create an empty file.")
+        return False
+
+    lib = library_for_file(args.file, workers=getattr(args, "workers", None), persist_indexes=not getattr(args, "no_index_file", False))
+    lib.read_from_json_file(args.file)
+
+    try:
+        duplicates = find_duplicates(lib.find(), threshold=getattr(args, "threshold", 0.6))
+    except ValueError as e:
+        print(e)
+        return 0
+
+    for index, (similarity, book, other) in enumerate(duplicates, start=1):
+        print(f"[{index}] {similarity:.2f}")
+        for b in (book, other):
+            print(f"    {b} <{b.uuid}>")
+
+    if getattr(args, "merge", False) and duplicates:
+        pairs = [(book.uuid, other.uuid) for _, book, other in duplicates]
+        merged = merge_duplicates(lib, pairs)
+        print(f"Merged {len(merged)} duplicates.")
+        lib.write_to_json_file(args.file, replay=lambda lib: merge_duplicates(lib, merged))
+
+    return len(duplicates)
+
+
+def handle_cli_command_reindex(args):
+    '''
+    Report (or merge) books sharing an ISBN in ISBN-10 and ISBN-13 form
+    Returns number of ISBNs shared by several books
+    '''
+
+    if not os.path.exists(args.file):
+        print("Cannot find library file. Use init command to create an empty file.")
+        return False
+
+    lib = library_for_file(args.file, workers=getattr(args, "workers", None), persist_indexes=not getattr(args, "no_index_file", False))
+    lib.read_from_json_file(args.file)
+
+    collisions = lib.isbn_collisions()
+    for books in collisions:
+        print(f"ISBN {books[0].isbn13}: {len(books)} books")
+        for book in books:
+            print(f"    {book} <{book.uuid}>")
+
+    if getattr(args, "merge", False) and collisions:
+        merged = merge_isbn_collisions(lib)
+        print(f"Merged {len(merged)} duplicates.")
+        lib.write_to_json_file(args.file, replay=merge_isbn_collisions)
+    elif not collisions:
+        print("No books with identical ISBN found.")
+
+    return len(collisions)
+
+
+def format_text_lines(books, args, first_index=1):
+    '''
+    Generate the human readable output lines of the list command
+    '''
+    for index, book in enumerate(books, start=first_index):
+
+        book_str = ""
+
+        if not args.bare:
+            book_str += f"[{index}] "
+
+        if args.show_all:
+            book_str += f" {book.full_str()}"
+        else:
+            book_str += f" {str(book)}"
+
+        if args.show_keywords or args.show_all:
+            book_str += f" {str(sorted(book.keywords))}"
+
+        if args.show_uuid or args.show_all:
+            book_str += f" <{book.uuid}>"
+
+        yield book_str + "\n"
+
+
+RECORD_FIELDS = ["uuid", "title", "authors", "publication_date", "isbn", "keywords"]
+
+# Separator of authors and keywords within a single CSV/TSV field
+RECORD_LIST_SEPARATOR = "; "
+
+
+class _LineBuffer:
+    '''
+    File-like object that returns instead of stores what is written,
+    allowing csv.writer to format a single row
+    '''
+    def write(self, value):
+        return value
+
+
+def format_record_lines(books, output_format):
+    '''
+    Generate machine-readable output lines of the list command
+    Supported formats: jsonl, json, csv, tsv
+    The records are built directly from the book metadata, i.e. all authors
+    and the complete publication date are contained.
+    '''
+    if output_format in ("jsonl", "json"):
+        encoder = json.JSONEncoder(ensure_ascii=False)
+        separator = ""
+        if output_format == "json":
+            yield "["
+
+        for book in books:
+            record = dict(book.meta)
+            if book.publication_date:
+                record["publication_date"] = book.publication_date.isoformat()
+            if "keywords" in record:
+                record["keywords"] = sorted(book.keywords)
+
+            if output_format == "json":
+                yield separator + "\n    " + encoder.encode(record)
+                separator = ","
+            else:
+                yield encoder.encode(record) + "\n"
+
+        if output_format == "json":
+            yield "\n]\n"
+
+    elif output_format in ("csv", "tsv"):
+        writer = csv.writer(_LineBuffer(), dialect="excel" if output_format == "csv" else "excel-tab", lineterminator="\n")
+        yield writer.writerow(RECORD_FIELDS)
+
+        for book in books:
+            yield writer.writerow([
+                book.uuid,
+                book.title,
+                RECORD_LIST_SEPARATOR.join(book.authors),
+                book.publication_date.isoformat() if book.publication_date else "",
+                book.isbn or "",
+                RECORD_LIST_SEPARATOR.join(sorted(book.keywords)),
+            ])
+
+    else:
+        raise ValueError(f"Unsupported output format: {output_format}")
+
+
+def select_books(books, key, reverse=False, offset=None, limit=None) -> list:
+    '''
+    Sort books and return the page [offset, offset+limit)
+    If a limit is given only the first offset+limit books are selected by
+    means of a heap, i.e. the complete result does not need to be sorted.
+    '''
+    offset = offset or 0
+    if offset < 0 or (limit is not None and limit < 0):
+        raise ValueError("Offset and limit must not be negative!")
+
+    if limit is None:
+        return sorted(books, key=key, reverse=reverse)[offset:]
+
+    if reverse:
+        page = heapq.nlargest(offset + limit, books, key=key)
+    else:
+        page = heapq.nsmallest(offset + limit, books, key=key)
+
+    return page[offset:]
+
+
+def write_lines(lines, stream, batch_size=1000) -> int:
+    '''
+    Write lines to stream in batches of batch_size lines
+    Stops silently if the reading end of a pipe has been closed (e.g. "| head")
+    Returns number of lines written
+    '''
+    written = 0
+    batch = []
+    try:
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= batch_size:
+                stream.write("".join(batch))
+                written += len(batch)
+                batch = []
+
+        if batch:
+            stream.write("".join(batch))
+            written += len(batch)
+
+        stream.flush()
+
+    except BrokenPipeError:
+        # Python flushes stdout again at exit, which would raise another
+        # BrokenPipeError. Redirect the remaining output to devnull.
+        try:
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, stream.fileno())
+        except (OSError, ValueError, AttributeError):
+            pass
+
+    return written
+
 def handle_cli_command_add(args) -> bool:
     '''
     Add a book to the library
     '''
 
-    if not os.path.isfile(args.file):
+    if not os.path.exists(args.file):
         print("Cannot find library file. Use init command to create an empty file.")
         return False
 
 
-    lib = BookLibraryJSON()
+    lib = library_for_file(args.file, workers=getattr(args, "workers", None), persist_indexes=not getattr(args, "no_index_file", False))
     lib.read_from_json_file(args.file)
 
     if args.fetch_meta: 
@@ -224,7 +638,7 @@ def handle_cli_command_add(args) -> bool:
 
     if lib.add(book):
         print("Added: " + str(book))
-        lib.write_to_json_file(args.file)    
+        lib.write_to_json_file(args.file, replay=lambda lib: lib.add(book))
         return True
     else:
         return False
@@ -235,12 +649,12 @@ def handle_cli_command_update(args):
     Modify the meta data of an existing book in the library
     '''
 
-    if not os.path.isfile(args.file):
+    if not os.path.exists(args.file):
         print("Cannot find library file. Use init command to create an empty file.")
         return False
 
-    lib = BookLibraryJSON()
-    lib.read_from_json_file(args.file)
+    lib = library_for_file(args.file, workers=getattr(args, "workers", None), persist_indexes=not getattr(args, "no_index_file", False))
+    lib.read_from_json_file(args.file, uuids=[args.uuid] if args.uuid else None)
 
 
     if not args.uuid:
@@ -262,9 +676,10 @@ def handle_cli_command_update(args):
 
     if lib.update(args.uuid, **meta):
         print("Updated: " + args.uuid)
-        lib.write_to_json_file(args.file)    
+        lib.write_to_json_file(args.file, replay=lambda lib: lib.update(args.uuid, **meta))
         return True
     else:
+        print("No changes: " + args.uuid)
         return False
 
 
@@ -274,7 +689,7 @@ def handle_cli_command_delete(args) -> bool:
     Delete a book from the library
     '''
 
-    if not os.path.isfile(args.file):
+    if not os.path.exists(args.file):
         print("Cannot find library file. Use init command to create an empty file.")
         return False
 
@@ -282,12 +697,12 @@ def handle_cli_command_delete(args) -> bool:
     if not args.uuid:
         raise ValueError("UUID must be specified!")
 
-    lib = BookLibraryJSON()
-    lib.read_from_json_file(args.file)
+    lib = library_for_file(args.file, workers=getattr(args, "workers", None), persist_indexes=not getattr(args, "no_index_file", False))
+    lib.read_from_json_file(args.file, uuids=[args.uuid])
 
     if lib.remove(args.uuid):
         print(f"Deleted book with UUID {args.uuid}" )
-        lib.write_to_json_file(args.file)    
+        lib.write_to_json_file(args.file, replay=lambda lib: lib.remove(args.uuid))
         return True
     else:
         return False
@@ -301,9 +716,15 @@ def parse_args(argv):
   # Configure CLI
     parser = argparse.ArgumentParser(description = "A simple book library software")
     parser.add_argument("--file", type=str, default="mybooks.json", help="Library file")    
+    parser.add_argument("--workers", type=int, metavar="N", help="Number of processes for loading sharded libraries and decoding large JSON Lines files (default: 1)")
+    parser.add_argument("--no-index-file", action='store_true', help="Neither load nor save the indexes of large libraries in an index file (FILE.idx)")
+    parser.add_argument("--profile", action='store_true', help="Print timings of processing phases to stderr")
+    parser.add_argument("--metrics-file", type=str, metavar="FILE", help="Save metrics to FILE (Prometheus text format, JSON if FILE ends with .json)")
+    parser.add_argument("--profile-output", type=str, metavar="FILE", help="Save cProfile statistics to FILE (implies --profile)")
     subparsers = parser.add_subparsers(dest="command", help="sub-command help", required=True)
     parser_init = subparsers.add_parser("init", help="Initialize empty library")
     parser_init.add_argument("--force", action='store_true', help="Force overwriting exisiting database")
+    parser_init.add_argument("--sharded", action='store_true', help="Store library in a directory of shard files (for very large libraries)")
     parser_add = subparsers.add_parser("add", help="Add a book to the library")
     parser_add.add_argument("--title", type=str, help="Title of the book")
     parser_add.add_argument("--isbn", type=str, help="ISBN number")
@@ -320,12 +741,38 @@ def parse_args(argv):
     parser_list.add_argument("--authors", type=str, metavar="AUTHOR", nargs = "+", help="Space-separated list of author names")
     parser_list.add_argument("--show-all", action='store_true', help="Show all metadata of the book")
     parser_list.add_argument("--match-all", action='store_true', help="Match all of given authors or keywords")
+    parser_list.add_argument("--insensitive", action='store_true', help="Match title, authors and keywords ignoring case and accents")
+    parser_list.add_argument("--fuzzy", type=int, metavar="N", help="Match author names with up to N typos (edit distance), ignoring case, accents and \"Last, First\" order")
     parser_list.add_argument("--published-after", metavar="YYYY-MM-DD",type=str, help="Date in ISO format (YYYY-MM-DD)")
     parser_list.add_argument("--published-before", metavar="YYYY-MM-DD",type=str, help="Date in ISO format (YYYY-MM-DD)")
     parser_list.add_argument("--show-keywords", action='store_true', help="Show keywords")
     parser_list.add_argument("--uuid", type=str, help="UUID of book in library")
     parser_list.add_argument("--show-uuid", action='store_true', help="Show UUID of book in library")
     parser_list.add_argument("--bare", action='store_true', help="Disable enumeration")
+    parser_list.add_argument("--limit", type=int, metavar="N", help="Show at most N books")
+    parser_list.add_argument("--count", action='store_true', help="Only show the number of matching books")
+    parser_list.add_argument("--offset", type=int, metavar="N", default=0, help="Skip the first N books")
+    parser_list.add_argument("--sort", choices=SORT_KEYS.keys(), default="date", help="Sort order (default: date, latest first)")
+    parser_list.add_argument("--reverse", action='store_true', help="Reverse sort order")
+    parser_list.add_argument("--format", choices=["text", "jsonl", "json", "csv", "tsv"], default="text", help="Output format (default: text)")
+    parser_search = subparsers.add_parser("search", help="Full-text search in titles, authors and keywords")
+    parser_search.add_argument("query", type=str, metavar="WORD", nargs="+", help="Words to search for")
+    parser_search.add_argument("--limit", type=int, metavar="N", default=10, help="Show the N best matching books (default: 10)")
+    parser_search.add_argument("--show-all", action='store_true', help="Show all metadata of the book")
+    parser_search.add_argument("--show-keywords", action='store_true', help="Show keywords")
+    parser_search.add_argument("--show-uuid", action='store_true', help="Show UUID of book in library")
+    parser_search.add_argument("--bare", action='store_true', help="Disable enumeration")
+    parser_search.add_argument("--format", choices=["text", "jsonl", "json", "csv", "tsv"], default="text", help="Output format (default: text)")
+    parser_complete = subparsers.add_parser("complete", help="Complete the beginning of an author name or title")
+    parser_complete.add_argument("prefix", type=str, metavar="PREFIX", help="Beginning of the name or title (case and accents are ignored)")
+    parser_complete.add_argument("--field", choices=["authors", "title"], default="authors", help="Complete author names or titles (default: authors)")
+    parser_complete.add_argument("--limit", type=int, metavar="N", default=10, help="Show the N most frequent completions (default: 10)")
+    parser_complete.add_argument("--show-count", action='store_true', help="Show number of books for each completion")
+    parser_dedupe = subparsers.add_parser("dedupe", help="Find books that are likely duplicates")
+    parser_dedupe.add_argument("--threshold", type=float, metavar="T", default=0.6, help="Minimum similarity of title and authors between 0 and 1 (default: 0.6)")
+    parser_dedupe.add_argument("--merge", action='store_true', help="Merge each duplicate into the book with more metadata")
+    parser_reindex = subparsers.add_parser("reindex", help="Find books with the same ISBN in ISBN-10 and ISBN-13 form")
+    parser_reindex.add_argument("--merge", action='store_true', help="Merge books with the same ISBN into the one with more metadata")
     parser_update = subparsers.add_parser("update", help="Modify book in library")
     parser_update.add_argument("--uuid", type=str, required=True, help="UUID of book in library (required)")
     parser_update.add_argument("--title", type=str, help="Set new title")
@@ -336,6 +783,10 @@ def parse_args(argv):
     parser_import = subparsers.add_parser("import", help="Import data")
     parser_import.add_argument("--json-file", type=str, help="JSON file")
     parser_import.add_argument("--isbn-file", type=str, help="Text file with one isbn per line")
+    parser_import.add_argument("--progress", type=int, default=10000, metavar="N", help="Show progress every N books (0: never, default: 10000)")
+    parser_import.add_argument("--checkpoint-every", type=int, default=100, metavar="N", help="ISBN import: save library after every N imported books (default: 100)")
+    parser_import.add_argument("--checkpoint-seconds", type=float, default=60, metavar="T", help="ISBN import: save library at least every T seconds (default: 60)")
+    parser_import.add_argument("--resume", action='store_true', help="ISBN import: skip the ISBNs processed by an interrupted import")
 
     return parser.parse_args(argv)
 
@@ -344,6 +795,14 @@ if __name__ == "__main__":
     
     # Parse command line arguments
     args = parse_args(sys.argv[1:])
+
+    if args.profile or args.profile_output:
+        profiling.start(args.profile_output)
+        atexit.register(lambda: print(profiling.stop().summary(), file=sys.stderr))
+
+    if args.metrics_file:
+        metrics.enable()
+        atexit.register(lambda: metrics.dump(args.metrics_file))
     
     # Handle command "init"
     if args.command == "init":
@@ -358,6 +817,8 @@ if __name__ == "__main__":
             handle_cli_command_import(args)
         except ValueError as err:
             print(err)
+        except KeyboardInterrupt:
+            sys.exit(130)
         sys.exit(0)
 
     # Handle command "list"
@@ -365,6 +826,26 @@ if __name__ == "__main__":
         handle_cli_command_list(args)
         sys.exit(0)
 
+    # Handle command "search"
+    elif args.command == "search":
+        handle_cli_command_search(args)
+        sys.exit(0)
+
+    # Handle command "complete"
+    elif args.command == "complete":
+        handle_cli_command_complete(args)
+        sys.exit(0)
+
+    # Handle command "dedupe"
+    elif args.command == "dedupe":
+        handle_cli_command_dedupe(args)
+        sys.exit(0)
+
+    # Handle command "reindex"
+    elif args.command == "reindex":
+        handle_cli_command_reindex(args)
+        sys.exit(0)
+
     # Handle command "add"
     elif args.command == "add":
         handle_cli_command_add(args)
@@ -0,0 +1,71 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+from benchmark import generate_library, run_benchmarks, compare, sample_vocabulary, run_parallel_load_benchmark, run_codec_benchmark
+from benchmark import run_isbn_benchmark
+import isbnlib
+
+
+def test_sample_vocabulary():
+    vocabulary = sample_vocabulary()
+    assert "Kepler" in vocabulary["last_names"]
+    assert "mathematics" in vocabulary["keywords"]
+
+
+def test_generate_library():
+    lib = generate_library(500, seed=1)
+    assert len(lib) == 500
+
+    for book in lib:
+        assert book.title and book.authors
+        if book.isbn:
+            assert not isbnlib.notisbn(book.isbn)
+
+    # same seed, same library
+    assert {b.uuid for b in generate_library(50, seed=1)} == {b.uuid for b in generate_library(50, seed=1)}
+
+
+def test_run_benchmarks():
+    results = run_benchmarks(200, repeat=1, memory=True)
+    assert "load" in results
+    assert "import_json" in results
+    assert "load_indexes_warm" in results
+    assert results["save"]["seconds"] > 0
+    assert results["find_all"]["peak_bytes"] > 0
+
+
+def test_compare():
+    baseline = {"1000": {"load": {"seconds": 1.0}, "save": {"seconds": 1.0}}}
+    results = {1000: {"load": {"seconds": 1.1}, "save": {"seconds": 1.5}, "find_all": {"seconds": 1.0}}}
+
+    assert compare(results, baseline, threshold=0.2) == [(1000, "save", 1.5)]
+
+
+def test_run_parallel_load_benchmark():
+    results = run_parallel_load_benchmark(300, [1, 2], repeat=1)
+    assert set(results) == {"parallel_load_1", "parallel_load_2", "parallel_load_jsonl_1", "parallel_load_jsonl_2"}
+
+
+def test_run_codec_benchmark():
+    results = run_codec_benchmark(300, repeat=1)
+    assert {"load_none", "save_none", "load_gzip", "save_xz"} <= set(results)
+    assert results["load_gzip"]["file_bytes"] < results["load_none"]["file_bytes"]
+
+
+def test_run_isbn_benchmark():
+    results = run_isbn_benchmark(300, repeat=1)
+    assert {"isbn_validate_isbnlib", "isbn_validate_batch", "isbn_mask_isbnlib", "isbn_str"} <= set(results)
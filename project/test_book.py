@@ -16,7 +16,7 @@
 
 import pytest
 import datetime
-from book import Book
+from book import Book, normalize, isbn13, _mask_isbn
 
 def test_Book_minimum_meta(mocker):
     
@@ -319,3 +319,86 @@ def test_Book_update():
     assert update_count == 8
     assert book.meta == {'__type__': 'mybooks.Book', 'uuid': '16fd2706-8baf-433b-82eb-8c7fada847da', 'title': 'A modified title', 'authors': ['Author A', 'Author B', 'Author C'], 'publication_date': datetime.date(1990, 1, 31), 
                          'isbn': '9786610326266', 'keywords': {'Apple', 'Banana'}}
+
+
+def test_Book_dirty():
+    book = Book(title="A book title", authors=["Jane M. Doe"], isbn="9791090636071", publication_date="1970-01-31", keywords=["Cat", "Dog"])
+    assert book.dirty == False
+
+    # same values: nothing changed
+    assert book.update(title="A book title", authors=["Jane M. Doe"], isbn="979-10-90636-07-1", publication_date="1970-01-31", keywords=["Dog", "Cat"]) == 0
+    assert book.dirty == False
+
+    book.add_keyword("Cat")
+    assert book.dirty == False
+
+    assert book.update(title="A book title", keywords=["Dog", "Cat", "Mouse"]) == 3
+    assert book.dirty == True
+
+    book.mark_clean()
+    assert book.dirty == False
+    book.add_keyword("Bird")
+    assert book.dirty == True
+
+
+def test_Book_record():
+    book = Book(title="A book title", authors=["Jane M. Doe"], isbn="9791090636071", publication_date="1970-01-31", keywords=["Cat", "Dog"])
+    copy = Book.from_record(book.record)
+    assert copy.meta == book.meta
+    assert not copy.dirty
+
+    book = Book(title="A book title", authors=["Jane M. Doe"])
+    assert Book.from_record(book.record).meta == book.meta
+
+
+def test_normalize():
+    assert normalize("Éléments de Mathématique") == "elements de mathematique"
+    assert normalize("Straße") == "strasse"
+    assert normalize("") == ""
+
+
+def test_Book_search_keys():
+    book = Book(title="Éléments", authors=["Évariste Galois"], keywords=["Algèbre"])
+    assert book.title_key == "elements"
+    assert book.author_keys == ["evariste galois"]
+    assert book.keyword_keys == ["algebre"]
+    assert "title_key" not in book.meta
+
+    book.update(title="Théorie", authors=["Niels Henrik Abel"])
+    assert book.title_key == "theorie"
+    assert book.author_keys == ["niels henrik abel"]
+
+    book.add_keyword("Groupes")
+    assert sorted(book.keyword_keys) == ["algebre", "groupes"]
+
+    assert Book.from_record(book.record).title_key == "theorie"
+
+
+def test_isbn13():
+    assert isbn13("0-306-40615-2") == "9780306406157"
+    assert isbn13("978-0-306-40615-7") == "9780306406157"
+    assert isbn13("979-10-90636-07-1") == "9791090636071"
+    assert isbn13("0-306-40615-3") == "0306406153"
+
+
+def test_Book_isbn13():
+    book = Book(title="A Book", authors=["John Doe"], isbn="0-306-40615-2")
+    assert book.isbn == "0306406152"
+    assert book.isbn13 == "9780306406157"
+
+    book.update(isbn="9791090636071")
+    assert book.isbn13 == "9791090636071"
+
+    assert Book(title="A Book", authors=["John Doe"]).isbn13 is None
+    assert Book.from_record(book.record).isbn13 == "9791090636071"
+
+
+def test_Book_isbn_str():
+    _mask_isbn.cache_clear()
+    book = Book(title="A Book", authors=["John Doe"], isbn="9780306406157")
+    assert book.isbn_str == "978-0-306-40615-7"
+    assert Book(title="Other", authors=["John Doe"], isbn="978-0-306-40615-7").isbn_str == "978-0-306-40615-7"
+
+    # the mask is computed once per ISBN
+    assert _mask_isbn.cache_info().hits == 1
+    assert Book(title="A Book", authors=["John Doe"]).isbn_str is None
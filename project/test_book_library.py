@@ -15,9 +15,19 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import pytest
-from book_library import BookLibraryJSON
+from book_library import BookLibraryJSON, LibraryFileChangedError, ThreadSafeBookLibraryJSON, ReadWriteLock
+from book_library import ShardedBookLibraryJSON, library_for_file, iter_books, CODECS, _iter_json_array, FullTextIndex, CompletionIndex, tokenize
+from book_library import FuzzyIndex, levenshtein, author_key
+from book_library import BitmapIndex, bitmap_from_ordinals, ordinals_from_bitmap, FindCache
 from book import Book
 import datetime
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import threading
 
 @pytest.fixture
 def sample_library():
@@ -168,3 +178,912 @@ def test_BookLibraryJSON_remove(sample_library):
 def test_BookLibraryJSON_write_to_json_file(sample_library):
     raise NotImplementedError
 
+
+
+def test_BookLibraryJSON_write_to_json_file_changed():
+    tmp_lib_name = "temporary_test_library.tmp"
+    shutil.copyfile("sample_library.json", tmp_lib_name)
+
+    lib_a = BookLibraryJSON()
+    lib_a.read_from_json_file(tmp_lib_name)
+    lib_b = BookLibraryJSON()
+    lib_b.read_from_json_file(tmp_lib_name)
+    assert lib_a.etag == lib_b.etag
+
+    # unchanged file is overwritten
+    lib_a.add(Book(title="Book A", authors=["John Doe"]))
+    lib_a.write_to_json_file(tmp_lib_name)
+    assert lib_a.etag != lib_b.etag
+
+    # changed file is not overwritten without replay
+    book_b = Book(title="Book B", authors=["John Doe"])
+    lib_b.add(book_b)
+    with pytest.raises(LibraryFileChangedError):
+        lib_b.write_to_json_file(tmp_lib_name)
+
+    # replay modification on fresh state
+    lib_b.write_to_json_file(tmp_lib_name, replay=lambda lib: lib.add(book_b))
+    assert len(lib_b) == 22
+
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib.find(title="Book ?")) == 2
+    assert lib.etag == lib_b.etag
+
+    os.remove(tmp_lib_name)
+
+
+def _add_books_concurrently(filename, count):
+    for i in range(count):
+        lib = BookLibraryJSON()
+        lib.read_from_json_file(filename)
+        book = Book(title=f"Book {os.getpid()}-{i}", authors=["John Doe"])
+        lib.add(book)
+        lib.write_to_json_file(filename, replay=lambda lib: lib.add(book))
+
+
+def test_BookLibraryJSON_concurrent_processes():
+    tmp_lib_name = "temporary_test_library.tmp"
+    shutil.copyfile("sample_library.json", tmp_lib_name)
+
+    processes = [multiprocessing.Process(target=_add_books_concurrently, args=(tmp_lib_name, 5)) for _ in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+
+    # no lost updates
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib) == 20 + 4 * 5
+
+    os.remove(tmp_lib_name)
+
+
+def test_ReadWriteLock():
+    lock = ReadWriteLock()
+
+    # many readers
+    lock.acquire_read()
+    lock.acquire_read()
+    acquired = threading.Event()
+
+    def writer():
+        with lock.write_locked():
+            acquired.set()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    assert not acquired.wait(0.1)
+
+    lock.release_read()
+    lock.release_read()
+    assert acquired.wait(5)
+    thread.join()
+
+    # writer may reacquire the lock
+    with lock.write_locked():
+        with lock.read_locked():
+            with lock.write_locked():
+                pass
+
+
+def test_ThreadSafeBookLibraryJSON():
+    lib = ThreadSafeBookLibraryJSON()
+    lib.read_from_json_file("sample_library.json")
+    assert len(lib) == 20
+
+    errors = []
+
+    def worker(n):
+        try:
+            for i in range(100):
+                book = Book(title=f"Book {n}-{i}", authors=[f"Author {n}"], keywords=["stress"])
+                assert lib.add(book)
+                assert len(lib.find(keywords=["fake"])) == 10
+                assert lib.find(uuid=book.uuid) == [book]
+                lib.update(book.uuid, title=f"Updated {n}-{i}")
+                assert sum(1 for _ in lib) >= 20
+                if i % 2:
+                    assert lib.remove(book.uuid)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(lib) == 20 + 8 * 50
+    assert len(lib.find(title="Updated *")) == 8 * 50
+    assert len(lib.books) == len(lib)
+
+    # queries building the lazy indexes race with reloading the library
+    # (large enough that building an index takes a while)
+    for i in range(2000):
+        lib.add(Book(title=f"Bulk {i}", authors=[f"Writer {i % 10}"], keywords=["bulk"]))
+    tmp_lib_name = "temporary_test_library.tmp"
+    lib.write_to_json_file(tmp_lib_name)
+    done = threading.Event()
+
+    def reader():
+        try:
+            while not done.is_set():
+                assert lib.count(keywords=["stress"]) == 8 * 50
+                assert len(lib.search("updated", limit=500)) == 8 * 50
+                assert dict(lib.complete("Author", limit=20)) == {f"Author {n}": 50 for n in range(8)}
+                assert len(lib.find(authors=["author 1"], fuzzy=0)) == 50
+                assert len(lib) == 20 + 8 * 50 + 2000
+        except Exception as e:
+            errors.append(e)
+
+    def reloader():
+        try:
+            for _ in range(50):
+                lib.read_from_json_file(tmp_lib_name)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            done.set()
+
+    # switch threads more often to provoke races
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    threads = [threading.Thread(target=reader) for _ in range(6)] + [threading.Thread(target=reloader)]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(switch_interval)
+        os.remove(tmp_lib_name)
+
+    assert not errors
+
+
+def test_ThreadSafeBookLibraryJSON_reload():
+    # lazy indexes are built by the first query after each reload
+    tmp_lib_name = "temporary_test_library.tmp"
+    BookLibraryJSON().write_to_json_file(tmp_lib_name)
+    lib = ThreadSafeBookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    for i in range(3000):
+        lib.add(Book(title=f"Book {i}", authors=[f"Author {i % 10}"], keywords=["all", f"book {i}"]))
+    lib.write_to_json_file(tmp_lib_name)
+
+    errors = []
+    done = threading.Event()
+
+    def reader():
+        try:
+            while not done.is_set():
+                assert len(lib.find(keywords=["all"])) == 3000
+                assert lib.count(authors=["Author 1"]) == 300
+                assert len(lib.find(authors=["author 2"], fuzzy=0)) == 300
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=reader) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    try:
+        for _ in range(30):
+            lib.read_from_json_file(tmp_lib_name)
+    finally:
+        done.set()
+        for thread in threads:
+            thread.join()
+        os.remove(tmp_lib_name)
+
+    assert not errors
+
+
+def test_BookLibraryJSON_dirty():
+    tmp_lib_name = "temporary_test_library.tmp"
+    shutil.copyfile("sample_library.json", tmp_lib_name)
+
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert not lib.is_dirty
+    assert lib.write_to_json_file(tmp_lib_name) == False
+
+    # unchanged values
+    uuid = "23271944-9e47-45d1-a592-9e74b1f562f0"
+    assert lib.update(uuid, title="The Art of Cooking") == 0
+    assert not lib.is_dirty
+
+    assert lib.update(uuid, title="The Art of Baking") == 1
+    assert lib.is_dirty
+    assert [b.uuid for b in lib.changed_books()] == [uuid]
+    assert lib.write_to_json_file(tmp_lib_name) == True
+    assert not lib.is_dirty
+
+    # modification of a book outside of the library is detected, too
+    lib.find(uuid=uuid)[0].add_keyword("baking")
+    assert lib.is_dirty
+    assert lib.write_to_json_file(tmp_lib_name) == True
+
+    lib.remove(uuid)
+    assert lib.removed_uuids == {uuid}
+    assert lib.write_to_json_file(tmp_lib_name) == True
+    assert lib.removed_uuids == set()
+
+    # writing to another file is never skipped
+    assert lib.write_to_json_file(tmp_lib_name + ".copy") == True
+    os.remove(tmp_lib_name + ".copy")
+    os.remove(tmp_lib_name)
+
+
+def test_ShardedBookLibraryJSON(sample_library):
+    tmp_lib_dir = "temporary_test_library_dir.tmp"
+    if os.path.isdir(tmp_lib_dir):
+        shutil.rmtree(tmp_lib_dir)
+
+    lib = ShardedBookLibraryJSON(prefix_length=1)
+    for book in sample_library:
+        lib.add(book)
+    assert lib.write_to_json_file(tmp_lib_dir) == True
+    assert isinstance(library_for_file(tmp_lib_dir), ShardedBookLibraryJSON)
+    assert not isinstance(library_for_file("sample_library.json"), ShardedBookLibraryJSON)
+
+    # load all shards
+    lib = ShardedBookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_dir)
+    assert len(lib) == 20
+    assert len(lib.find(keywords=["fake"])) == 10
+    assert lib.write_to_json_file(tmp_lib_dir) == False
+
+    # load only the shard of a single UUID
+    uuid = "23271944-9e47-45d1-a592-9e74b1f562f0"
+    lib = ShardedBookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_dir, uuids=[uuid])
+    assert lib.loaded_shards == {"2"}
+    assert lib.find(uuid=uuid)[0].title == "The Art of Cooking"
+
+    # only the modified shard is rewritten
+    inodes = {name: os.stat(os.path.join(tmp_lib_dir, name)).st_ino for name in os.listdir(tmp_lib_dir)}
+    assert lib.update(uuid, title="The Art of Baking") == 1
+    assert lib.write_to_json_file(tmp_lib_dir) == True
+    for name, inode in inodes.items():
+        assert (os.stat(os.path.join(tmp_lib_dir, name)).st_ino != inode) == (name == "shard-2.json")
+
+    # books of shards that are not loaded yet are loaded on demand
+    assert lib.remove("ff85c452-def5-4e5c-adde-ff3798766812") == True
+    assert lib.loaded_shards == {"2", "f"}
+    lib.add(Book(title="A new book", authors=["John Doe"], uuid="a0000000-0000-4000-8000-000000000000"))
+    lib.write_to_json_file(tmp_lib_dir)
+
+    lib = ShardedBookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_dir)
+    assert len(lib) == 20
+    assert lib.find(uuid=uuid)[0].title == "The Art of Baking"
+
+    # concurrent modification of a shard
+    lib_a = ShardedBookLibraryJSON()
+    lib_a.read_from_json_file(tmp_lib_dir)
+    lib_b = ShardedBookLibraryJSON()
+    lib_b.read_from_json_file(tmp_lib_dir)
+    lib_a.update(uuid, title="Title A")
+    lib_a.write_to_json_file(tmp_lib_dir)
+    lib_b.remove(uuid)
+    with pytest.raises(LibraryFileChangedError):
+        lib_b.write_to_json_file(tmp_lib_dir)
+    lib_b.write_to_json_file(tmp_lib_dir, replay=lambda lib: lib.remove(uuid))
+    assert len(lib_b) == 19
+    assert not lib_b.is_dirty
+
+    # reloading discards unsaved changes
+    lib_b.add(Book(title="Unsaved", authors=["John Doe"]))
+    lib_b.remove("a0000000-0000-4000-8000-000000000000")
+    lib_b.read_from_json_file(tmp_lib_dir)
+    assert not lib_b.is_dirty
+    assert lib_b.changed_books() == [] and lib_b.removed_uuids == set()
+    assert lib_b.write_to_json_file(tmp_lib_dir) == False
+
+    shutil.rmtree(tmp_lib_dir)
+
+
+def test_ShardedBookLibraryJSON_parallel(sample_library):
+    tmp_lib_dir = "temporary_test_library_dir.tmp"
+    if os.path.isdir(tmp_lib_dir):
+        shutil.rmtree(tmp_lib_dir)
+
+    lib = ShardedBookLibraryJSON(prefix_length=1)
+    for book in sample_library:
+        lib.add(book)
+    lib.write_to_json_file(tmp_lib_dir)
+
+    lib = ShardedBookLibraryJSON(workers=2)
+    lib.read_from_json_file(tmp_lib_dir)
+    assert len(lib) == 20
+    assert {b.uuid: b.meta for b in lib} == {b.uuid: b.meta for b in sample_library}
+    assert lib.write_to_json_file(tmp_lib_dir) == False
+
+    uuid = "23271944-9e47-45d1-a592-9e74b1f562f0"
+    lib.update(uuid, title="The Art of Baking")
+    assert lib.write_to_json_file(tmp_lib_dir) == True
+
+    shutil.rmtree(tmp_lib_dir)
+
+
+def test_BookLibraryJSON_jsonl(sample_library):
+    tmp_lib_name = "temporary_test_library.jsonl"
+    if os.path.isfile(tmp_lib_name):
+        os.remove(tmp_lib_name)
+
+    # written in JSON Lines format: header and one book per line
+    sample_library.write_to_json_file(tmp_lib_name)
+    with open(tmp_lib_name, "rb") as f:
+        content = f.read()
+    assert len(content.splitlines()) == 1 + 20
+    assert content.splitlines()[0] == b'{"__type__":"mybooks.Library","format":"jsonl","version":1}'
+
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert {b.uuid: b.meta for b in lib} == {b.uuid: b.meta for b in sample_library}
+    assert {b.uuid for b in iter_books(tmp_lib_name)} == {b.uuid for b in sample_library}
+
+    # added books are appended
+    book = Book(title="Appended book", authors=["John Doe"])
+    lib.add(book)
+    assert lib.write_to_json_file(tmp_lib_name) == True
+    with open(tmp_lib_name, "rb") as f:
+        appended = f.read()
+    assert appended.startswith(content)
+    assert len(appended.splitlines()) == 1 + 21
+
+    lib2 = BookLibraryJSON()
+    lib2.read_from_json_file(tmp_lib_name)
+    assert len(lib2) == 21
+    assert lib2.etag == lib.etag
+
+    # changed books require rewriting the file, which keeps its format
+    lib.update(book.uuid, title="Changed book")
+    assert lib.write_to_json_file(tmp_lib_name) == True
+    with open(tmp_lib_name, "rb") as f:
+        assert len(f.read().splitlines()) == 1 + 21
+
+    # appending detects concurrent changes
+    lib2.add(Book(title="Another book", authors=["John Doe"]))
+    with pytest.raises(LibraryFileChangedError):
+        lib2.write_to_json_file(tmp_lib_name)
+    assert lib2.write_to_json_file(tmp_lib_name, replay=lambda l: l.add(Book(title="Another book", authors=["John Doe"])))
+    lib2.read_from_json_file(tmp_lib_name)
+    assert len(lib2) == 22
+    assert lib2.find(title="Changed book")
+
+    os.remove(tmp_lib_name)
+
+
+def test_BookLibraryJSON_jsonl_read():
+    tmp_lib_name = "temporary_test_library.tmp"
+
+    # JSON Lines files are detected by their content, the header is optional
+    lines = [Book(title=f"Book {i}", authors=["John Doe"]).as_json for i in range(200)]
+    with open(tmp_lib_name, "wt") as f:
+        f.write("\n".join(lines))
+
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib) == 200
+
+    # missing newline at the end of the file
+    lib.add(Book(title="Appended book", authors=["John Doe"]))
+    lib.write_to_json_file(tmp_lib_name)
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib) == 201
+
+    # parallel decoding of chunks
+    lib = BookLibraryJSON(workers=3)
+    lib.PARALLEL_LOAD_MIN_BYTES = 0
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib) == 201
+
+    with open(tmp_lib_name, "wt") as f:
+        f.write('{"__type__":"mybooks.Library","format":"jsonl","version":2}\n')
+    with pytest.raises(ValueError):
+        BookLibraryJSON().read_from_json_file(tmp_lib_name)
+
+    with open(tmp_lib_name, "wt") as f:
+        f.write(lines[0] + '\n{"title": "no book"}\n')
+    with pytest.raises(ValueError):
+        BookLibraryJSON().read_from_json_file(tmp_lib_name)
+
+    os.remove(tmp_lib_name)
+
+
+@pytest.mark.parametrize("extension", [".json", ".jsonl"])
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_BookLibraryJSON_compressed(sample_library, codec, extension):
+    tmp_lib_name = "temporary_test_library" + extension + CODECS[codec][0]
+    if os.path.isfile(tmp_lib_name):
+        os.remove(tmp_lib_name)
+
+    sample_library.write_to_json_file(tmp_lib_name)
+    with open(tmp_lib_name, "rb") as f:
+        assert f.read().startswith(CODECS[codec][1])
+
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert {b.uuid: b.meta for b in lib} == {b.uuid: b.meta for b in sample_library}
+    assert len(list(iter_books(tmp_lib_name))) == 20
+
+    # appending to compressed JSON Lines files, rewriting compressed JSON files
+    lib.add(Book(title="Added book", authors=["John Doe"]))
+    lib.write_to_json_file(tmp_lib_name)
+    lib2 = BookLibraryJSON()
+    lib2.read_from_json_file(tmp_lib_name)
+    assert len(lib2) == 21
+    assert lib2.etag == lib.etag
+
+    # compression is detected by magic bytes
+    os.replace(tmp_lib_name, "temporary_test_library.tmp")
+    lib.read_from_json_file("temporary_test_library.tmp")
+    assert len(lib) == 21
+    lib.update(lib.find(title="Added book")[0].uuid, title="Changed book")
+    lib.write_to_json_file("temporary_test_library.tmp")
+    with open("temporary_test_library.tmp", "rb") as f:
+        assert f.read().startswith(CODECS[codec][1])
+
+    os.remove("temporary_test_library.tmp")
+
+
+def test_BookLibraryJSON_read_streamed(sample_library, monkeypatch):
+    # JSON files are decoded book by book while reading, not as a whole
+    tmp_lib_name = "temporary_test_library.json.gz"
+    sample_library.write_to_json_file(tmp_lib_name)
+    monkeypatch.setattr(json, "loads", lambda *args, **kwargs: pytest.fail("file decoded as a whole"))
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib) == 20
+    os.remove(tmp_lib_name)
+
+
+def test_iter_json_array(sample_library):
+    with open("sample_library.json", "rb") as f:
+        data = f.read()
+
+    # books spanning several chunks
+    for chunk_size in (1, 7, 1 << 16):
+        books = list(_iter_json_array(io.BufferedReader(io.BytesIO(data)), chunk_size=chunk_size))
+        assert {b.uuid: b.meta for b in books} == {b.uuid: b.meta for b in sample_library}
+
+    assert list(_iter_json_array(io.BufferedReader(io.BytesIO(b" [ ] ")))) == []
+
+    for invalid in (b"", b"[", b'[{"title": "no book"}]', b"{}", data[:-10]):
+        with pytest.raises(ValueError):
+            list(_iter_json_array(io.BufferedReader(io.BytesIO(invalid)), chunk_size=5))
+
+
+def test_BookLibraryJSON_indexes(sample_library):
+    uuid = "23271944-9e47-45d1-a592-9e74b1f562f0"
+    book = sample_library.find(uuid=uuid)[0]
+    assert sample_library.find(uuid=uuid, title="Nothing") == []
+
+    sample_library.update(uuid, isbn="9791090636071")
+    assert sample_library.find(isbn="979-10-90636-07-1") == [book]
+    assert not sample_library.add(Book(title="Same ISBN", authors=["John Doe"], isbn="9791090636071"))
+
+    sample_library.update(uuid, isbn="9780262033848")
+    assert sample_library.find(isbn="9791090636071") == []
+    assert sample_library.add(Book(title="Same ISBN", authors=["John Doe"], isbn="9791090636071"))
+
+    sample_library.remove(uuid)
+    assert sample_library.find(uuid=uuid) == []
+    assert sample_library.find(isbn="9780262033848") == []
+
+
+def test_BookLibraryJSON_book_changed_directly(sample_library):
+    book = sample_library.find(title="Harmonices Mundi")[0]
+    assert book.update(isbn="9780306406157")
+    assert sample_library.find(isbn="0306406152") == [book]
+    assert not sample_library.add(Book(title="Same ISBN", authors=["John Doe"], isbn="9780306406157"))
+    assert sample_library.find(title="Harmonices Mundi", keywords=["music theory"]) == []
+
+    book.add_keyword("music theory")
+    assert sample_library.find(title="Harmonices Mundi", keywords=["music theory"]) == [book]
+
+    # removed books are no longer indexed
+    sample_library.remove(book.uuid)
+    book.update(isbn="9780262033848")
+    assert sample_library.find(isbn="9780262033848") == []
+
+
+def test_BookLibraryJSON_isbn10_isbn13(sample_library):
+    book = Book(title="ISBN-10", authors=["John Doe"], isbn="0-306-40615-2")
+    assert sample_library.add(book)
+
+    # both forms of the ISBN are equivalent
+    assert sample_library.find(isbn="978-0-306-40615-7") == [book]
+    assert sample_library.find(isbn="0306406152") == [book]
+    assert not sample_library.add(Book(title="ISBN-13", authors=["John Doe"], isbn="9780306406157"))
+    assert sample_library.isbn_collisions() == []
+
+    # books stored before both forms were detected
+    other = Book(title="ISBN-13", authors=["John Doe"], isbn="9780306406157")
+    sample_library._add_loaded([other])
+    collisions = sample_library.isbn_collisions()
+    assert len(collisions) == 1
+    assert set(collisions[0]) == {book, other}
+
+    sample_library.update(book.uuid, isbn="9780262033848")
+    assert sample_library.isbn_collisions() == []
+    assert sample_library.find(isbn="0306406152") == [other]
+
+
+def test_tokenize():
+    assert tokenize("Éléments de Mathématique, Vol. 2") == ["elements", "de", "mathematique", "vol", "2"]
+
+
+def test_FullTextIndex():
+    index = FullTextIndex()
+    book1 = Book(title="The cat", authors=["John Doe"], keywords=["cat", "pet"])
+    book2 = Book(title="A dog and a cat", authors=["Jane Doe"], keywords=["dog", "pet"])
+    index.add(book1)
+    index.add(book2)
+
+    assert [uuid for _, uuid in index.search("cat")] == [book1.uuid, book2.uuid]
+    assert [uuid for _, uuid in index.search("dog")] == [book2.uuid]
+    assert len(index.search("doe pet", limit=1)) == 1
+    assert index.search("mouse") == []
+
+    index.remove(book1.uuid)
+    assert [uuid for _, uuid in index.search("cat")] == [book2.uuid]
+
+
+def test_BookLibraryJSON_search(sample_library):
+    assert sample_library.search("Kepler harmonics")[0].title == "Harmonices Mundi"
+    assert len(sample_library.search("mathematics", limit=2)) == 2
+    assert sample_library.search("") == []
+
+    with pytest.raises(ValueError):
+        sample_library.search(None)
+    with pytest.raises(ValueError):
+        sample_library.search("mathematics", limit=-1)
+    assert sample_library.search("mathematics", limit=0) == []
+
+    # index is maintained when the library is modified
+    book = Book(title="Harmonices", authors=["John Doe"])
+    sample_library.add(book)
+    assert book in sample_library.search("harmonices")
+
+    sample_library.update(book.uuid, title="Something else")
+    assert book not in sample_library.search("harmonices")
+    assert sample_library.search("something") == [book]
+
+    sample_library.remove(book.uuid)
+    assert sample_library.search("something") == []
+
+
+def test_CompletionIndex():
+    book1 = Book(title="A", authors=["Jane Doe", "John Doe"])
+    book2 = Book(title="B", authors=["JOHN DOE"])
+    book3 = Book(title="C", authors=["John Doe", "Émile Zola"])
+
+    index = CompletionIndex(lambda book: book.authors)
+    index.add_all([book1, book2])
+    index.add(book3)
+    assert index.complete("j") == [("John Doe", 3), ("Jane Doe", 1)]
+    assert index.complete("j", limit=1) == [("John Doe", 3)]
+    assert index.complete("emi") == [("Émile Zola", 1)]
+    assert index.complete("x") == []
+
+    index.remove(book1.uuid)
+    index.remove(book3.uuid)
+    assert index.complete("j") == [("JOHN DOE", 1)]
+    assert index.complete("e") == []
+
+
+def test_BookLibraryJSON_complete(sample_library):
+    assert sample_library.complete("jo") == [("John Doe", 2), ("Johannes Kepler", 1), ("Joseph-Louis Lagrange", 1)]
+    assert sample_library.complete("EVAR") == [("Évariste Galois", 1)]
+    assert sample_library.complete("harmonices", field="title") == [("Harmonices Mundi", 1)]
+    assert len(sample_library.complete("", limit=3)) == 3
+
+    with pytest.raises(ValueError):
+        sample_library.complete("a", field="keywords")
+    with pytest.raises(ValueError):
+        sample_library.complete(None)
+    with pytest.raises(ValueError):
+        sample_library.complete("jo", limit=-1)
+    assert sample_library.complete("jo", limit=0) == []
+
+    # index is maintained when the library is modified
+    book = Book(title="Harmonices", authors=["Joanna Doe"])
+    sample_library.add(book)
+    assert ("Joanna Doe", 1) in sample_library.complete("jo")
+    assert sample_library.complete("harmonices", field="title") == [("Harmonices", 1), ("Harmonices Mundi", 1)]
+
+    sample_library.update(book.uuid, authors=["John Doe"])
+    assert sample_library.complete("jo")[0] == ("John Doe", 3)
+
+    sample_library.remove(book.uuid)
+    assert sample_library.complete("harmonices", field="title") == [("Harmonices Mundi", 1)]
+
+
+def test_levenshtein():
+    assert levenshtein("kitten", "sitting") == 3
+    assert levenshtein("", "abc") == 3
+    assert levenshtein("abc", "abc") == 0
+    assert levenshtein("abc", "acb") == 2
+
+
+def test_author_key():
+    assert author_key("Kepler, Johannes") == "johannes kepler"
+    assert author_key("  Évariste   Galois ") == "evariste galois"
+
+
+def test_FuzzyIndex(sample_library):
+    index = FuzzyIndex()
+    index.add_all(sample_library.find())
+
+    # same result as comparing with every author
+    for name, distance in [("Jon Do", 2), ("Kepler, Johanes", 1), ("gina right", 1), ("x", 3), ("John Doe", 0)]:
+        expected = {b.uuid for b in sample_library.find()
+                    if any(levenshtein(author_key(name), author_key(a)) <= distance for a in b.authors)}
+        assert index.match(name, distance) == expected
+
+    book = sample_library.find(authors=["Johannes Kepler"])[0]
+    index.remove(book.uuid)
+    assert index.match("Johannes Kepler", 1) == set()
+
+
+def test_bitmap_ordinals():
+    assert bitmap_from_ordinals([0, 3, 17]) == 0b100000000000001001
+    assert bitmap_from_ordinals([]) == 0
+    assert list(ordinals_from_bitmap(0b100000000000001001)) == [0, 3, 17]
+    assert list(ordinals_from_bitmap(0)) == []
+    assert list(ordinals_from_bitmap(bitmap_from_ordinals(range(5, 1000, 7)))) == list(range(5, 1000, 7))
+
+
+def test_BitmapIndex():
+    books = [Book(title=f"Book {i}", authors=["John Doe" if i % 2 else "Jane Doe"],
+                  keywords=["all"] + (["three"] if i % 3 == 0 else []) + [f"book {i}"]) for i in range(300)]
+    index = BitmapIndex()
+    index.add_all(books[:200])
+    for book in books[200:]:
+        index.add(book)
+
+    # frequent values are stored as bitmaps, rare ones as sets
+    assert isinstance(index._postings["keywords"]["all"], int)
+    assert isinstance(index._postings["keywords"]["book 1"], set)
+
+    def titles(bits):
+        return {book.title for book in index.books(bits)}
+
+    assert index.match("keywords", ["all"]).bit_count() == 300
+    assert titles(index.match("keywords", ["book 1", "book 2"])) == {"Book 1", "Book 2"}
+    assert titles(index.match("keywords", ["book 1*"])) == {"Book 1"} | {f"Book {i}" for i in range(10, 20)} | {f"Book {i}" for i in range(100, 200)}
+    assert index.match("keywords", ["three", "book 3"], match_all=True).bit_count() == 1
+    assert index.match("authors", ["John Doe"]).bit_count() == 150
+    assert index.match("authors", ["nobody"]) == 0
+
+    index.remove(books[3].uuid)
+    assert index.match("keywords", ["three", "book 3"], match_all=True) == 0
+    assert index.match("keywords", ["three"]).bit_count() == 99
+
+    # ordinals are reused
+    index.add(books[3])
+    assert index.match("keywords", ["book 3"]).bit_count() == 1
+    assert len(index._books) == 300
+
+
+def test_BookLibraryJSON_count(sample_library):
+    assert sample_library.count() == 20
+    for query in [dict(keywords=["mathematics"]), dict(keywords=["mathematics", "astronomy"], match_all=True),
+                  dict(authors=["John Doe", "*Kepler"]), dict(authors=["*"], keywords=["m*"]),
+                  dict(keywords=["mathematics"], published_before="1700-01-01"), dict(authors=["jon doe"], fuzzy=1),
+                  dict(keywords=["MATHEMATICS"], insensitive=True), dict(keywords=["nothing"])]:
+        assert sample_library.count(**query) == len(sample_library.find(**query))
+
+    assert sample_library.count(keywords=["mathematics"]) == 7
+
+    with pytest.raises(ValueError):
+        sample_library.count(nothing="nothing")
+
+    # bitmaps are maintained when the library is modified
+    book = Book(title="New", authors=["John Doe"], keywords=["mathematics", "new"])
+    sample_library.add(book)
+    assert sample_library.count(keywords=["mathematics"]) == 8
+    assert sample_library.find(keywords=["new"], authors=["John Doe"]) == [book]
+    sample_library.update(book.uuid, keywords=["old"])
+    assert sample_library.find(keywords=["new"]) == []
+    sample_library.remove(book.uuid)
+    assert sample_library.count(keywords=["old"]) == 0
+
+
+@pytest.mark.parametrize("cls", [BookLibraryJSON, ThreadSafeBookLibraryJSON])
+def test_BookLibraryJSON_lazy_indexes_book_changed(cls):
+    lib = cls()
+    lib.read_from_json_file("sample_library.json")
+    book = lib.find(title="Harmonices Mundi")[0]
+
+    # build all lazy indexes
+    assert lib.find(keywords=["harmonics"], authors=["Johannes Kepler"]) == [book]
+    assert lib.find(authors=["Johannes Keppler"], fuzzy=1) == [book]
+    assert lib.search("Harmonices")[0] == book
+    assert lib.complete("harmonices", field="title") == [("Harmonices Mundi", 1)]
+    assert lib.complete("johannes k") == [("Johannes Kepler", 1)]
+
+    book.add_keyword("zzz")
+    assert lib.find(keywords=["zzz"]) == [book]
+    assert lib.count(keywords=["zzz"]) == 1
+
+    book.update(title="Harmonie der Welt", authors=["Jan Kepler"])
+    assert lib.find(authors=["Johannes Kepler"]) == []
+    assert lib.find(authors=["Jan Keppler"], fuzzy=1) == [book]
+    assert lib.search("Harmonices") == []
+    assert lib.search("Harmonie")[0] == book
+    assert lib.complete("harmonices", field="title") == []
+    assert lib.complete("jan k") == [("Jan Kepler", 1)]
+
+
+def test_FindCache_key():
+    assert FindCache.key({"keywords": ["b", "a", "a"], "match_all": False, "title": None}) == (("keywords", ("a", "b")),)
+    assert FindCache.key({"isbn": "0-306-40615-2"}) == FindCache.key({"isbn": "9780306406157"})
+    assert FindCache.key({"authors": ["x"], "fuzzy": 0}) == (("authors", ("x",)), ("fuzzy", 0))
+    assert FindCache.key({"keywords": {"b", "a"}}) == FindCache.key({"keywords": ("a", "b", "a")}) == (("keywords", ("a", "b")),)
+    assert FindCache.key({"keywords": set(), "authors": ()}) == ()
+    assert FindCache.key({}) == ()
+
+
+def test_BookLibraryJSON_find_cache():
+    assert BookLibraryJSON(cache_size=4).find(keywords={"fake"}) == []
+
+    lib = BookLibraryJSON(cache_size=2)
+    lib.read_from_json_file("sample_library.json")
+    assert BookLibraryJSON().cache_stats() is None
+
+    results = lib.find(keywords=["mathematics"])
+    assert lib.find(keywords=["mathematics"]) == results
+    assert lib.find(keywords=["mathematics"], match_all=False) == results
+    assert lib.cache_stats() == {"hits": 2, "misses": 1, "size": 1, "maxsize": 2}
+
+    # the results are copies
+    results.clear()
+    assert len(lib.find(keywords=["mathematics"])) == 7
+
+    # changes invalidate the cache
+    book = Book(title="New", authors=["John Doe"], keywords=["mathematics"])
+    lib.add(book)
+    assert len(lib.find(keywords=["mathematics"])) == 8
+    lib.update(book.uuid, keywords=["physics"])
+    assert len(lib.find(keywords=["mathematics"])) == 7
+    lib.update(book.uuid, keywords=["mathematics"])
+    lib.remove(book.uuid)
+    assert len(lib.find(keywords=["mathematics"])) == 7
+    lib.read_from_json_file("sample_library.json")
+    assert lib.find(keywords=["mathematics"])[0] not in results
+    assert lib.cache_stats()["hits"] == 3
+
+    # least recently used results are dropped
+    lib.find(keywords=["mathematics"])
+    lib.find(keywords=["astronomy"])
+    lib.find(title="*")
+    assert lib.cache_stats()["size"] == 2
+    hits = lib.cache_stats()["hits"]
+    lib.find(title="*")
+    lib.find(keywords=["mathematics"])
+    assert lib.cache_stats()["hits"] == hits + 1
+
+
+def test_BookLibraryJSON_index_file(monkeypatch):
+    tmp_lib_name = "temporary_test_library.tmp"
+    shutil.copyfile("sample_library.json", tmp_lib_name)
+    monkeypatch.setattr(BookLibraryJSON, "INDEX_FILE_MIN_BOOKS", 10)
+
+    def query(lib):
+        return (lib.count(keywords=["mathematics", "astronomy"]), {b.uuid for b in lib.find(authors=["jon doe"], fuzzy=1)},
+                [b.uuid for b in lib.search("mathematics")], lib.complete("j"), lib.complete("the", field="title"))
+
+    # the index file is written when the indexes are built
+    lib = BookLibraryJSON(persist_indexes=True)
+    lib.read_from_json_file(tmp_lib_name)
+    expected = query(lib)
+    astronomy = lib.count(keywords=["astronomy"])
+    assert os.path.exists(tmp_lib_name + ".idx")
+
+    # and loaded instead of rebuilding the indexes while the library file is unchanged
+    with monkeypatch.context() as m:
+        for cls in (FullTextIndex, CompletionIndex, FuzzyIndex, BitmapIndex):
+            m.setattr(cls, "add_all", lambda self, books: pytest.fail("index rebuilt"))
+        lib = ThreadSafeBookLibraryJSON(persist_indexes=True)
+        lib.read_from_json_file(tmp_lib_name)
+        assert query(lib) == expected
+
+        # the loaded indexes are maintained
+        book = Book(title="The Mathematics of Stars", authors=["Jonn Doe"], keywords=["astronomy"])
+        lib.add(book)
+        assert book in lib.find(authors=["jon doe"], fuzzy=1)
+        assert lib.search("stars")[0] is book
+        assert lib.count(keywords=["astronomy"]) == astronomy + 1
+        lib.remove(book.uuid)
+        assert query(lib) == expected
+
+    # changed library files are detected, their indexes are rebuilt
+    lib.add(book)
+    lib.write_to_json_file(tmp_lib_name)
+    lib = BookLibraryJSON(persist_indexes=True)
+    lib.read_from_json_file(tmp_lib_name)
+    assert lib.search("stars")[0].uuid == book.uuid
+    assert lib.count(keywords=["astronomy"]) == astronomy + 1
+    assert lib._stored_indexes.keys() == {"text", "bitmap"}
+
+    # indexes of modified libraries are not stored
+    lib = BookLibraryJSON(persist_indexes=True)
+    lib.read_from_json_file(tmp_lib_name)
+    lib.remove(book.uuid)
+    assert lib.count(keywords=["astronomy"]) == astronomy
+    assert lib.find(authors=["jon doe"], fuzzy=1)
+    lib = BookLibraryJSON(persist_indexes=True)
+    lib.read_from_json_file(tmp_lib_name)
+    assert lib._stored_indexes.keys() == {"text", "bitmap"}
+
+    # truncated or damaged index files are ignored
+    os.truncate(tmp_lib_name + ".idx", os.path.getsize(tmp_lib_name + ".idx") - 100)
+    lib = BookLibraryJSON(persist_indexes=True)
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib._stored_indexes) == 1
+    assert lib.count(keywords=["astronomy"]) == astronomy + 1
+    assert lib.search("stars")[0].uuid == book.uuid
+
+    with open(tmp_lib_name + ".idx", "wb") as f:
+        f.write(b"garbage\n")
+    lib = BookLibraryJSON(persist_indexes=True)
+    lib.read_from_json_file(tmp_lib_name)
+    assert lib.search("stars")[0].uuid == book.uuid
+    os.remove(tmp_lib_name + ".idx")
+
+    # neither libraries without persist_indexes nor small libraries have an index file
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    lib.search("stars")
+    monkeypatch.setattr(BookLibraryJSON, "INDEX_FILE_MIN_BOOKS", 100)
+    lib = library_for_file(tmp_lib_name, persist_indexes=True)
+    lib.read_from_json_file(tmp_lib_name)
+    lib.search("stars")
+    assert not os.path.exists(tmp_lib_name + ".idx")
+    os.remove(tmp_lib_name)
+
+
+def test_BookLibraryJSON_find_fuzzy(sample_library):
+    assert [b.title for b in sample_library.find(authors=["Kepler, Johanes"], fuzzy=1)] == ["Harmonices Mundi"]
+    assert sample_library.find(authors=["Kepler, Johanes"], fuzzy=0) == []
+    assert len(sample_library.find(authors=["jon doe"], fuzzy=1)) == 2
+    assert len(sample_library.find(authors=["jon doe", "Paula Robert"], fuzzy=1, match_all=True)) == 1
+    assert len(sample_library.find(authors=["jon doe"], fuzzy=1, published_before="1000-01-01")) == 0
+
+    with pytest.raises(ValueError):
+        sample_library.find(authors=["John Doe"], fuzzy=-1)
+    with pytest.raises(ValueError):
+        sample_library.find(authors=["John Doe"], fuzzy="1")
+
+    # index is maintained when the library is modified
+    book = Book(title="Harmonices", authors=["Joanna Dough"])
+    sample_library.add(book)
+    assert book in sample_library.find(authors=["Joana Doug"], fuzzy=2)
+    sample_library.update(book.uuid, authors=["Someone Else"])
+    assert book not in sample_library.find(authors=["Joana Doug"], fuzzy=2)
+    assert sample_library.find(authors=["someone else"], fuzzy=0) == [book]
+
+
+def test_BookLibraryJSON_find_insensitive(sample_library):
+    assert sample_library.find(title="elements*") == []
+    assert [b.title for b in sample_library.find(title="elements*", insensitive=True)] == ["Éléments de mathématique"]
+    assert len(sample_library.find(authors=["EVARISTE *"], insensitive=True)) == 1
+    assert len(sample_library.find(authors=["évariste galois", "johannes kepler"], insensitive=True)) == 2
+    assert len(sample_library.find(authors=["évariste galois", "johannes kepler"], match_all=True, insensitive=True)) == 0
+    assert len(sample_library.find(keywords=["MATHEMATICS"], insensitive=True)) == len(sample_library.find(keywords=["mathematics"]))
+    assert len(sample_library.find(keywords=["mathematics"], published_before="1700-01-01", insensitive=True)) == len(sample_library.find(keywords=["mathematics"], published_before="1700-01-01"))
+    assert len(sample_library.find(title="*", insensitive=True)) == 20
+
+    # keys are updated with the book
+    uuid = "23271944-9e47-45d1-a592-9e74b1f562f0"
+    sample_library.update(uuid, title="Über Bücher")
+    assert [b.uuid for b in sample_library.find(title="uber bucher", insensitive=True)] == [uuid]
+    assert sample_library.search("bücher")[0].uuid == uuid
@@ -0,0 +1,126 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+import datetime
+import itertools
+from book import Book
+from book_library import BookLibraryJSON
+from dedupe import shingles, jaccard, MinHash, find_duplicates, merge_duplicates, merge_isbn_collisions
+
+
+@pytest.fixture
+def sample_library():
+    lib = BookLibraryJSON()
+    lib.read_from_json_file("sample_library.json")
+    return lib
+
+
+def test_shingles():
+    book = Book(title="Harmonices Mundi", authors=["Johannes Kepler"])
+    assert "harm" in shingles(book)
+    assert "mund" in shingles(book)
+
+    # case, accents and "Last, First" order are ignored
+    other = Book(title="HARMONICES MÜNDI", authors=["Kepler, Johannes"])
+    assert shingles(other) == shingles(book)
+
+    assert shingles(Book(title="", authors=["A"])) == frozenset([" a"])
+
+
+def test_jaccard():
+    assert jaccard({1, 2}, {2, 3}) == 1 / 3
+    assert jaccard(set(), set()) == 1.0
+
+
+def test_MinHash():
+    minhash = MinHash(16)
+    a = shingles(Book(title="Harmonices Mundi", authors=["Johannes Kepler"]))
+    b = shingles(Book(title="Harmonices Mundi Libri V", authors=["Johannes Kepler"]))
+
+    signature = minhash.signature(a)
+    assert len(signature) == 16
+    assert signature == MinHash(16).signature(a)
+
+    # fraction of equal values estimates the similarity
+    minhash = MinHash(256)
+    estimate = sum(x == y for x, y in zip(minhash.signature(a), minhash.signature(b))) / 256
+    assert abs(estimate - jaccard(a, b)) < 0.15
+
+
+def test_find_duplicates(sample_library):
+    books = sample_library.find()
+    assert find_duplicates(books) == []
+
+    copy = Book(title="Harmonices mundi libri V", authors=["Kepler, Johannes"])
+    books.append(copy)
+    duplicates = find_duplicates(books)
+    assert len(duplicates) == 1
+    similarity, book, other = duplicates[0]
+    assert book.title == "Harmonices Mundi" and other is copy
+    assert 0.6 <= similarity < 1
+
+    assert find_duplicates(books, threshold=0.9) == []
+
+    with pytest.raises(ValueError):
+        find_duplicates(books, num_perm=30, bands=8)
+    with pytest.raises(ValueError):
+        find_duplicates(books, threshold=2)
+
+
+def test_find_duplicates_candidates():
+    # LSH finds (nearly) all pairs found by comparing all pairs
+    books = [Book(title=f"{word} of the {other}", authors=[f"Author {i % 7}"])
+             for i, (word, other) in enumerate(itertools.product(["Kingdom", "Kingdoms", "Garden", "History"], ["Stars", "Star", "Sea"]))]
+    expected = {(a.uuid, b.uuid) for a, b in itertools.combinations(books, 2) if jaccard(shingles(a), shingles(b)) >= 0.8}
+    found = {(a.uuid, b.uuid) for _, a, b in find_duplicates(books, threshold=0.8)}
+    assert found <= expected
+    assert len(found) >= 0.9 * len(expected)
+
+
+def test_merge_duplicates(sample_library):
+    book = sample_library.find(title="Harmonices Mundi")[0]
+    copy = Book(title="Harmonices mundi libri V", authors=["Kepler, Johannes"], isbn="9780871692092",
+                keywords=["music"])
+    sample_library.add(copy)
+    keywords = set(book.keywords)
+
+    assert merge_duplicates(sample_library, [(book.uuid, copy.uuid)]) == [(copy.uuid, book.uuid)]
+    assert sample_library.find(title="Harmonices*") == [copy]
+
+    # the book with the ISBN is kept and completed
+    assert copy.publication_date == datetime.date(1619, 1, 1)
+    assert set(copy.keywords) == {"music"} | set(keywords)
+    assert sample_library.find(isbn="9780871692092") == [copy]
+
+    # pairs with removed books are skipped
+    assert merge_duplicates(sample_library, [(book.uuid, copy.uuid)]) == []
+
+
+def test_merge_isbn_collisions(sample_library):
+    books = [Book(title="ISBN-10", authors=["John Doe"], isbn="0-306-40615-2", keywords=["ten"]),
+             Book(title="ISBN-13", authors=["John Doe"], isbn="9780306406157", publication_date="2000-01-01"),
+             Book(title="Copy", authors=["John Doe"], isbn="0306406152")]
+    sample_library._add_loaded(books)
+
+    merged = merge_isbn_collisions(sample_library)
+    assert len(merged) == 2
+    assert sample_library.isbn_collisions() == []
+
+    book = sample_library.find(isbn="0306406152")[0]
+    assert book is books[1]
+    assert set(book.keywords) == {"ten"}
+    assert merge_isbn_collisions(sample_library) == []
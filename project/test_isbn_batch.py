@@ -0,0 +1,79 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+import random
+import isbnlib
+import isbn_batch
+from isbn_batch import canonical_isbn, canonical_isbns, iter_canonical_isbns
+
+
+def isbn_like_values(count=5000, seed=1):
+    """ Valid, invalid and garbled ISBNs """
+    rnd = random.Random(seed)
+    values = ["0000000000", "000000000X", "0000000000000", "123456789X", "12345678x", "123456789x",
+              "978123456789X", "²" * 10, "9780306406157x", "", "ISBN 978-0-306-40615-7", "0-306-40615-2\n"]
+    for _ in range(count):
+        choice = rnd.random()
+        if choice < 0.3:
+            value = "97" + rnd.choice("789") + "".join(rnd.choice("0123456789") for _ in range(9))
+            value += isbnlib.check_digit13(value) if rnd.random() < 0.7 else rnd.choice("0123456789")
+        elif choice < 0.5:
+            value = "".join(rnd.choice("0123456789") for _ in range(9))
+            value += isbnlib.check_digit10(value) if rnd.random() < 0.7 else rnd.choice("0123456789X")
+        else:
+            value = "".join(rnd.choice("0123456789X-x a9") for _ in range(rnd.randint(0, 18)))
+        if rnd.random() < 0.3 and len(value) > 3:
+            i = rnd.randint(1, len(value) - 1)
+            value = value[:i] + rnd.choice("- ") + value[i:]
+        values.append(value)
+    return values
+
+
+def test_canonical_isbn():
+    assert canonical_isbn("978-0-306-40615-7") == "9780306406157"
+    assert canonical_isbn("0-306-40615-2") == "0306406152"
+    assert canonical_isbn("0-9752298-0-x") == "097522980X"
+    assert canonical_isbn("978-0-306-40615-8") is None
+    assert canonical_isbn("123-0-306-40615-7") is None
+
+    for value in isbn_like_values():
+        expected = isbnlib.canonical(value) if not isbnlib.notisbn(value) else None
+        assert canonical_isbn(value) == expected, value
+
+
+def test_canonical_isbns():
+    assert canonical_isbns(["978-0785839781", "ISBN 1494745429", "no ISBN", "9780785839782"]) == \
+        ["9780785839781", "1494745429", None, None]
+
+    values = isbn_like_values()
+    assert canonical_isbns(values, use_numpy=False) == [isbnlib.get_canonical_isbn(value) or None for value in values]
+
+
+def test_canonical_isbns_numpy():
+    if isbn_batch.numpy is None:
+        with pytest.raises(ValueError):
+            canonical_isbns(["9780785839781"], use_numpy=True)
+        pytest.skip("NumPy is not installed")
+
+    values = isbn_like_values()
+    assert canonical_isbns(values, use_numpy=True) == canonical_isbns(values, use_numpy=False)
+
+
+def test_iter_canonical_isbns():
+    values = isbn_like_values(100)
+    assert list(iter_canonical_isbns(values, chunk_size=7)) == canonical_isbns(values)
+    assert list(iter_canonical_isbns([])) == []
@@ -0,0 +1,121 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+import metrics
+import json
+import os
+from book import Book
+from book_library import BookLibraryJSON, ShardedBookLibraryJSON
+
+
+@pytest.fixture
+def registry():
+    yield metrics.enable()
+    metrics.disable()
+
+
+def test_disabled():
+    assert not metrics.enabled()
+    metrics.inc("foo")
+    metrics.observe("bar", 1.0)
+    with metrics.timer("baz"):
+        pass
+    assert metrics.registry() is None
+
+
+def test_Registry(registry):
+    metrics.inc("requests_total", method="get")
+    metrics.inc("requests_total", 2, method="get")
+    metrics.set_gauge("books", 42)
+    metrics.observe("latency_seconds", 0.0002)
+    metrics.observe("latency_seconds", 20)
+
+    assert registry.counters[("requests_total", (("method", "get"),))] == 3
+
+    text = registry.as_prometheus()
+    assert '# TYPE requests_total counter\nrequests_total{method="get"} 3\n' in text
+    assert "books 42\n" in text
+    assert 'latency_seconds_bucket{le="0.0001"} 0\n' in text
+    assert 'latency_seconds_bucket{le="0.0005"} 1\n' in text
+    assert 'latency_seconds_bucket{le="+Inf"} 2\n' in text
+    assert "latency_seconds_count 2\n" in text
+
+    data = registry.as_dict()
+    assert data["gauges"] == [{"name": "books", "labels": {}, "value": 42}]
+    assert data["histograms"][0]["count"] == 2
+
+
+def test_library_metrics(registry):
+    lib = BookLibraryJSON()
+    lib.read_from_json_file("sample_library.json")
+    lib.find(keywords=["fake"], match_all=True)
+    lib.find(authors=["John Doe"])
+
+    assert registry.gauges[("mybooks_books", ())] == 20
+    assert registry.histograms[("mybooks_find_seconds", (("filters", "keywords+match_all"),))].count == 1
+    assert registry.histograms[("mybooks_find_seconds", (("filters", "authors"),))].count == 1
+
+    # entries of the indexes are recorded when they are built and changed
+    assert registry.gauges[("mybooks_index_entries", (("index", "uuid"),))] == 20
+    assert ("mybooks_index_entries", (("index", "text"),)) not in registry.gauges
+    lib.search("mathematics")
+    terms = registry.gauges[("mybooks_index_entries", (("index", "text"),))]
+    assert terms > 0
+    lib.add(Book(title="Zymurgy", authors=["John Doe"], isbn="9780306406157"))
+    assert registry.gauges[("mybooks_index_entries", (("index", "uuid"),))] == 21
+    assert registry.gauges[("mybooks_index_entries", (("index", "text"),))] == terms + 1
+    assert registry.gauges[("mybooks_books", ())] == 21
+
+    # shards do not overwrite the gauges of the whole library
+    sharded = ShardedBookLibraryJSON()
+    for uuid in ("a0000000-0000-4000-8000-000000000000", "b0000000-0000-4000-8000-000000000000"):
+        sharded.add(Book(title="Sharded", authors=["John Doe"], uuid=uuid))
+    assert registry.gauges[("mybooks_books", ())] == 2
+    assert registry.gauges[("mybooks_index_entries", (("index", "uuid"),))] == 2
+
+    tmp_lib_name = "temporary_test_library.tmp"
+    lib.write_to_json_file(tmp_lib_name)
+    assert registry.counters[("mybooks_save_bytes_total", ())] == os.path.getsize(tmp_lib_name)
+    os.remove(tmp_lib_name)
+
+
+def test_fetch_metrics(registry, mocker):
+    meta = mocker.patch('isbnlib.meta', return_value={'Title': "A Title", 'Authors': ['John Doe'], 'Year': 1970})
+
+    Book.from_isbn("9786610326266")
+    Book.from_isbn("978-6610326266")
+    assert meta.call_count == 2
+    assert registry.histograms[("mybooks_fetch_seconds", ())].count == 2
+
+    mocker.patch('isbnlib.meta', side_effect=ConnectionError())
+    with pytest.raises(ConnectionError):
+        Book.from_isbn("9791090636071")
+    assert registry.counters[("mybooks_fetch_errors_total", (("error", "ConnectionError"),))] == 1
+
+
+def test_dump(registry):
+    metrics.inc("requests_total")
+
+    metrics.dump("temporary_test_metrics.tmp")
+    with open("temporary_test_metrics.tmp") as f:
+        assert "requests_total 1" in f.read()
+
+    metrics.dump("temporary_test_metrics.tmp", "json")
+    with open("temporary_test_metrics.tmp") as f:
+        assert json.load(f)["counters"][0]["value"] == 1
+
+    os.remove("temporary_test_metrics.tmp")
@@ -0,0 +1,73 @@
+# MyBooks - A simple book library software
+# Copyright (C) 2024  Oliver Arp
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import pytest
+import profiling
+import pstats
+import os
+import time
+from book_library import BookLibraryJSON
+
+
+def test_phase_disabled():
+    assert profiling.phase("load") is profiling.phase("query")
+
+    with profiling.phase("load") as p:
+        p.add_count(5)
+
+
+def test_start_stop():
+    profiling.start()
+
+    lib = BookLibraryJSON()
+    lib.read_from_json_file("sample_library.json")
+    lib.find(keywords=["fake"])
+    lib.find()
+
+    profiler = profiling.stop()
+    assert profiler.phases["decode"][2] == 20
+    assert profiler.phases["query"][1] == 2
+    assert profiler.phases["query"][2] == 30
+    assert "decode" in profiler.summary()
+
+    # disabled again
+    assert profiling.phase("load") is profiling.phase("query")
+
+
+def test_nested_phases():
+    profiler = profiling.start()
+    with profiling.phase("query") as p:
+        p.add_count(1)
+        with profiling.phase("load index"):
+            time.sleep(0.05)
+    profiling.stop()
+
+    # time of the inner phase is not counted twice
+    assert profiler.phases["load index"][0] >= 0.05
+    assert profiler.phases["query"][0] < 0.05
+    assert profiler.phases["query"][2] == 1
+
+
+def test_start_stop_cprofile():
+    stats_file = "temporary_test_stats.tmp"
+
+    profiling.start(stats_file)
+    BookLibraryJSON().read_from_json_file("sample_library.json")
+    profiling.stop()
+
+    assert os.path.isfile(stats_file)
+    assert pstats.Stats(stats_file).total_calls > 0
+    os.remove(stats_file)
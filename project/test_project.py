@@ -22,10 +22,24 @@ from project import handle_cli_command_list
 from project import handle_cli_command_add
 from project import handle_cli_command_delete
 from project import handle_cli_command_update
+from project import handle_cli_command_search
+from project import handle_cli_command_complete
+from project import handle_cli_command_dedupe
+from project import handle_cli_command_reindex
+from project import select_books
+from project import write_lines
+from project import SORT_KEYS
+from project import format_record_lines
+from project import ProgressLine
 from book_library import BookLibraryJSON
+from book import Book
 import argparse
+import csv
+import io
+import json
 import os
 import shutil
+import sys
 
 def test_parse_args():
     argv = ['--file', 'foo.json', 'init']
@@ -34,6 +48,14 @@ def test_parse_args():
 
     assert args.command == 'init'
     assert args.file == 'foo.json'
+    assert args.profile == False
+
+    args = parse_args(['--profile', '--profile-output', 'stats.prof', 'list'])
+    assert args.profile == True
+    assert args.profile_output == 'stats.prof'
+
+    args = parse_args(['--workers', '4', 'list'])
+    assert args.workers == 4
 
     # missing command argument
     argv = ['--file', 'foo.json']
@@ -76,6 +98,24 @@ def test_parse_args_list():
     assert args.uuid == '23271944-9e47-45d1-a592-9e74b1f562f0'
     assert args.show_uuid == True
 
+    argv = ['list', '--limit', '10', '--offset', '20']
+    args = parse_args(argv)
+    assert args.limit == 10
+    assert args.offset == 20
+    assert args.sort == 'date'
+    assert args.reverse == False
+
+    argv = ['list', '--sort', 'title', '--reverse']
+    args = parse_args(argv)
+    assert args.sort == 'title'
+    assert args.reverse == True
+
+    with pytest.raises(SystemExit):
+        parse_args(['list', '--sort', 'color'])
+
+    args = parse_args(['list', '--format', 'csv'])
+    assert args.format == 'csv'
+
 def test_parse_args_add():
     argv = ['add', '--title', 'A Title', '--isbn', '123-4567890', '--keywords', 'cat', 'dog', '--authors', 'Jane Doe', 'John Doe',  
             '--publication-date', '2020-01-01',  '--fetch-meta']
@@ -140,6 +180,14 @@ def test_handle_cli_command_init(monkeypatch):
 
     os.remove(tmp_lib_name)
 
+    # sharded library
+    args.file = "temporary_test_library_dir.tmp"
+    args.force = True
+    args.sharded = True
+    assert handle_cli_command_init(args) == True
+    assert os.path.isfile(os.path.join(args.file, "manifest.json"))
+    shutil.rmtree(args.file)
+
 
 
 def test_handle_cli_command_import(mocker):
@@ -175,6 +223,11 @@ def test_handle_cli_command_import(mocker):
     num_imported = handle_cli_command_import(args)
     assert num_imported == 20
 
+    # importing the same books again does not rewrite the library file
+    mtime = os.stat(tmp_lib_name).st_mtime_ns
+    assert handle_cli_command_import(args) == 0
+    assert os.stat(tmp_lib_name).st_mtime_ns == mtime
+
     # Test case --import-isbn
     # resuse test library from previous test
     args.json_file = None
@@ -188,6 +241,141 @@ def test_handle_cli_command_import(mocker):
         os.remove(tmp_lib_name)
 
 
+def test_handle_cli_command_import_isbn_resume(mocker):
+    tmp_lib_name = "temporary_test_library.jsonl"
+    progress_name = "sample_isbns.txt.progress"
+    for name in (tmp_lib_name, progress_name):
+        if os.path.isfile(name):
+            os.remove(name)
+
+    args = argparse.Namespace(file=tmp_lib_name, force=True)
+    handle_cli_command_init(args)
+
+    # network failure while fetching the 6th ISBN
+    meta = {'Title': "A Title", 'Authors': ['John Doe'], 'Year': 1970}
+    mocker.patch('isbnlib.meta', side_effect=[meta] * 5 + [ConnectionError()])
+
+    args = argparse.Namespace(file=tmp_lib_name, json_file=None, isbn_file='sample_isbns.txt',
+                              checkpoint_every=2, checkpoint_seconds=0, resume=False)
+    with pytest.raises(ConnectionError):
+        handle_cli_command_import(args)
+
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib) == 5
+    with open(progress_name, "rt") as f:
+        assert json.load(f)["lines"] == 5
+
+    # resumed import fetches the remaining ISBNs only
+    isbnlib_meta = mocker.patch('isbnlib.meta', return_value=meta)
+    args.resume = True
+    assert handle_cli_command_import(args) == 4
+    assert isbnlib_meta.call_count == 4
+    assert not os.path.exists(progress_name)
+
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib) == 9
+
+    os.remove(tmp_lib_name)
+
+
+def test_handle_cli_command_list_insensitive(capsys):
+    args = parse_args(['--file', 'sample_library.json', 'list', '--authors', 'evariste*', '--insensitive', '--bare'])
+    assert args.insensitive == True
+    assert handle_cli_command_list(args) == 1
+    assert "Galois" in capsys.readouterr().out
+
+
+def test_handle_cli_command_list_count(capsys):
+    args = parse_args(['--file', 'sample_library.json', 'list', '--keywords', 'mathematics', '--count'])
+    assert handle_cli_command_list(args) == 7
+    assert capsys.readouterr().out == "7\n"
+
+
+def test_handle_cli_command_list_fuzzy(capsys):
+    args = parse_args(['--file', 'sample_library.json', 'list', '--authors', 'Kepler, Johanes', '--fuzzy', '1', '--bare'])
+    assert args.fuzzy == 1
+    assert handle_cli_command_list(args) == 1
+    assert "Harmonices Mundi" in capsys.readouterr().out
+
+
+def test_handle_cli_command_search(capsys):
+    args = parse_args(['--file', 'sample_library.json', 'search', 'Kepler', 'harmonics', '--limit', '3', '--bare'])
+    assert args.query == ['Kepler', 'harmonics']
+
+    assert handle_cli_command_search(args) == 1
+    assert capsys.readouterr().out == ' Johannes Kepler, "Harmonices Mundi" (1619)\n'
+
+    args = parse_args(['--file', 'sample_library.json', 'search', 'mathematics', '--format', 'jsonl'])
+    assert handle_cli_command_search(args) == 7
+    assert len(capsys.readouterr().out.splitlines()) == 7
+
+    args = parse_args(['--file', 'sample_library.json', 'search', 'the', '--limit', '0'])
+    assert handle_cli_command_search(args) == 0
+    assert capsys.readouterr().out == ""
+
+    args = parse_args(['--file', 'sample_library.json', 'search', 'the', '--limit', '-1'])
+    assert handle_cli_command_search(args) == 0
+    assert "negative" in capsys.readouterr().out
+
+
+def test_handle_cli_command_complete(capsys):
+    args = parse_args(['--file', 'sample_library.json', 'complete', 'jo', '--show-count'])
+    assert args.field == "authors"
+    assert handle_cli_command_complete(args) == 3
+    assert capsys.readouterr().out == "John Doe (2)\nJohannes Kepler (1)\nJoseph-Louis Lagrange (1)\n"
+
+    args = parse_args(['--file', 'sample_library.json', 'complete', 'the', '--field', 'title', '--limit', '2'])
+    assert handle_cli_command_complete(args) == 2
+    assert len(capsys.readouterr().out.splitlines()) == 2
+
+    args = parse_args(['--file', 'sample_library.json', 'complete', 'jo', '--limit', '0'])
+    assert handle_cli_command_complete(args) == 0
+    assert capsys.readouterr().out == ""
+
+    args = parse_args(['--file', 'sample_library.json', 'complete', 'jo', '--limit', '-1'])
+    assert handle_cli_command_complete(args) == 0
+    assert "negative" in capsys.readouterr().out
+
+
+def test_ProgressLine():
+    stream = io.StringIO()
+    progress = ProgressLine(2, "{count} read, {imported} imported", stream)
+    for count in range(1, 6):
+        progress.update(count, imported=count - 1)
+    progress.close()
+    assert stream.getvalue() == "\r2 read, 1 imported\r4 read, 3 imported\n"
+
+    stream = io.StringIO()
+    progress = ProgressLine(0, "{count}", stream)
+    progress.update(10)
+    progress.close()
+    assert stream.getvalue() == ""
+
+
+def test_handle_cli_command_import_jsonl():
+    tmp_lib_name = "temporary_test_library.jsonl"
+    tmp_import_name = "temporary_test_library.tmp"
+
+    # JSON Lines library file created by init
+    args = argparse.Namespace(file=tmp_lib_name, force=True)
+    assert handle_cli_command_init(args) == True
+    with open(tmp_lib_name, "rt") as f:
+        assert f.read().startswith('{"__type__":"mybooks.Library"')
+
+    # import of the sample library is appended to the file
+    args = argparse.Namespace(file=tmp_lib_name, json_file='sample_library.json', isbn_file=None)
+    assert handle_cli_command_import(args) == 20
+
+    # import from a JSON Lines file
+    shutil.copyfile(tmp_lib_name, tmp_import_name)
+    args = argparse.Namespace(file=tmp_lib_name, json_file=tmp_import_name, isbn_file=None)
+    assert handle_cli_command_import(args) == 0
+
+    os.remove(tmp_lib_name)
+    os.remove(tmp_import_name)
+
+
 
 
 def test_handle_cli_command_list():
@@ -546,6 +734,11 @@ def test_handle_cli_command_update():
     
     assert handle_cli_command_update(args) == True
 
+    # same values again: nothing changed, file not rewritten
+    mtime = os.stat(tmp_lib_name).st_mtime_ns
+    assert handle_cli_command_update(args) == False
+    assert os.stat(tmp_lib_name).st_mtime_ns == mtime
+
 
 #     args = argparse.Namespace()
 #     args.file = tmp_lib_name
@@ -598,3 +791,131 @@ def test_handle_cli_command_delete():
 
     assert os.path.isfile(tmp_lib_name)
     os.remove(tmp_lib_name)
+
+
+def test_handle_cli_command_dedupe(capsys, mocker):
+    tmp_lib_name = "temporary_test_library.tmp"
+    lib = BookLibraryJSON()
+    lib.read_from_json_file("sample_library.json")
+    lib.add(Book(title="Harmonices mundi libri V", authors=["Kepler, Johannes"]))
+    lib.write_to_json_file(tmp_lib_name)
+
+    args = parse_args(['--file', tmp_lib_name, 'dedupe'])
+    assert args.threshold == 0.6 and not args.merge
+    assert handle_cli_command_dedupe(args) == 1
+    output = capsys.readouterr().out
+    assert "Harmonices Mundi" in output and "Harmonices mundi libri V" in output
+
+    args = parse_args(['--file', tmp_lib_name, 'dedupe', '--merge'])
+    assert handle_cli_command_dedupe(args) == 1
+    assert "Merged 1 duplicates." in capsys.readouterr().out
+
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib) == 20
+    assert handle_cli_command_dedupe(args) == 0
+
+    # a threshold of 0 is passed on
+    find = mocker.patch('project.find_duplicates', return_value=[])
+    args = parse_args(['--file', tmp_lib_name, 'dedupe', '--threshold', '0'])
+    assert handle_cli_command_dedupe(args) == 0
+    assert find.call_args.kwargs["threshold"] == 0
+
+    os.remove(tmp_lib_name)
+
+
+def test_handle_cli_command_reindex(capsys):
+    tmp_lib_name = "temporary_test_library.tmp"
+    lib = BookLibraryJSON()
+    lib.read_from_json_file("sample_library.json")
+    lib._add_loaded([Book(title="ISBN-10", authors=["John Doe"], isbn="0-306-40615-2"),
+                     Book(title="ISBN-13", authors=["John Doe"], isbn="9780306406157")])
+    lib.write_to_json_file(tmp_lib_name)
+
+    args = parse_args(['--file', tmp_lib_name, 'reindex'])
+    assert handle_cli_command_reindex(args) == 1
+    assert "ISBN 9780306406157: 2 books" in capsys.readouterr().out
+
+    args = parse_args(['--file', tmp_lib_name, 'reindex', '--merge'])
+    assert handle_cli_command_reindex(args) == 1
+    assert "Merged 1 duplicates." in capsys.readouterr().out
+
+    lib = BookLibraryJSON()
+    lib.read_from_json_file(tmp_lib_name)
+    assert len(lib) == 21
+    assert handle_cli_command_reindex(args) == 0
+
+    os.remove(tmp_lib_name)
+
+
+def test_select_books():
+    books = [5, 3, 9, 1, 7]
+
+    assert select_books(books, key=lambda b: b) == [1, 3, 5, 7, 9]
+    assert select_books(books, key=lambda b: b, reverse=True) == [9, 7, 5, 3, 1]
+    assert select_books(books, key=lambda b: b, limit=2) == [1, 3]
+    assert select_books(books, key=lambda b: b, reverse=True, offset=1, limit=2) == [7, 5]
+    assert select_books(books, key=lambda b: b, offset=3) == [7, 9]
+    assert select_books(books, key=lambda b: b, offset=10, limit=2) == []
+
+    with pytest.raises(ValueError):
+        select_books(books, key=lambda b: b, limit=-1)
+
+
+def test_write_lines(capsys):
+    lines = (f"line {i}\n" for i in range(25))
+    assert write_lines(lines, sys.stdout, batch_size=10) == 25
+
+    captured = capsys.readouterr()
+    assert captured.out.splitlines() == [f"line {i}" for i in range(25)]
+
+    class ClosedPipe(io.StringIO):
+        def write(self, s):
+            raise BrokenPipeError()
+
+    assert write_lines(["a\n", "b\n"], ClosedPipe(), batch_size=1) == 0
+
+
+def test_SORT_KEYS():
+    lib = BookLibraryJSON()
+    lib.read_from_json_file('sample_library.json')
+    lib.add(Book(title="an undated book", authors=["aaron Aardvark"]))
+
+    key, reverse = SORT_KEYS["date"]
+    books = select_books(lib, key=key, reverse=reverse, limit=3)
+    assert books[0].publication_date == None
+    assert books[1].publication_date >= books[2].publication_date
+
+    key, reverse = SORT_KEYS["title"]
+    titles = [b.title for b in select_books(lib, key=key, reverse=reverse)]
+    assert titles == sorted(titles, key=str.casefold)
+
+    key, reverse = SORT_KEYS["author"]
+    assert select_books(lib, key=key, reverse=reverse, limit=1)[0].title == "an undated book"
+
+    key, reverse = SORT_KEYS["isbn"]
+    books = select_books(lib, key=key, reverse=reverse)
+    assert books[0].isbn and not books[-1].isbn
+
+
+def test_format_record_lines():
+    book = Book(title='A "quoted", title', authors=["A", "B", "C", "D"], publication_date="1970-01-31", isbn="9791090636071",
+                keywords=["Dog", "Cat"], uuid='16fd2706-8baf-433b-82eb-8c7fada847da')
+
+    lines = list(format_record_lines([book], "jsonl"))
+    assert len(lines) == 1
+    assert json.loads(lines[0]) == {"__type__": "mybooks.Book", "uuid": "16fd2706-8baf-433b-82eb-8c7fada847da", "title": 'A "quoted", title',
+                                    "authors": ["A", "B", "C", "D"], "publication_date": "1970-01-31", "isbn": "9791090636071", "keywords": ["Cat", "Dog"]}
+
+    assert json.loads("".join(format_record_lines([book, book], "json")))[1]["uuid"] == book.uuid
+    assert json.loads("".join(format_record_lines([], "json"))) == []
+
+    rows = list(csv.reader(io.StringIO("".join(format_record_lines([book], "csv")))))
+    assert rows == [["uuid", "title", "authors", "publication_date", "isbn", "keywords"],
+                    ["16fd2706-8baf-433b-82eb-8c7fada847da", 'A "quoted", title', "A; B; C; D", "1970-01-31", "9791090636071", "Cat; Dog"]]
+
+    rows = list(csv.reader(io.StringIO("".join(format_record_lines([Book(title="T", authors=["A"])], "tsv"))), dialect="excel-tab"))
+    assert rows[1][1:] == ["T", "A", "", "", ""]
+
+    with pytest.raises(ValueError):
+        list(format_record_lines([book], "xml"))